@@ -2,6 +2,9 @@
 ASGI config for nexgenstack project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Lifespan events are handled here so that process-wide resources, such as the
+RabbitMQ broker pool, the outbox relay and the webhook dispatcher, are opened
+once at startup and closed on shutdown.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +16,51 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nexgenstack.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from svcs.broker import close_broker, get_broker  # noqa: E402
+from svcs.cache import subscribe_invalidations, unsubscribe_invalidations  # noqa: E402
+from svcs.outbox import start_outbox_relay, stop_outbox_relay  # noqa: E402
+from svcs.webhooks import start_webhook_dispatcher, stop_webhook_dispatcher  # noqa: E402
+
+
+async def startup():
+    broker = get_broker()
+    await broker.start()
+    await subscribe_invalidations(broker)
+    await start_outbox_relay()
+    await start_webhook_dispatcher()
+
+
+async def shutdown():
+    await stop_webhook_dispatcher()
+    await stop_outbox_relay()
+    unsubscribe_invalidations()
+    await close_broker()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            try:
+                await shutdown()
+            except Exception as e:
+                await send({"type": "lifespan.shutdown.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -10,11 +10,113 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+from importlib.util import find_spec
 from pathlib import Path
 import os
 
 EXCHANGE_NAME = 'x.compute_task_distributor'
 
+# State reports from compute nodes, see svcs/management/commands/conductor_events.py
+EVENTS_QUEUE_NAME = 'conductor.events'
+# Events that can never be applied are dead-lettered here for inspection
+# rather than dropped. Every declaration of the events queue must pass the
+# same arguments.
+EVENTS_DEAD_LETTER_QUEUE_NAME = 'conductor.events.dead'
+EVENTS_QUEUE_ARGUMENTS = {
+    'x-dead-letter-exchange': '',
+    'x-dead-letter-routing-key': EVENTS_DEAD_LETTER_QUEUE_NAME,
+}
+CONDUCTOR_EVENTS_BATCH_SIZE = int(os.getenv('CONDUCTOR_EVENTS_BATCH_SIZE', '100'))
+CONDUCTOR_EVENTS_WINDOW = float(os.getenv('CONDUCTOR_EVENTS_WINDOW', '0.1'))
+CONDUCTOR_EVENTS_MAX_RETRY_DELAY = int(os.getenv('CONDUCTOR_EVENTS_MAX_RETRY_DELAY', '30'))
+
+# Compute node placement, see svcs/scheduler.py
+SCHEDULER_FILTERS = [
+    'svcs.scheduler.ComputeFilter',
+    'svcs.scheduler.DiskFilter',
+    'svcs.scheduler.GpuFilter',
+]
+SCHEDULER_WEIGHERS = {
+    'svcs.scheduler.SpreadWeigher': 1.0,
+    'svcs.scheduler.LeastRecentlyUsedWeigher': 0.5,
+}
+SCHEDULER_INDEX_TTL = int(os.getenv('SCHEDULER_INDEX_TTL', '30'))
+
+# Flavor, Image, Environment and ComputeNode lookup cache, see svcs/cache.py
+CATALOG_EXCHANGE_NAME = 'x.catalog_invalidation'
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', '300'))
+CATALOG_CACHE_MAX_SIZE = int(os.getenv('CATALOG_CACHE_MAX_SIZE', '1024'))
+
+# Resolved API tokens, see svcs/authentication.py
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', '60'))
+TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', '10000'))
+
+# GET /v1/core/virtual-machines/ pagination
+VM_LIST_PAGE_SIZE = int(os.getenv('VM_LIST_PAGE_SIZE', '100'))
+VM_LIST_MAX_PAGE_SIZE = int(os.getenv('VM_LIST_MAX_PAGE_SIZE', '1000'))
+
+# callback_url notifications, see svcs/webhooks.py
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '32'))
+WEBHOOK_MAX_PER_HOST = int(os.getenv('WEBHOOK_MAX_PER_HOST', '4'))
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', '1'))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', '100'))
+WEBHOOK_LEASE = int(os.getenv('WEBHOOK_LEASE', '300'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '10'))
+WEBHOOK_BASE_BACKOFF = float(os.getenv('WEBHOOK_BASE_BACKOFF', '1'))
+WEBHOOK_MAX_BACKOFF = float(os.getenv('WEBHOOK_MAX_BACKOFF', '600'))
+WEBHOOK_CONNECT_TIMEOUT = float(os.getenv('WEBHOOK_CONNECT_TIMEOUT', '3.05'))
+WEBHOOK_READ_TIMEOUT = float(os.getenv('WEBHOOK_READ_TIMEOUT', '10'))
+# Deliver to loopback, link-local and private addresses, e.g. in development.
+WEBHOOK_ALLOW_PRIVATE_DESTINATIONS = os.getenv('WEBHOOK_ALLOW_PRIVATE_DESTINATIONS', '0') == '1'
+
+# Messages to compute nodes, see svcs/outbox.py and svcs/messages.py. An empty
+# MESSAGE_CONTENT_TYPE picks msgpack, and JSON on an install without it.
+MESSAGE_CONTENT_TYPE = os.getenv('MESSAGE_CONTENT_TYPE', '')
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1'))
+# A relay gives up on a batch after OUTBOX_PUBLISH_TIMEOUT seconds and
+# OUTBOX_LEASE must be longer, or another relay publishes it a second time.
+OUTBOX_PUBLISH_TIMEOUT = float(os.getenv('OUTBOX_PUBLISH_TIMEOUT', '60'))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', '120'))
+
+# PostgreSQL connection pool, see svcs/db/postgresql/base.py. Every request
+# runs its queries on one thread at a time, so the pool should be about as
+# large as the number of requests served concurrently, which ASGI_THREADS
+# also bounds for asgiref's executor. With psycopg 3 and psycopg_pool
+# installed, Django's own pool is used with the same options.
+POSTGRES_POOL = os.getenv('POSTGRES_POOL', '1') == '1'
+POSTGRES_NATIVE_POOL = find_spec('psycopg_pool') is not None
+POSTGRES_POOL_MIN_SIZE = int(os.getenv('POSTGRES_POOL_MIN_SIZE', '2'))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv('POSTGRES_POOL_MAX_SIZE') or os.getenv('ASGI_THREADS') or '20')
+POSTGRES_POOL_TIMEOUT = float(os.getenv('POSTGRES_POOL_TIMEOUT', '30'))
+POSTGRES_POOL_MAX_IDLE = float(os.getenv('POSTGRES_POOL_MAX_IDLE', '600'))
+POSTGRES_POOL_MAX_LIFETIME = float(os.getenv('POSTGRES_POOL_MAX_LIFETIME', '3600'))
+# The replica has a pool of its own, holding connections to another server.
+# It only serves reads that tolerate lag, so it keeps no idle connections by
+# default and can be capped below the primary's pool.
+POSTGRES_REPLICA_POOL_MIN_SIZE = int(os.getenv('POSTGRES_REPLICA_POOL_MIN_SIZE', '0'))
+POSTGRES_REPLICA_POOL_MAX_SIZE = int(os.getenv('POSTGRES_REPLICA_POOL_MAX_SIZE') or POSTGRES_POOL_MAX_SIZE)
+# Only used with POSTGRES_POOL=0.
+POSTGRES_CONN_MAX_AGE = int(os.getenv('POSTGRES_CONN_MAX_AGE', '0'))
+
+# Read replica, see svcs/routers.py. Setting POSTGRES_REPLICA_HOST sends the
+# reads of GET requests and catalog cache misses to it, except for clients
+# that wrote within the last DATABASE_REPLICA_STICKY_SECONDS.
+DATABASE_REPLICA_STICKY_SECONDS = int(os.getenv('DATABASE_REPLICA_STICKY_SECONDS', '5'))
+
+# Request and response bodies, see svcs/renderers.py and svcs/parsers.py
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'svcs.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'svcs.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -53,6 +155,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "svcs.routers.ReadYourWritesMiddleware",
 ]
 
 ROOT_URLCONF = "nexgenstack.urls"
@@ -79,21 +182,55 @@ WSGI_APPLICATION = "nexgenstack.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+def postgres_pool(min_size, max_size):
+    """
+    The pooling keys of a PostgreSQL entry of DATABASES.
+    """
+    if not POSTGRES_POOL:
+        return {"CONN_MAX_AGE": POSTGRES_CONN_MAX_AGE, "OPTIONS": {}, "POOL": None}
+    pool = {
+        "min_size": min_size,
+        "max_size": max_size,
+        "timeout": POSTGRES_POOL_TIMEOUT,
+        "max_idle": POSTGRES_POOL_MAX_IDLE,
+        "max_lifetime": POSTGRES_POOL_MAX_LIFETIME,
+    }
+    if POSTGRES_NATIVE_POOL:
+        return {"CONN_MAX_AGE": 0, "OPTIONS": {"pool": pool}, "POOL": None}
+    return {"CONN_MAX_AGE": 0, "OPTIONS": {}, "POOL": pool}
+
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
     },
     "postgres": {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": "svcs.db.postgresql",
         "NAME": os.environ.get("POSTGRES_DB"),
         "USER": os.environ.get("POSTGRES_USER"),
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD"),
         "HOST": os.environ.get("POSTGRES_HOST"),
         "PORT": os.environ.get("POSTGRES_PORT"),
+        "CONN_HEALTH_CHECKS": True,
+        **postgres_pool(POSTGRES_POOL_MIN_SIZE, POSTGRES_POOL_MAX_SIZE),
     },
 }
+DATABASES["postgres_replica"] = {
+    **DATABASES["postgres"],
+    "HOST": os.environ.get("POSTGRES_REPLICA_HOST", os.environ.get("POSTGRES_HOST")),
+    "PORT": os.environ.get("POSTGRES_REPLICA_PORT", os.environ.get("POSTGRES_PORT")),
+    **postgres_pool(POSTGRES_REPLICA_POOL_MIN_SIZE, POSTGRES_REPLICA_POOL_MAX_SIZE),
+    # Tests read the replica's data from the default database.
+    "TEST": {"MIRROR": "default"},
+}
 DATABASES['default'] = DATABASES[os.getenv('DJANGO_DB', 'default')]
+DATABASE_REPLICAS = (
+    ['postgres_replica']
+    if os.getenv('DJANGO_DB') == 'postgres' and os.getenv('POSTGRES_REPLICA_HOST')
+    else []
+)
+DATABASE_ROUTERS = ['svcs.routers.ReplicaRouter']
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
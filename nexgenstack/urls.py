@@ -17,11 +17,21 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path
-from svcs.views import VirtualMachineView
+from svcs.views import (
+    VirtualMachineBulkDeleteView,
+    VirtualMachineByLabelView,
+    VirtualMachineByNameView,
+    VirtualMachineStateView,
+    VirtualMachineView,
+)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path('v1/core/virtual-machines/', VirtualMachineView.as_view(), name='virtual_machine'),
-    path('v1/core/virtual-machines/<str:pk>/', VirtualMachineView.as_view(), name='virtual_machine_by_id'),
-    path('v1/internal/vm-state/<str:pk>/', VirtualMachineView.as_view(), name='virtual_machine_update_state'),
+    path('v1/core/virtual-machines/bulk-delete/', VirtualMachineBulkDeleteView.as_view(), name='virtual_machines_bulk_delete'),
+    path('v1/core/virtual-machines/<int:pk>/', VirtualMachineView.as_view(), name='virtual_machine_by_id'),
+    path('v1/core/virtual-machines/<str:environment_name>/labels/<str:label>/', VirtualMachineByLabelView.as_view(), name='virtual_machines_by_label'),
+    path('v1/core/virtual-machines/<str:environment_name>/<str:name>/', VirtualMachineByNameView.as_view(), name='virtual_machine_by_name'),
+    path('v1/internal/vm-state/<int:pk>/', VirtualMachineView.as_view(), name='virtual_machine_update_state'),
+    path('v1/internal/vm-states/', VirtualMachineStateView.as_view(), name='virtual_machine_update_states'),
 ]
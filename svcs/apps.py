@@ -3,3 +3,6 @@ from django.apps import AppConfig
 class SvcsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "svcs"
+
+    def ready(self):
+        from . import signals  # noqa: F401
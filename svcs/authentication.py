@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+
+from .cache import TTLCache, cache_clearers
+
+token_cache = TTLCache(maxsize=settings.TOKEN_CACHE_MAX_SIZE, ttl=settings.TOKEN_CACHE_TTL)
+# Cleared on every conductor replica when a token is deleted or a user or
+# their groups change, see svcs/signals.py.
+cache_clearers["authtoken.token"] = token_cache.clear
+cache_clearers["auth.user"] = token_cache.clear
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Async token authentication that caches the resolved token, user and
+    primary group for TOKEN_CACHE_TTL seconds.
+
+    Entries are dropped when their token is deleted, and the whole cache is
+    cleared when a user or a user's group membership changes.
+    """
+
+    async def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+
+        if len(auth) == 1:
+            msg = _('Invalid token header. No credentials provided.')
+            raise exceptions.AuthenticationFailed(msg)
+        elif len(auth) > 2:
+            msg = _('Invalid token header. Token string should not contain spaces.')
+            raise exceptions.AuthenticationFailed(msg)
+
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            msg = _('Invalid token header. Token string should not contain invalid characters.')
+            raise exceptions.AuthenticationFailed(msg)
+
+        return await self.aauthenticate_credentials(token)
+
+    async def aauthenticate_credentials(self, key):
+        user_auth_tuple = token_cache.get(key)
+        if user_auth_tuple is not None:
+            return user_auth_tuple
+
+        model = self.get_model()
+        try:
+            token = await model.objects.select_related('user').aget(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        await aget_primary_group(token.user)
+        user_auth_tuple = (token.user, token)
+        token_cache.set(key, user_auth_tuple)
+        return user_auth_tuple
+
+
+async def aget_primary_group(user):
+    """
+    Return the group the user acts on behalf of, or None, memoised on the
+    user instance so that cached users resolve it without a query.
+    """
+    if not hasattr(user, 'primary_group'):
+        user.primary_group = await user.groups.order_by('id').afirst()
+    return user.primary_group
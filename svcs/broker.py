@@ -0,0 +1,224 @@
+import asyncio
+import os
+import weakref
+from contextlib import asynccontextmanager
+
+import aio_pika
+from aio_pika.pool import Pool
+from django.conf import settings
+
+from .models import ComputeNode
+
+
+class BrokerChannel:
+    """
+    A pooled channel together with the task exchange declared on it.
+
+    The channel is reopened lazily when it is found closed on lease, so a
+    broker restart costs one reopen per pooled channel instead of failing
+    every request that happens to draw a dead channel.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channel = None
+        self.exchange = None
+        self.window = asyncio.Semaphore(broker.publish_window)
+
+    async def ensure_open(self):
+        if self.channel is not None and not self.channel.is_closed:
+            return
+        if self.channel is not None:
+            self.broker.topology.invalidate()
+        async with self.broker.connection_pool.acquire() as connection:
+            # With confirms on, a publish completes once the broker has
+            # taken responsibility for the message, and messages that no
+            # queue is bound for come back as errors instead of vanishing.
+            self.channel = await connection.channel(
+                publisher_confirms=True, on_return_raises=True
+            )
+        self.exchange = await self.channel.declare_exchange(
+            settings.EXCHANGE_NAME, aio_pika.ExchangeType.DIRECT, durable=True
+        )
+
+    async def publish(self, routing_key, body, content_type=None):
+        """
+        Publish a persistent message and wait for the broker to confirm it.
+
+        At most `publish_window` publishes are unconfirmed on the channel at
+        any time; further ones wait for a slot instead of piling up in the
+        client's buffers.
+        """
+        async with self.window:
+            await self.exchange.publish(
+                aio_pika.Message(
+                    body=body,
+                    content_type=content_type,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=routing_key,
+                timeout=self.broker.publish_timeout,
+            )
+
+    async def close(self):
+        if self.channel is not None and not self.channel.is_closed:
+            await self.channel.close()
+
+
+class Topology:
+    """
+    Registry of compute node queues already declared and bound on the broker.
+
+    Queues are durable, so declaring them once per connection is enough; the
+    registry is cleared whenever a connection or channel is re-established so
+    that a broker that lost its state gets the topology declared again.
+    """
+
+    def __init__(self):
+        self.declared = set()
+
+    async def ensure_queue(self, broker_channel, queue_name):
+        if queue_name in self.declared:
+            return
+        queue = await broker_channel.channel.declare_queue(queue_name, durable=True)
+        await queue.bind(broker_channel.exchange, routing_key=queue_name)
+        self.declared.add(queue_name)
+
+    def invalidate(self, *args):
+        self.declared.clear()
+
+
+class Broker:
+    """
+    Process-wide pool of robust RabbitMQ connections and channels.
+
+    A handful of robust connections carry a bounded pool of channels that
+    are shared by every view instance running on the same event loop.
+    """
+
+    def __init__(
+        self, host, port=5672, max_connections=2, max_channels=16, publish_window=256, publish_timeout=30
+    ):
+        self.host = host
+        self.port = port
+        self.publish_window = publish_window
+        self.publish_timeout = publish_timeout
+        self.topology = Topology()
+        self.subscription_channels = []
+        self.connection_pool = Pool(self._create_connection, max_size=max_connections)
+        self.channel_pool = Pool(self._create_channel, max_size=max_channels)
+
+    @classmethod
+    def from_environment(cls):
+        rabbitmq_host = os.environ.get("RABBITMQ_HOST")
+        if not rabbitmq_host:
+            raise ValueError("RABBITMQ_HOST environment variable is not set")
+        return cls(
+            host=rabbitmq_host,
+            port=int(os.environ.get("RABBITMQ_PORT") or 5672),
+            max_connections=int(os.environ.get("RABBITMQ_MAX_CONNECTIONS") or 2),
+            max_channels=int(os.environ.get("RABBITMQ_MAX_CHANNELS") or 16),
+            publish_window=int(os.environ.get("RABBITMQ_PUBLISH_WINDOW") or 256),
+            publish_timeout=float(os.environ.get("RABBITMQ_PUBLISH_TIMEOUT") or 30),
+        )
+
+    async def _create_connection(self):
+        connection = await aio_pika.connect_robust(host=self.host, port=self.port)
+        connection.reconnect_callbacks.add(self.topology.invalidate)
+        return connection
+
+    async def _create_channel(self):
+        return BrokerChannel(self)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.channel_pool.acquire() as broker_channel:
+            await broker_channel.ensure_open()
+            yield broker_channel
+
+    async def publish(self, routing_key, body, content_type=None):
+        """
+        Publish a single message, raising if the broker does not confirm it.
+        """
+        [error] = await self.publish_batch(routing_key, [body], content_type)
+        if error is not None:
+            raise error
+
+    async def publish_batch(self, routing_key, bodies, content_type=None):
+        """
+        Publish several messages to one queue over a single channel lease.
+
+        The publishes are pipelined on the channel up to its window rather
+        than waiting for each confirm in turn. Returns one entry per body:
+        None once the broker confirmed it, or the exception it failed with,
+        so that callers can retry exactly the messages that were not
+        delivered.
+        """
+        async with self.acquire() as broker_channel:
+            await self.topology.ensure_queue(broker_channel, routing_key)
+            results = await asyncio.gather(*[
+                broker_channel.publish(routing_key, body, content_type) for body in bodies
+            ], return_exceptions=True)
+        return [result if isinstance(result, BaseException) else None for result in results]
+
+    async def broadcast(self, exchange_name, body):
+        async with self.acquire() as broker_channel:
+            exchange = await broker_channel.channel.declare_exchange(
+                exchange_name, aio_pika.ExchangeType.FANOUT, durable=True
+            )
+            # Nobody listening is fine for a broadcast, so it is not
+            # mandatory for the message to reach a queue.
+            await exchange.publish(aio_pika.Message(body=body), routing_key="", mandatory=False)
+
+    async def subscribe(self, exchange_name, callback):
+        """
+        Consume a fanout exchange through an exclusive queue of this process.
+
+        Subscriptions get a channel of their own rather than a pooled one,
+        since a consuming channel is held for the lifetime of the process.
+        """
+        async with self.connection_pool.acquire() as connection:
+            channel = await connection.channel()
+        self.subscription_channels.append(channel)
+        exchange = await channel.declare_exchange(
+            exchange_name, aio_pika.ExchangeType.FANOUT, durable=True
+        )
+        queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        await queue.bind(exchange)
+        await queue.consume(callback, no_ack=True)
+
+    async def start(self):
+        async with self.acquire() as broker_channel:
+            async for compute_node_name in ComputeNode.objects.values_list("name", flat=True):
+                await self.topology.ensure_queue(broker_channel, f"q.{compute_node_name}")
+
+    async def close(self):
+        for channel in self.subscription_channels:
+            if not channel.is_closed:
+                await channel.close()
+        await self.channel_pool.close()
+        await self.connection_pool.close()
+
+
+_brokers = weakref.WeakKeyDictionary()
+
+
+def get_broker():
+    """
+    Return the broker for the running event loop, creating it on first use.
+
+    aio-pika connections are bound to the loop they were opened on, so each
+    loop gets its own pool.
+    """
+    loop = asyncio.get_running_loop()
+    broker = _brokers.get(loop)
+    if broker is None:
+        broker = Broker.from_environment()
+        _brokers[loop] = broker
+    return broker
+
+
+async def close_broker():
+    broker = _brokers.pop(asyncio.get_running_loop(), None)
+    if broker is not None:
+        await broker.close()
@@ -0,0 +1,171 @@
+"""
+In-process cache of the reference catalogs read on every VM create.
+
+Flavors, images, environments and compute nodes change a few times a day,
+so lookups are served from a TTL-bounded, size-limited cache. Any change
+saved through the ORM clears the model's cache locally and is broadcast on a
+RabbitMQ fanout exchange so that every other conductor replica clears its
+cache too; the TTL bounds staleness for changes made outside the ORM.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.shortcuts import aget_object_or_404
+
+from .models import ComputeNode, Environment, Flavor, Image
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Least-recently-used mapping whose entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CatalogCache:
+    """
+    Cache of model instances keyed by the lookup used to fetch them.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.cleared_at = float("-inf")
+        self.entries = TTLCache(
+            maxsize=settings.CATALOG_CACHE_MAX_SIZE, ttl=settings.CATALOG_CACHE_TTL
+        )
+
+    async def aget(self, **lookup):
+        """
+        Return the instance matching `lookup`, raising Http404 like
+        `aget_object_or_404` when there is none.
+        """
+        key = tuple(sorted(lookup.items()))
+        instance = self.entries.get(key)
+        if instance is None:
+            instance = await aget_object_or_404(self.queryset(), **lookup)
+            self.entries.set(key, instance)
+        return instance
+
+    def queryset(self):
+        # Misses may be read from a replica, see svcs/routers.py, except
+        # right after a change, which the replica may not have yet and which
+        # would then be cached for the whole TTL.
+        if time.monotonic() - self.cleared_at < settings.DATABASE_REPLICA_STICKY_SECONDS:
+            return self.model._default_manager.all()
+        return self.model._default_manager.db_manager(hints={"replica_ok": True}).all()
+
+    def clear(self):
+        self.cleared_at = time.monotonic()
+        self.entries.clear()
+
+
+flavors = CatalogCache(Flavor)
+images = CatalogCache(Image)
+environments = CatalogCache(Environment)
+compute_nodes = CatalogCache(ComputeNode)
+
+catalog_caches = {
+    cache.model._meta.label_lower: cache
+    for cache in [flavors, images, environments, compute_nodes]
+}
+
+# How to clear the other in-process caches that depend on a model, by the
+# model's label, e.g. the token cache of svcs/authentication.py.
+cache_clearers = {}
+
+_subscription = None
+
+
+def clear_cached(model_label):
+    cache = catalog_caches.get(model_label)
+    if cache is not None:
+        cache.clear()
+    clear = cache_clearers.get(model_label)
+    if clear is not None:
+        clear()
+
+
+def broadcast_invalidation(model_label):
+    """
+    Clear the caches depending on `model_label` and ask every other
+    conductor replica to clear theirs.
+
+    Safe to call from any thread; svcs/signals.py calls it once the change
+    is committed. The local cache is cleared even when the broadcast fails,
+    or before `subscribe_invalidations` has run in this process.
+    """
+    clear_cached(model_label)
+    if _subscription is None:
+        return
+    loop, broker = _subscription
+    body = json.dumps({"model": model_label}).encode()
+    future = asyncio.run_coroutine_threadsafe(
+        broker.broadcast(settings.CATALOG_EXCHANGE_NAME, body), loop
+    )
+    future.add_done_callback(lambda future: log_broadcast_failure(future, model_label))
+
+
+def log_broadcast_failure(future, model_label):
+    if not future.cancelled() and future.exception() is not None:
+        # Other replicas serve their cached entries until CATALOG_CACHE_TTL.
+        logger.error(
+            "Failed to broadcast the invalidation of %s", model_label,
+            exc_info=future.exception(),
+        )
+
+
+async def on_invalidation_message(message):
+    clear_cached(json.loads(message.body)["model"])
+
+
+async def subscribe_invalidations(broker):
+    global _subscription
+    await broker.subscribe(settings.CATALOG_EXCHANGE_NAME, on_invalidation_message)
+    _subscription = (asyncio.get_running_loop(), broker)
+
+
+def unsubscribe_invalidations():
+    global _subscription
+    _subscription = None
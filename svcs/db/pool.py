@@ -0,0 +1,194 @@
+"""
+A process-wide pool of database connections for drivers without one.
+
+Under ASGI every request runs its ORM calls on a thread of its own, so
+Django's persistent connections, which are kept per thread, are dropped at
+the end of every request. The pool keeps the connections instead: threads
+borrow one for as long as Django would have held it and hand it back when
+Django closes it.
+"""
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.idle_since = self.created_at
+
+
+class ConnectionPool:
+    """
+    A bounded pool that opens connections on demand up to `max_size` and
+    keeps up to `min_size` of them around even when they have been idle for
+    longer than `max_idle`.
+
+    `connect` opens a new connection and `configure` prepares it once after
+    opening. `check`, if given, is run on every connection before it is
+    handed out and a connection failing it is replaced. Connections older
+    than `max_lifetime` are replaced when they are returned.
+    """
+
+    def __init__(
+        self, connect, configure=None, check=None, min_size=0, max_size=10,
+        timeout=30.0, max_idle=600.0, max_lifetime=3600.0,
+    ):
+        self.connect = connect
+        self.configure = configure
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.idle = deque()
+        self.in_use = {}
+        self.size = 0
+        self.opened = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def open(self):
+        # Connections are opened on demand; kept for interface compatibility
+        # with psycopg_pool, which Django's PostgreSQL backend calls.
+        pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            pooled = self._reserve(deadline)
+            if pooled is None:
+                pooled = self._open_new()
+            elif self.check is not None and not self._healthy(pooled.connection):
+                self._discard(pooled)
+                continue
+            with self.condition:
+                self.in_use[id(pooled.connection)] = pooled
+            return pooled.connection
+
+    def putconn(self, connection):
+        with self.condition:
+            pooled = self.in_use.pop(id(connection), None)
+        if pooled is None:
+            raise ValueError("Connection does not belong to this pool")
+        now = time.monotonic()
+        if self.closed or connection.closed or now - pooled.created_at > self.max_lifetime:
+            self._discard(pooled)
+            return
+        try:
+            # Never hand out a connection that is still inside a transaction.
+            connection.rollback()
+        except Exception:
+            self._discard(pooled)
+            return
+        pooled.idle_since = now
+        with self.condition:
+            # Most recently used first, so the rest of the pool can go idle.
+            self.idle.append(pooled)
+            self.condition.notify()
+            expired = self._expire_idle(now)
+        for pooled in expired:
+            self._close_connection(pooled.connection)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for pooled in idle:
+            self._close_connection(pooled.connection)
+
+    def _reserve(self, deadline):
+        """
+        Take an idle connection, or reserve room for a new one and return
+        None, waiting up to `deadline` for either.
+        """
+        expired = []
+        try:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        raise PoolTimeout("The connection pool is closed")
+                    now = time.monotonic()
+                    expired.extend(self._expire_idle(now))
+                    if self.idle:
+                        return self.idle.pop()
+                    if self.size < self.max_size:
+                        self.size += 1
+                        return None
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            f"No connection available within {self.timeout}s, "
+                            f"all {self.max_size} are in use"
+                        )
+                    self.condition.wait(remaining)
+        finally:
+            for pooled in expired:
+                self._close_connection(pooled.connection)
+
+    def _expire_idle(self, now):
+        """
+        Remove the connections idle for longer than `max_idle` beyond
+        `min_size` and return them for the caller to close outside the lock.
+
+        Connections are returned to the right of `idle`, so the longest idle
+        ones are on the left.
+        """
+        expired = []
+        while (
+            self.idle
+            and self.size > self.min_size
+            and now - self.idle[0].idle_since > self.max_idle
+        ):
+            expired.append(self.idle.popleft())
+            self.size -= 1
+        return expired
+
+    def _open_new(self):
+        try:
+            connection = self.connect()
+            if self.configure is not None:
+                self.configure(connection)
+        except BaseException:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.opened += 1
+        return PooledConnection(connection)
+
+    def _healthy(self, connection):
+        try:
+            return not connection.closed and self.check(connection) is not False
+        except Exception:
+            return False
+
+    def _discard(self, pooled):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+        self._close_connection(pooled.connection)
+
+    def _close_connection(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": len(self.in_use),
+                "opened": self.opened,
+            }
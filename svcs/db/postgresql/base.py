@@ -0,0 +1,88 @@
+"""
+Django's PostgreSQL backend with connection pooling for psycopg2.
+
+Django 5.1 pools connections natively through OPTIONS["pool"], but only with
+psycopg 3 and psycopg_pool. With those installed this backend leaves pooling
+to Django; with psycopg2 it pools through svcs/db/pool.py, configured by the
+"POOL" key of the database settings:
+
+    "POOL": {"min_size": 2, "max_size": 20, "timeout": 30, ...}
+
+Like the native pool, it requires CONN_MAX_AGE = 0 and checks connections
+on checkout when CONN_HEALTH_CHECKS is on.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+from django.db.backends.base.base import NO_DB_ALIAS
+
+from svcs.db.pool import ConnectionPool
+
+
+def check_connection(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+    if not connection.autocommit:
+        connection.rollback()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    _connection_pools = {}
+
+    @property
+    def pool(self):
+        if self.settings_dict["OPTIONS"].get("pool"):
+            return super().pool
+        pool_options = self.settings_dict.get("POOL")
+        if self.alias == NO_DB_ALIAS or not pool_options:
+            return None
+
+        pool = self._connection_pools.get(self.alias)
+        if pool is not None and pool.dbname != self.settings_dict["NAME"]:
+            # The test runner switched the alias over to the test database.
+            self.close_pool()
+            pool = None
+        if pool is None:
+            if self.settings_dict.get("CONN_MAX_AGE", 0) != 0:
+                raise ImproperlyConfigured("Pooling doesn't support persistent connections.")
+            if is_psycopg3:
+                raise ImproperlyConfigured(
+                    'Use OPTIONS["pool"] instead of POOL to pool psycopg 3 connections.'
+                )
+            pool = ConnectionPool(
+                connect=self.connect_to_database,
+                configure=self.configure_pooled_connection,
+                check=check_connection if self.settings_dict["CONN_HEALTH_CHECKS"] else None,
+                **(pool_options if isinstance(pool_options, dict) else {}),
+            )
+            pool.dbname = self.settings_dict["NAME"]
+            # As in Django's own pooling, threads racing to create the pool
+            # settle on the first one.
+            pool = self._connection_pools.setdefault(self.alias, pool)
+        return pool
+
+    def close_pool(self):
+        pool = self._connection_pools.pop(self.alias, None)
+        if pool is not None:
+            pool.close()
+
+    def connect_to_database(self):
+        return self.Database.connect(**self.get_connection_params())
+
+    def configure_pooled_connection(self, connection):
+        # Runs once per physical connection, on behalf of Django's
+        # init_connection_state(), which skips this step for pooled ones.
+        if self._configure_connection(connection):
+            connection.commit()
+
+    def _close(self):
+        pool = self.pool
+        if self.connection is None or pool is None or is_psycopg3:
+            return super()._close()
+        with self.wrap_database_errors:
+            try:
+                pool.putconn(self.connection)
+            except ValueError:
+                # Borrowed from a pool that has since been replaced.
+                self.connection.close()
+            self.connection = None
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.core import signals
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = 'Measure the database connections opened per request, with and without the connection pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--queries', type=int, default=3, help='Queries per request')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        self.alias = options['database']
+        connection = connections[self.alias]
+        if connection.vendor != 'postgresql' or 'POOL' not in connection.settings_dict:
+            raise CommandError('The benchmark needs a database using the svcs.db.postgresql backend')
+        if connection.settings_dict['OPTIONS'].get('pool'):
+            raise CommandError('The benchmark measures the psycopg2 pool, not the psycopg 3 pool in OPTIONS["pool"]')
+        self.queries = options['queries']
+        pool_options = connection.settings_dict['POOL'] or {}
+        self.stdout.write(f'{"mode":<10}{"requests":>10}{"connections":>13}{"per request":>13}{"requests/s":>12}')
+        try:
+            for mode, pool in [('no pool', None), ('pool', pool_options)]:
+                connection.settings_dict['POOL'] = pool
+                connection.close_pool()
+                sessions, elapsed = asyncio.run(self.run_requests(options['requests'], options['concurrency']))
+                self.stdout.write(
+                    f'{mode:<10}{options["requests"]:>10}{len(sessions):>13}'
+                    f'{len(sessions) / options["requests"]:>13.2f}{options["requests"] / elapsed:>12.0f}'
+                )
+        finally:
+            connection.settings_dict['POOL'] = pool_options or None
+            connection.close_pool()
+
+    async def run_requests(self, count, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited():
+            async with semaphore:
+                return await self.request()
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[limited() for _ in range(count)])
+        return set().union(*results), time.perf_counter() - start
+
+    async def request(self):
+        """
+        Run queries the way an ASGI request does: on a thread of the
+        request's own, between the request_started and request_finished
+        signals that open and release connections.
+        """
+        async with ThreadSensitiveContext():
+            await sync_to_async(signals.request_started.send)(sender=self.__class__)
+            sessions = set()
+            for _ in range(self.queries):
+                sessions.add(await sync_to_async(self.session)())
+            await sync_to_async(signals.request_finished.send)(sender=self.__class__)
+        return sessions
+
+    def session(self):
+        # A server process and its start time identify a connection.
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(
+                'SELECT pid, backend_start FROM pg_stat_activity WHERE pid = pg_backend_pid()'
+            )
+            return cursor.fetchone()
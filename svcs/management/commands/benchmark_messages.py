@@ -0,0 +1,42 @@
+import timeit
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from svcs import messages
+
+
+class Command(BaseCommand):
+    help = 'Benchmark encoding and decoding of compute node messages in every available content type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-data-kb', type=int, default=16, help='Size of the user_data of the start message')
+        parser.add_argument('--vms', type=int, default=100, help='Number of VMs in the multi-VM delete message')
+        parser.add_argument('--number', type=int, default=10000, help='Encodes and decodes per measurement')
+
+    def handle(self, *args, **options):
+        vm = SimpleNamespace(
+            id=1,
+            name='benchmark-vm',
+            image=SimpleNamespace(name='ubuntu-24.04'),
+            flavor=SimpleNamespace(cpu_cores=4, memory_mb=8192, disk_gb=80),
+            user_data='#cloud-config\n' + 'x' * (options['user_data_kb'] * 1024),
+        )
+        vms = [SimpleNamespace(id=i, hypervisor_id=f'hv-{i}') for i in range(options['vms'])]
+        samples = {
+            'start': messages.start_vm(vm, '192.168.1.1', ['web', 'production']),
+            'delete': messages.delete_vm(1, 'hv-1'),
+            'delete_vms': messages.delete_vms(vms),
+        }
+        number = options['number']
+        self.stdout.write(f'{"message":<12}{"content type":<22}{"bytes":>10}{"encode/s":>14}{"decode/s":>14}')
+        for name, message in samples.items():
+            for content_type in messages.content_types():
+                body, _ = messages.encode(message, content_type)
+                encode = timeit.timeit(lambda: messages.encode(message, content_type), number=number)
+                decode = timeit.timeit(lambda: messages.decode(body, content_type), number=number)
+                self.stdout.write(
+                    f'{name:<12}{content_type:<22}{len(body):>10}{number / encode:>14.0f}{number / decode:>14.0f}'
+                )
+        if messages.msgpack is None:
+            self.stdout.write(self.style.WARNING('msgpack is not installed, only JSON was measured'))
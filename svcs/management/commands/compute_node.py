@@ -1,12 +1,90 @@
+import functools
 import os
 import pika
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from django.core.management.base import BaseCommand
 from django.conf import settings
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.urls import reverse
+from svcs import messages
 from .sdk import Client
 
+class StateReportBatcher:
+    """
+    Coalesce VM state reports from the worker threads into batches.
+
+    A batch is sent once it reaches `max_size` reports or `window` seconds
+    after its first report arrived, whichever comes first. `submit` returns a
+    future that resolves once the batch holding the report was delivered, so
+    workers can still ack a message only after its outcome was reported.
+    """
+
+    def __init__(self, send, max_size, window):
+        self.send = send
+        self.max_size = max_size
+        self.window = window
+        self.pending = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, report):
+        future = Future()
+        with self.condition:
+            self.pending.append((report, future))
+            self.condition.notify()
+        return future
+
+    def close(self, wait=True):
+        """
+        Send the pending reports and stop. With `wait=False` the caller
+        waits for `thread` itself, e.g. while servicing a connection that
+        `send` depends on.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if wait:
+            self.thread.join()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self.pending) < self.max_size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.pending[:self.max_size]
+            self.pending = self.pending[self.max_size:]
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            try:
+                self.send([report for report, _ in batch])
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+
+
 class Command(BaseCommand):
     help = 'Compute node service: listen to RabbitMQ queue'
 
@@ -32,83 +110,286 @@ class Command(BaseCommand):
         if not self.rabbitmq_port:
             self.rabbitmq_port = 5672
 
+        self.workers = int(os.getenv('COMPUTE_NODE_WORKERS', '4'))
+
+        self.callback_timeout = (
+            float(os.getenv('COMPUTE_NODE_CALLBACK_CONNECT_TIMEOUT', '3.05')),
+            float(os.getenv('COMPUTE_NODE_CALLBACK_READ_TIMEOUT', '10')),
+        )
+        self.session = self.create_session(int(os.getenv('COMPUTE_NODE_CALLBACK_RETRIES', '10')))
+        self.report_transport = os.getenv('COMPUTE_NODE_REPORT_TRANSPORT', 'broker')
+        if self.report_transport not in ('broker', 'http'):
+            raise ValueError('COMPUTE_NODE_REPORT_TRANSPORT must be either broker or http')
+        self.report_batch_size = int(os.getenv('COMPUTE_NODE_REPORT_BATCH_SIZE', '100'))
+        self.report_window = float(os.getenv('COMPUTE_NODE_REPORT_WINDOW', '0.05'))
+        self.report_retry_delay = float(os.getenv('COMPUTE_NODE_REPORT_RETRY_DELAY', '1'))
+        self.report_retry_max_delay = float(os.getenv('COMPUTE_NODE_REPORT_RETRY_MAX_DELAY', '60'))
+        # Futures of the hypervisor ids of the VMs started here, by VM id.
+        self.started_vms = {}
+        self.started_vms_lock = threading.Lock()
+
         hypervisor_client_api_key = os.getenv('HYPERVISOR_CLIENT_API_KEY')
         if not hypervisor_client_api_key:
             raise ValueError('HYPERVISOR_CLIENT_API_KEY environment variable is not set')
         self.client = Client(api_key=hypervisor_client_api_key)
         self.client.authenticate()
 
-    def virtual_machine_update_state(self, vm_id, hypervisor_id, state):
-        relative_url = reverse('virtual_machine_update_state', kwargs={'pk': vm_id})
-        url = f"{self.conductor_api_url}{relative_url}"
-        payload = {
-            'id': vm_id,
-            'hypervisor_id': hypervisor_id,
-            'state': state
-        }
-        headers = {'Content-Type': 'application/json'}
-        headers['Authorization'] = f'Token {self.compute_node_token}'
-        response = requests.patch(url, json=payload, headers=headers)
+    def create_session(self, retries):
+        """
+        Build the keep-alive session used for every call to the conductor.
+
+        Connection errors and 5xx responses are retried with jittered
+        exponential backoff, so a conductor restart delays state reports
+        instead of losing them.
+        """
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            backoff_max=60,
+            backoff_jitter=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({'POST', 'DELETE'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=self.workers)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Authorization'] = f'Token {self.compute_node_token}'
+        return session
+
+    def virtual_machine_update_states(self, reports):
+        url = f"{self.conductor_api_url}{reverse('virtual_machine_update_states')}"
+        response = self.session.post(url, json=reports, timeout=self.callback_timeout)
         if response.status_code != 200:
-            raise Exception(f'Failed to notify conductor about state change for VM {vm_id}')
-        self.stdout.write(self.style.SUCCESS(f'Successfully notified conductor about state change for VM {vm_id}'))
+            raise Exception(f'Failed to notify conductor about state changes for {len(reports)} VMs')
+        for vm_id in response.json()['not_found']:
+            self.stdout.write(self.style.WARNING(f'Conductor does not know VM {vm_id}'))
+        self.stdout.write(self.style.SUCCESS(f'Successfully notified conductor about state changes for {len(reports)} VMs'))
+
+    def publish_state_events(self, reports):
+        """
+        Publish a batch of state reports to the conductor events queue.
+
+        Runs on the batcher thread, so the publish is handed over to the
+        connection thread; it returns once the broker confirmed the message.
+        """
+        published = Future()
+
+        def publish():
+            try:
+                self.events_channel.basic_publish(
+                    exchange='',
+                    routing_key=settings.EVENTS_QUEUE_NAME,
+                    body=json.dumps(reports).encode(),
+                    properties=pika.BasicProperties(
+                        content_type='application/json',
+                        delivery_mode=pika.DeliveryMode.Persistent,
+                    ),
+                )
+            except BaseException as e:
+                published.set_exception(e)
+            else:
+                published.set_result(None)
+
+        self.connection.add_callback_threadsafe(publish)
+        published.result()
+        self.stdout.write(self.style.SUCCESS(f'Successfully published state changes for {len(reports)} VMs'))
+
+    def report_state(self, vm_id, hypervisor_id, state):
+        """
+        Report a state change through the batcher and wait until it is delivered.
+        """
+        report = {'id': vm_id, 'hypervisor_id': hypervisor_id, 'state': state}
+        self.state_reports.submit(report).result()
+
+    def report_states(self, reports):
+        futures = [self.state_reports.submit(report) for report in reports]
+        for future in futures:
+            future.result()
+
+    def deliver(self, send, description):
+        """
+        Call `send` until it succeeds, backing off between attempts.
+
+        Used for the outcomes of operations the hypervisor already carried
+        out: giving up would lose them, and reporting a running VM as failed
+        because the conductor was unreachable would be wrong. The message
+        stays unacked in the meantime.
+        """
+        delay = self.report_retry_delay
+        while True:
+            try:
+                return send()
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(
+                    f"Failed to report {description}, retrying in {delay:g}s: {e}"
+                ))
+                time.sleep(delay)
+                delay = min(max(delay * 2, self.report_retry_delay), self.report_retry_max_delay)
 
     def virtual_machine_delete(self, vm_id):
         relative_url = reverse('virtual_machine_by_id', kwargs={'pk': vm_id})
         url = f"{self.conductor_api_url}{relative_url}"
-        headers = { }
-        headers['Authorization'] = f'Token {self.compute_node_token}'
-        response = requests.delete(url, headers=headers)
-        if response.status_code != 204:
+        response = self.session.delete(url, timeout=self.callback_timeout)
+        # A 404 means a retried DELETE already went through.
+        if response.status_code not in (204, 404):
             raise Exception(f'Failed to notify conductor about VM deletion for VM {vm_id}')
         self.stdout.write(self.style.SUCCESS(f'Successfully notified conductor about VM deletion for VM {vm_id}'))
 
+    def process_message(self, body, content_type=None):
+        """
+        Carry out the request in `body` and report the outcome to the conductor.
+
+        Runs on a worker thread. Returns True if the message should be acked.
+        """
+        vm_id = None
+        hypervisor_id = None
+        try:
+            message = messages.decode(body, content_type)
+            if 'vms' in message:
+                self.process_bulk_delete(message)
+                return True
+            vm_id = message["id"]
+            requested_state = message["state"]
+            if requested_state == 'started':
+                hypervisor_id = self.start_vm(message)
+            elif requested_state == 'deleted':
+                hypervisor_id = message['hypervisor_id']
+                self.client.delete_vm(hypervisor_id)
+                self.forget_vm(vm_id)
+            else:
+                raise Exception(f"Invalid state {requested_state} for VM {vm_id}")
+        except BaseException as e:
+            self.stdout.write(self.style.ERROR(f"Error processing message: {e}"))
+            if vm_id is not None:
+                self.deliver(
+                    functools.partial(self.report_state, vm_id, hypervisor_id, "failed"),
+                    f"the failure of VM {vm_id}",
+                )
+            return False
+        if requested_state == 'deleted' and self.report_transport == 'http':
+            send = functools.partial(self.virtual_machine_delete, vm_id)
+        else:
+            send = functools.partial(self.report_state, vm_id, hypervisor_id, requested_state)
+        self.deliver(send, f"the {requested_state} state of VM {vm_id}")
+        return True
+
+    def start_vm(self, message):
+        """
+        Create the VM of a start message and return its hypervisor id.
+
+        The conductor's outbox may deliver a start message more than once. A
+        VM that was already started here, or is being started by another
+        worker, is not created a second time; its hypervisor id is returned
+        again so that the state report is repeated instead.
+        """
+        vm_id = message["id"]
+        with self.started_vms_lock:
+            started = self.started_vms.get(vm_id)
+            creating = started is None
+            if creating:
+                started = self.started_vms[vm_id] = Future()
+        if not creating:
+            self.stdout.write(self.style.WARNING(f"VM {vm_id} was already started, reporting it again"))
+            return started.result()
+        try:
+            vm = self.client.create_vm(
+                name=message["name"],
+                cpu_cores=message["cpu_cores"],
+                memory=message["memory_mb"],
+                disk_size=message["disk_gb"],
+                public_ip=message["public_ip"],
+                labels=message["labels"],
+            )
+        except BaseException as e:
+            self.forget_vm(vm_id)
+            started.set_exception(e)
+            raise
+        started.set_result(vm.id)
+        return vm.id
+
+    def forget_vm(self, vm_id):
+        with self.started_vms_lock:
+            self.started_vms.pop(vm_id, None)
+
+    def process_bulk_delete(self, message):
+        """
+        Delete every VM of a multi-VM delete message and report each outcome.
+        """
+        if message['state'] != 'deleted':
+            raise Exception(f"Invalid state {message['state']} for a multi-VM message")
+        reports = []
+        for vm in message['vms']:
+            try:
+                self.client.delete_vm(vm['hypervisor_id'])
+                self.forget_vm(vm['id'])
+                state = 'deleted'
+            except BaseException as e:
+                self.stdout.write(self.style.ERROR(f"Error deleting VM {vm['id']}: {e}"))
+                state = 'failed'
+            reports.append({'id': vm['id'], 'hypervisor_id': vm['hypervisor_id'], 'state': state})
+        self.deliver(functools.partial(self.report_states, reports), f"the states of {len(reports)} VMs")
+
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS(f'Starting RabbitMQ listener on compute node {self.compute_node_name}...'))
 
         connection_params = pika.ConnectionParameters(host=self.rabbitmq_host, port=self.rabbitmq_port)
         connection = pika.BlockingConnection(connection_params)
         channel = connection.channel()
+        channel.basic_qos(prefetch_count=self.workers)
         channel.exchange_declare(exchange=settings.EXCHANGE_NAME, exchange_type='direct', durable=True)
         queue_name = f"q.{self.compute_node_name}"
         channel.queue_declare(queue=queue_name, durable=True)
         channel.queue_bind(exchange=settings.EXCHANGE_NAME, queue=queue_name, routing_key=queue_name)
 
+        self.connection = connection
+        if self.report_transport == 'broker':
+            self.events_channel = connection.channel()
+            self.events_channel.queue_declare(
+                queue=settings.EVENTS_QUEUE_NAME, durable=True, arguments=settings.EVENTS_QUEUE_ARGUMENTS
+            )
+            self.events_channel.confirm_delivery()
+            send_state_reports = self.publish_state_events
+        else:
+            send_state_reports = self.virtual_machine_update_states
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        in_flight = set()
+        self.state_reports = StateReportBatcher(
+            send_state_reports,
+            max_size=self.report_batch_size,
+            window=self.report_window,
+        )
+        self.state_reports.start()
+
+        def settle(ch, delivery_tag, future):
+            # Runs on the connection thread: pika channels are not thread-safe.
+            in_flight.discard(future)
+            if future.result():
+                ch.basic_ack(delivery_tag=delivery_tag)
+            else:
+                ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
         def callback(ch, method, properties, body):
-            vm_id = None
-            hypervisor_id = None
-            try:
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f"{self.compute_node_name}: received {body} with routing key {method.routing_key}"
-                    )
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{self.compute_node_name}: received {len(body)} bytes of {properties.content_type or messages.JSON} "
+                    f"with routing key {method.routing_key}"
                 )
-                message = json.loads(body.decode('utf-8'))
-                vm_id = message["id"]
-                requested_state = message["state"]
-                if requested_state == 'started':
-                    vm = self.client.create_vm(
-                        name=message["name"],
-                        cpu_cores=message["cpu_cores"],
-                        memory=message["memory_mb"],
-                        disk_size=message["disk_gb"],
-                        public_ip=message["public_ip"],
-                        labels=message["labels"],
-                    )
-                    hypervisor_id = vm.id
-                    self.virtual_machine_update_state(vm_id, hypervisor_id, requested_state)
-                elif requested_state == 'deleted':
-                    hypervisor_id = message['hypervisor_id']
-                    self.client.delete_vm(hypervisor_id)
-                    self.virtual_machine_delete(vm_id)
-                else:
-                    raise Exception(f"Invalid state {requested_state} for VM {vm_id}")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-            except BaseException as e:
-                self.stdout.write(self.style.ERROR(f"Error processing message: {e}"))
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-                if vm_id is not None:
-                    self.virtual_machine_update_state(vm_id, hypervisor_id, "failed")
+            )
+            future = executor.submit(self.process_message, body, properties.content_type)
+            in_flight.add(future)
+            future.add_done_callback(
+                lambda future: connection.add_callback_threadsafe(
+                    functools.partial(settle, ch, method.delivery_tag, future)
+                )
+            )
+
+        def stop(signum, frame):
+            connection.add_callback_threadsafe(channel.stop_consuming)
+
+        previous_sigterm_handler = signal.signal(signal.SIGTERM, stop)
 
         channel.basic_consume(
             queue=queue_name,
@@ -116,4 +397,21 @@ class Command(BaseCommand):
             auto_ack=False,
         )
         self.stdout.write(self.style.SUCCESS('Waiting for messages. To exit press CTRL+C'))
-        channel.start_consuming()
+        try:
+            channel.start_consuming()
+        finally:
+            self.stdout.write(self.style.SUCCESS('Draining in-flight messages...'))
+            # Workers and the batcher may be waiting on publishes that only
+            # the connection thread can carry out, and blocking it would also
+            # stop heartbeats, so keep servicing it instead of joining them.
+            while not all(future.done() for future in list(in_flight)):
+                connection.process_data_events(time_limit=0.1)
+            # Every task is done, so this no longer blocks.
+            executor.shutdown(wait=True)
+            self.state_reports.close(wait=False)
+            while self.state_reports.thread.is_alive():
+                connection.process_data_events(time_limit=0.1)
+            # Run the acks scheduled by the last tasks.
+            connection.process_data_events(time_limit=0)
+            connection.close()
+            signal.signal(signal.SIGTERM, previous_sigterm_handler)
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import os
+import signal
+
+import aio_pika
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from svcs.serializers import VirtualMachineStateSerializer
+from svcs.state import apply_state_reports
+
+
+class Command(BaseCommand):
+    help = 'Conductor service: apply VM state events published by compute nodes'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rabbitmq_host = os.getenv('RABBITMQ_HOST')
+        if not self.rabbitmq_host:
+            raise ValueError('RABBITMQ_HOST environment variable is not set')
+
+        self.rabbitmq_port = int(os.getenv('RABBITMQ_PORT') or 5672)
+        self.batch_size = settings.CONDUCTOR_EVENTS_BATCH_SIZE
+        self.window = settings.CONDUCTOR_EVENTS_WINDOW
+        self.max_retry_delay = settings.CONDUCTOR_EVENTS_MAX_RETRY_DELAY
+        self.retry_delay = 0
+
+    def handle(self, *args, **options):
+        asyncio.run(self.consume())
+
+    async def consume(self):
+        self.stdout.write(self.style.SUCCESS(f'Starting consumer of {settings.EVENTS_QUEUE_NAME}...'))
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+
+        connection = await aio_pika.connect_robust(host=self.rabbitmq_host, port=self.rabbitmq_port)
+        async with connection:
+            channel = await connection.channel()
+            # The prefetch bounds how far the broker runs ahead of the
+            # database; unacked events stay queued on the broker.
+            await channel.set_qos(prefetch_count=self.batch_size)
+            await channel.declare_queue(settings.EVENTS_DEAD_LETTER_QUEUE_NAME, durable=True)
+            queue = await channel.declare_queue(
+                settings.EVENTS_QUEUE_NAME, durable=True, arguments=settings.EVENTS_QUEUE_ARGUMENTS
+            )
+            messages = asyncio.Queue()
+            consumer_tag = await queue.consume(messages.put)
+            self.stdout.write(self.style.SUCCESS('Waiting for state events. To exit press CTRL+C'))
+            while not stopping.is_set():
+                batch = await self.next_batch(messages)
+                if batch:
+                    await self.apply_batch(batch)
+            await queue.cancel(consumer_tag)
+            # Events delivered but not yet applied are requeued by the
+            # broker when the channel closes.
+
+    async def next_batch(self, messages):
+        """
+        Wait up to a second for an event, then collect more until the batch
+        is full or the batching window has elapsed.
+        """
+        try:
+            batch = [await asyncio.wait_for(messages.get(), timeout=1)]
+        except asyncio.TimeoutError:
+            return []
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(messages.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def apply_batch(self, batch):
+        reports = []
+        accepted = []
+        for message in batch:
+            try:
+                data = json.loads(message.body)
+            except ValueError:
+                data = None
+            serializer = VirtualMachineStateSerializer(data=data, many=True)
+            if not serializer.is_valid():
+                self.stdout.write(self.style.ERROR(f'Dead-lettering invalid state event {message.body!r}'))
+                await message.reject(requeue=False)
+                continue
+            reports.append(serializer.validated_data)
+            accepted.append(message)
+        if not reports:
+            return
+
+        try:
+            await self.apply_reports([report for message_reports in reports for report in message_reports])
+        except Exception as e:
+            if len(accepted) == 1:
+                requeued = [await self.failed(accepted[0], e)]
+            else:
+                # One bad event must not hold back the rest of the batch:
+                # apply the events one by one to find it.
+                self.stdout.write(self.style.ERROR(f'Error applying state events, applying them one by one: {e}'))
+                requeued = []
+                for message, message_reports in zip(accepted, reports):
+                    try:
+                        await self.apply_reports(message_reports)
+                    except Exception as e:
+                        requeued.append(await self.failed(message, e))
+                    else:
+                        await message.ack()
+            if any(requeued):
+                await self.back_off()
+            return
+
+        self.retry_delay = 0
+        await asyncio.gather(*[message.ack() for message in accepted])
+
+    async def back_off(self):
+        """
+        Wait before the requeued events come round again, twice as long
+        after every failed batch up to `max_retry_delay`, so an outage of
+        the database is not met with a busy loop.
+        """
+        self.retry_delay = min(self.retry_delay * 2 or 1, self.max_retry_delay)
+        await asyncio.sleep(self.retry_delay)
+
+    async def apply_reports(self, reports):
+        await sync_to_async(close_old_connections)()
+        vms, not_found = await apply_state_reports(reports)
+        for vm_id in not_found:
+            self.stdout.write(self.style.WARNING(f'Ignoring state event for unknown VM {vm_id}'))
+        self.stdout.write(self.style.SUCCESS(f'Applied {len(reports)} state events for {len(vms)} VMs'))
+
+    async def failed(self, message, error):
+        """
+        Requeue an event that could not be applied and return whether it was
+        requeued.
+
+        A lost or unusable database connection is requeued however often the
+        event was delivered, since `redelivered` is also set on every event
+        that was in flight when a conductor restarted. Any other error fails
+        the same way every time, so an event that fails with one again after
+        redelivery is dead-lettered rather than retried forever.
+        """
+        if message.redelivered and not isinstance(error, (OperationalError, InterfaceError)):
+            self.stdout.write(self.style.ERROR(f'Dead-lettering state event {message.body!r} that failed again: {error}'))
+            await message.reject(requeue=False)
+            return False
+        self.stdout.write(self.style.ERROR(f'Error applying state event, requeueing it: {error}'))
+        await message.nack(requeue=True)
+        return True
@@ -0,0 +1,109 @@
+"""
+Wire format of the messages the conductor sends to compute nodes.
+
+Both sides build and parse messages through this module only. Every message
+is a mapping that carries the schema `version` it was written with. Decoders
+ignore keys they do not know, so optional fields can be added without
+redeploying every compute node at once; a change that older compute nodes
+cannot handle bumps SCHEMA_VERSION, and they reject such messages instead
+of misreading them.
+
+Bodies are encoded with msgpack, a dependency in pyproject.toml, and with
+JSON on an install that lacks it; the AMQP content type says which.
+Messages without a content type are JSON, which is what compute nodes were
+sent before this module.
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SCHEMA_VERSION = 1
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+class MessageError(ValueError):
+    pass
+
+
+def content_types():
+    """
+    The content types this process can encode and decode.
+    """
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def default_content_type():
+    return settings.MESSAGE_CONTENT_TYPE or content_types()[0]
+
+
+def encode(message, content_type=None):
+    """
+    Return the body of `message` and the content type it was encoded with.
+    """
+    content_type = content_type or default_content_type()
+    message = {"version": SCHEMA_VERSION, **message}
+    if content_type == MSGPACK and msgpack is not None:
+        return msgpack.packb(message, use_bin_type=True), content_type
+    if content_type == JSON:
+        return json.dumps(message).encode(), content_type
+    raise MessageError(f"Cannot encode messages as {content_type}")
+
+
+def decode(body, content_type=None):
+    try:
+        if content_type in (None, "", JSON):
+            message = json.loads(body)
+        elif content_type == MSGPACK and msgpack is not None:
+            message = msgpack.unpackb(body, raw=False)
+        else:
+            raise MessageError(f"Cannot decode messages of type {content_type}")
+    except MessageError:
+        raise
+    except Exception as e:
+        raise MessageError(f"Malformed message: {e}") from e
+    if not isinstance(message, dict):
+        raise MessageError("Malformed message: not a mapping")
+    version = message.get("version", 1)
+    if not isinstance(version, int) or version > SCHEMA_VERSION:
+        raise MessageError(f"Unsupported message version {version}")
+    return message
+
+
+def start_vm(vm, public_ip, labels):
+    return {
+        "id": vm.id,
+        "name": vm.name,
+        "state": "started",
+        "image": vm.image.name,
+        "cpu_cores": vm.flavor.cpu_cores,
+        "memory_mb": vm.flavor.memory_mb,
+        "disk_gb": vm.flavor.disk_gb,
+        "user_data": vm.user_data,
+        "labels": labels,
+        "public_ip": public_ip,
+    }
+
+
+def delete_vm(vm_id, hypervisor_id):
+    return {
+        "id": vm_id,
+        "hypervisor_id": hypervisor_id,
+        "state": "deleted",
+    }
+
+
+def delete_vms(vms):
+    """
+    A single message deleting several VMs of the same compute node.
+    """
+    return {
+        "state": "deleted",
+        "vms": [{"id": vm.id, "hypervisor_id": vm.hypervisor_id} for vm in vms],
+    }
@@ -0,0 +1,58 @@
+# Generated by Django 5.1 on 2026-10-17 10:30
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_allocated_capacity(apps, schema_editor):
+    ComputeNode = apps.get_model("svcs", "ComputeNode")
+    VirtualMachine = apps.get_model("svcs", "VirtualMachine")
+    usage = (
+        VirtualMachine.objects.filter(compute_node__isnull=False)
+        .exclude(state="failed")
+        .values("compute_node_id")
+        .annotate(
+            cpu_cores=Sum("flavor__cpu_cores"),
+            memory_mb=Sum("flavor__memory_mb"),
+            disk_gb=Sum("flavor__disk_gb"),
+            gpu_count=Sum("flavor__gpu_count"),
+        )
+    )
+    for row in usage:
+        ComputeNode.objects.filter(pk=row["compute_node_id"]).update(
+            allocated_cpu_cores=row["cpu_cores"],
+            allocated_memory_mb=row["memory_mb"],
+            allocated_disk_gb=row["disk_gb"],
+            allocated_gpu_count=row["gpu_count"],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="computenode",
+            name="allocated_cpu_cores",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computenode",
+            name="allocated_disk_gb",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computenode",
+            name="allocated_gpu_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computenode",
+            name="allocated_memory_mb",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_allocated_capacity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1 on 2026-10-17 10:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0002_computenode_allocated_capacity"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="floatingip",
+            index=models.Index(
+                condition=models.Q(("virtual_machine__isnull", True)),
+                fields=["id"],
+                name="floatingip_free_idx",
+            ),
+        ),
+    ]
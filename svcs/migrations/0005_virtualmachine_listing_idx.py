@@ -0,0 +1,20 @@
+# Generated by Django 5.1 on 2026-10-17 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0004_webhookdelivery"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="virtualmachine",
+            index=models.Index(
+                fields=["environment", "created_at", "id"],
+                name="virtualmachine_listing_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1 on 2026-10-17 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0005_virtualmachine_listing_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="vmlabel",
+            index=models.Index(
+                fields=["name", "virtual_machine"],
+                name="vmlabel_name_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1 on 2026-10-17 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0006_vmlabel_name_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxMessage",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("routing_key", models.CharField(max_length=255)),
+                ("body", models.BinaryField()),
+                ("claim", models.CharField(blank=True, db_index=True, max_length=32, null=True)),
+                ("claimed_until", models.DateTimeField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-17 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0007_outboxmessage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxmessage",
+            name="content_type",
+            field=models.CharField(default="application/json", max_length=64),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-17 11:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0008_outboxmessage_content_type"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="virtualmachine",
+            index=models.Index(fields=["created_at", "id"], name="virtualmachine_created_idx"),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1 on 2026-10-17 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0009_virtualmachine_created_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReadPin",
+            fields=[
+                ("client", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("pinned_until", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1 on 2026-10-17 12:20
+
+from urllib.parse import urlsplit
+
+from django.db import migrations, models
+
+
+def backfill_host(apps, schema_editor):
+    WebhookDelivery = apps.get_model("svcs", "WebhookDelivery")
+    deliveries = list(WebhookDelivery.objects.only("url"))
+    for delivery in deliveries:
+        delivery.host = urlsplit(delivery.url).netloc
+    WebhookDelivery.objects.bulk_update(deliveries, ["host"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("svcs", "0010_readpin"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="webhookdelivery",
+            name="host",
+            field=models.CharField(default="", max_length=255),
+        ),
+        migrations.RunPython(backfill_host, migrations.RunPython.noop),
+    ]
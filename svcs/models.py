@@ -21,6 +21,10 @@ class ComputeNode(models.Model):
     disk_gb = models.PositiveIntegerField()
     gpu_type = models.CharField(max_length=255)
     gpu_count = models.PositiveIntegerField()
+    allocated_cpu_cores = models.PositiveIntegerField(default=0)
+    allocated_memory_mb = models.PositiveIntegerField(default=0)
+    allocated_disk_gb = models.PositiveIntegerField(default=0)
+    allocated_gpu_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -38,6 +42,13 @@ class FloatingIP(models.Model):
                 name='unique_virtual_machine'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['id'],
+                condition=Q(virtual_machine__isnull=True),
+                name='floatingip_free_idx'
+            )
+        ]
 
 
 class Image(models.Model):
@@ -85,6 +96,17 @@ class VirtualMachine(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     class Meta:
         unique_together = ('name', 'environment')
+        indexes = [
+            models.Index(
+                fields=['environment', 'created_at', 'id'],
+                name='virtualmachine_listing_idx'
+            ),
+            # Serves the group-wide listing, which pages across environments.
+            models.Index(
+                fields=['created_at', 'id'],
+                name='virtualmachine_created_idx'
+            ),
+        ]
 
 
 class VMKeyBinding(models.Model):
@@ -103,3 +125,42 @@ class VMLabel(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     class Meta:
         unique_together = ('virtual_machine', 'name')
+        indexes = [
+            models.Index(
+                fields=['name', 'virtual_machine'],
+                name='vmlabel_name_idx'
+            )
+        ]
+
+
+class WebhookDelivery(models.Model):
+    # Not a foreign key: the notification about a deletion outlives the VM.
+    virtual_machine_id = models.BigIntegerField(unique=True)
+    url = models.URLField()
+    # The netloc of `url`, so that the dispatcher can leave out busy hosts
+    # in the query.
+    host = models.CharField(max_length=255, default="")
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class OutboxMessage(models.Model):
+    # Written in the same transaction as the rows the message describes and
+    # deleted by the relay once the broker has confirmed it, see svcs/outbox.py.
+    routing_key = models.CharField(max_length=255)
+    body = models.BinaryField()
+    content_type = models.CharField(max_length=64, default="application/json")
+    claim = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class ReadPin(models.Model):
+    # Clients that wrote recently and must read from the primary, shared by
+    # every conductor process, see svcs/routers.py. Keyed by a keyed hash of
+    # the client's token, never by the token itself.
+    client = models.CharField(max_length=64, primary_key=True)
+    pinned_until = models.DateTimeField()
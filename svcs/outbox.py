@@ -0,0 +1,177 @@
+"""
+Transactional outbox for messages to compute nodes.
+
+Messages are written to the OutboxMessage table in the same transaction as
+the rows they describe, so a VM is never committed without its start
+message, and a rolled back create never reaches a compute node. The relay
+publishes pending rows in batches over the broker pool and deletes them only
+after the broker has confirmed them. A crash in between means a message is
+published again, never that it is lost.
+"""
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Q, Subquery
+from django.utils import timezone
+
+from .broker import get_broker
+from .messages import encode
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+def add_outbox_messages(messages):
+    """
+    Encode `(routing_key, message)` pairs, see svcs/messages.py, and write
+    them to the outbox.
+
+    Must be called inside the transaction that writes the rows the messages
+    describe; the relay is woken once that transaction commits.
+    """
+    outbox_messages = []
+    for routing_key, message in messages:
+        body, content_type = encode(message)
+        outbox_messages.append(
+            OutboxMessage(routing_key=routing_key, body=body, content_type=content_type)
+        )
+    OutboxMessage.objects.bulk_create(outbox_messages)
+    transaction.on_commit(wake_outbox_relay, using=router.db_for_write(OutboxMessage))
+
+
+def wake_outbox_relay():
+    if _relay is not None:
+        _relay.wake()
+
+
+class OutboxRelay:
+    """
+    Publish the outbox to the broker.
+
+    Claimed messages are published for at most `publish_timeout` seconds,
+    which must be shorter than the `lease`, so that no other relay claims
+    them again while they are still being published.
+    """
+
+    def __init__(self, batch_size, poll_interval, lease, publish_timeout):
+        if publish_timeout >= lease:
+            raise ValueError("The outbox lease must be longer than its publish timeout")
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.publish_timeout = publish_timeout
+        self.woken = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            batch_size=settings.OUTBOX_BATCH_SIZE,
+            poll_interval=settings.OUTBOX_POLL_INTERVAL,
+            lease=settings.OUTBOX_LEASE,
+            publish_timeout=settings.OUTBOX_PUBLISH_TIMEOUT,
+        )
+
+    def wake(self):
+        # Called from the thread that committed the transaction.
+        self.loop.call_soon_threadsafe(self.woken.set)
+
+    async def run(self):
+        while True:
+            try:
+                await self.relay_pending()
+            except Exception:
+                logger.exception("Failed to relay outbox messages")
+            try:
+                await asyncio.wait_for(self.woken.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.woken.clear()
+
+    async def relay_pending(self):
+        """
+        Publish batches until the outbox holds no unclaimed messages.
+        """
+        while await self.relay_batch() == self.batch_size:
+            pass
+
+    async def relay_batch(self):
+        """
+        Claim up to `batch_size` messages, publish them and delete the ones
+        the broker confirmed. Returns the number of messages claimed.
+        """
+        messages = await self.claim()
+        if not messages:
+            return 0
+        by_destination = defaultdict(list)
+        for message in messages:
+            by_destination[message.routing_key, message.content_type].append(message)
+
+        broker = get_broker()
+        results = await asyncio.gather(*[
+            asyncio.wait_for(
+                broker.publish_batch(routing_key, [bytes(message.body) for message in queued], content_type),
+                timeout=self.publish_timeout,
+            )
+            for (routing_key, content_type), queued in by_destination.items()
+        ], return_exceptions=True)
+
+        # Unconfirmed messages keep their claim until the lease runs out and
+        # are published again after that.
+        published = []
+        for ((routing_key, _), queued), errors in zip(by_destination.items(), results):
+            if isinstance(errors, BaseException):
+                errors = [errors] * len(queued)
+            failed = [error for error in errors if error is not None]
+            if failed:
+                logger.warning(
+                    "Broker did not confirm %s of %s messages to %s: %s",
+                    len(failed), len(queued), routing_key, failed[0],
+                )
+            published.extend(message.pk for message, error in zip(queued, errors) if error is None)
+        if published:
+            # Should the lease have run out anyway, the messages belong to
+            # the relay that claimed them since.
+            await OutboxMessage.objects.filter(pk__in=published, claim=messages[0].claim).adelete()
+        return len(messages)
+
+    async def claim(self):
+        """
+        Lease the oldest unclaimed messages with a single UPDATE, so that
+        relays of other conductor replicas skip them.
+        """
+        now = timezone.now()
+        unclaimed = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+        oldest = OutboxMessage.objects.filter(unclaimed).order_by("id").values("id")
+        claim = uuid.uuid4().hex
+        claimed = await OutboxMessage.objects.filter(
+            unclaimed, pk__in=Subquery(oldest[:self.batch_size])
+        ).aupdate(claim=claim, claimed_until=now + timedelta(seconds=self.lease))
+        if not claimed:
+            return []
+        return [message async for message in OutboxMessage.objects.filter(claim=claim).order_by("id")]
+
+
+_relay = None
+_relay_task = None
+
+
+async def start_outbox_relay():
+    global _relay, _relay_task
+    _relay = OutboxRelay.from_settings()
+    _relay_task = asyncio.create_task(_relay.run())
+
+
+async def stop_outbox_relay():
+    global _relay, _relay_task
+    if _relay_task is None:
+        return
+    _relay_task.cancel()
+    await asyncio.gather(_relay_task, return_exceptions=True)
+    _relay = None
+    _relay_task = None
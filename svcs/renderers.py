@@ -0,0 +1,40 @@
+"""
+JSON rendering with orjson, which serializes datetimes, dates, times and
+UUIDs natively instead of handing every one of them to a Python-level
+encoder. Falls back to DRF's stdlib renderer when orjson is not installed.
+"""
+import ipaddress
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(obj):
+    """
+    Called by orjson only for types it does not know.
+    """
+    if isinstance(obj, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        return str(obj)
+    # Decimals, lazy translations, querysets and the like.
+    return JSONEncoder().default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    # Like DRF's renderer, and unlike orjson's default, UTC is written as "Z"
+    # and dict keys may be integers, which ListField errors use.
+    options = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b""
+        options = self.options
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=encode_default, option=options)
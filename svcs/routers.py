@@ -0,0 +1,186 @@
+"""
+Routing of reads to the read replicas in DATABASE_REPLICAS.
+
+Only reads that can tolerate replication lag leave the primary:
+
+- reads of `svcs` models made by GET, HEAD and OPTIONS requests, and
+- catalog cache misses, see svcs/cache.py, which pass the `replica_ok`
+  hint.
+
+Everything else, including every query made in a transaction and by the
+management commands, stays on the primary. A client that wrote is pinned to
+the primary for DATABASE_REPLICA_STICKY_SECONDS so that it reads its own
+writes on whichever conductor process serves it next. Token clients are
+pinned in the ReadPin table, keyed by a keyed hash of their credentials and
+checked with one primary key lookup on the primary per safe request; this
+process also remembers the clients it pinned, to skip that lookup. Other
+clients are pinned by a cookie.
+"""
+import contextvars
+import random
+from datetime import timedelta
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from .cache import TTLCache
+from .models import ReadPin
+
+PIN_COOKIE_NAME = "svcs_read_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_request_reads = contextvars.ContextVar("request_reads", default=None)
+recent_writers = TTLCache(maxsize=10000, ttl=settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+class RequestReads:
+    """
+    Where the reads of one request may go.
+    """
+
+    def __init__(self, request):
+        self.client = client_key(request)
+        self.wrote = False
+        # One replica per request, so that its reads see a single snapshot.
+        self.replica = random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else None
+        self.pinned = (
+            request.method not in SAFE_METHODS
+            or PIN_COOKIE_NAME in request.COOKIES
+            or (self.client is not None and recent_writers.get(self.client) is not None)
+        )
+
+    def use_replica(self):
+        return not (self.pinned or self.wrote)
+
+    def may_be_pinned(self):
+        return not self.pinned and self.client is not None and bool(settings.DATABASE_REPLICAS)
+
+    def check_pin(self):
+        """
+        Pin the request to the primary if its client wrote through another
+        conductor process.
+        """
+        self.pinned = ReadPin.objects.using(DEFAULT_DB_ALIAS).filter(
+            client=self.client, pinned_until__gt=timezone.now()
+        ).exists()
+
+    def needs_pin(self):
+        return self.wrote and self.client is not None and bool(settings.DATABASE_REPLICAS)
+
+    def pin(self):
+        """
+        Pin the client to the primary in every conductor process.
+        """
+        recent_writers.set(self.client, True)
+        pinned_until = timezone.now() + timedelta(seconds=settings.DATABASE_REPLICA_STICKY_SECONDS)
+        ReadPin.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            [ReadPin(client=self.client, pinned_until=pinned_until)],
+            update_conflicts=True,
+            unique_fields=["client"],
+            update_fields=["pinned_until"],
+        )
+
+
+def client_key(request):
+    """
+    Identify the client of `request` by a keyed hash of its Authorization
+    header, so that no bearer token is kept in memory or in the database.
+    """
+    authorization = request.headers.get("Authorization")
+    if not authorization:
+        return None
+    return salted_hmac("svcs.routers.client_key", authorization, algorithm="sha256").hexdigest()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != "svcs" or not settings.DATABASE_REPLICAS:
+            return None
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db is not None:
+            # Related objects come from where the instance did.
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        reads = _request_reads.get()
+        if hints.get("replica_ok"):
+            return reads.replica if reads is not None else random.choice(settings.DATABASE_REPLICAS)
+        if reads is None or not reads.use_replica():
+            return DEFAULT_DB_ALIAS
+        return reads.replica
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != "svcs":
+            return None
+        reads = _request_reads.get()
+        if reads is not None:
+            reads.wrote = True
+        # Never fall back to the database of an instance read from a replica.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ReadYourWritesMiddleware:
+    """
+    Track the reads of each request for ReplicaRouter and pin clients that
+    wrote to the primary for DATABASE_REPLICA_STICKY_SECONDS.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        reads = RequestReads(request)
+        if reads.may_be_pinned():
+            reads.check_pin()
+        token = _request_reads.set(reads)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_reads.reset(token)
+        if reads.needs_pin():
+            reads.pin()
+        return self.process_response(reads, response)
+
+    async def __acall__(self, request):
+        reads = RequestReads(request)
+        if reads.may_be_pinned():
+            await sync_to_async(reads.check_pin)()
+        token = _request_reads.set(reads)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_reads.reset(token)
+        if reads.needs_pin():
+            await sync_to_async(reads.pin)()
+        return self.process_response(reads, response)
+
+    def process_response(self, reads, response):
+        if reads.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PIN_COOKIE_NAME, "1",
+                max_age=settings.DATABASE_REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -0,0 +1,333 @@
+"""
+Placement of virtual machines on compute nodes.
+
+Placement runs in two stages: filters discard compute nodes that cannot fit
+the requested flavor, and weighers rank the remaining ones. Both stages run
+against an in-memory capacity index that is reloaded from the database only
+when it expires or is invalidated, so scheduling does not scan the
+ComputeNode table on every create.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils.module_loading import import_string
+
+from .models import ComputeNode
+
+ALLOCATED_FIELDS = [
+    "allocated_cpu_cores",
+    "allocated_memory_mb",
+    "allocated_disk_gb",
+    "allocated_gpu_count",
+]
+
+
+class NoValidHost(Exception):
+    pass
+
+
+class HostState:
+    """
+    Remaining capacity of a single compute node as seen by the scheduler.
+    """
+
+    def __init__(self, compute_node):
+        self.compute_node = compute_node
+        self.last_scheduled = 0.0
+
+    @property
+    def free_cpu_cores(self):
+        return self.compute_node.cpu_cores - self.compute_node.allocated_cpu_cores
+
+    @property
+    def free_memory_mb(self):
+        return self.compute_node.memory_mb - self.compute_node.allocated_memory_mb
+
+    @property
+    def free_disk_gb(self):
+        return self.compute_node.disk_gb - self.compute_node.allocated_disk_gb
+
+    @property
+    def free_gpu_count(self):
+        return self.compute_node.gpu_count - self.compute_node.allocated_gpu_count
+
+    def consume(self, flavor, count=1):
+        compute_node = self.compute_node
+        compute_node.allocated_cpu_cores += flavor.cpu_cores * count
+        compute_node.allocated_memory_mb += flavor.memory_mb * count
+        compute_node.allocated_disk_gb += flavor.disk_gb * count
+        compute_node.allocated_gpu_count += flavor.gpu_count * count
+        self.last_scheduled = time.monotonic()
+
+    def release(self, flavor, count=1):
+        compute_node = self.compute_node
+        compute_node.allocated_cpu_cores = max(0, compute_node.allocated_cpu_cores - flavor.cpu_cores * count)
+        compute_node.allocated_memory_mb = max(0, compute_node.allocated_memory_mb - flavor.memory_mb * count)
+        compute_node.allocated_disk_gb = max(0, compute_node.allocated_disk_gb - flavor.disk_gb * count)
+        compute_node.allocated_gpu_count = max(0, compute_node.allocated_gpu_count - flavor.gpu_count * count)
+
+    async def refresh(self):
+        await self.compute_node.arefresh_from_db(fields=ALLOCATED_FIELDS)
+
+
+def reserve_capacity(compute_node_id, flavor, count=1):
+    """
+    Allocate `count` VMs of `flavor` on a compute node with a single
+    conditional UPDATE.
+
+    Returns False when the node no longer has room, which happens when
+    another conductor reserved the capacity first. The UPDATE re-checks the
+    room itself, so no transaction or row lock is needed: the scheduler
+    calls this in autocommit, and a reservation that is not followed by its
+    VMs has to be undone with `release_capacity`.
+    """
+    cpu_cores = flavor.cpu_cores * count
+    memory_mb = flavor.memory_mb * count
+    disk_gb = flavor.disk_gb * count
+    gpu_count = flavor.gpu_count * count
+    updated_count = ComputeNode.objects.filter(
+        pk=compute_node_id,
+        cpu_cores__gte=F("allocated_cpu_cores") + cpu_cores,
+        memory_mb__gte=F("allocated_memory_mb") + memory_mb,
+        disk_gb__gte=F("allocated_disk_gb") + disk_gb,
+        gpu_count__gte=F("allocated_gpu_count") + gpu_count,
+    ).update(
+        allocated_cpu_cores=F("allocated_cpu_cores") + cpu_cores,
+        allocated_memory_mb=F("allocated_memory_mb") + memory_mb,
+        allocated_disk_gb=F("allocated_disk_gb") + disk_gb,
+        allocated_gpu_count=F("allocated_gpu_count") + gpu_count,
+    )
+    return updated_count == 1
+
+
+def release_capacity(compute_node_id, flavor, count=1):
+    ComputeNode.objects.filter(pk=compute_node_id).update(
+        allocated_cpu_cores=Greatest(F("allocated_cpu_cores") - flavor.cpu_cores * count, 0),
+        allocated_memory_mb=Greatest(F("allocated_memory_mb") - flavor.memory_mb * count, 0),
+        allocated_disk_gb=Greatest(F("allocated_disk_gb") - flavor.disk_gb * count, 0),
+        allocated_gpu_count=Greatest(F("allocated_gpu_count") - flavor.gpu_count * count, 0),
+    )
+
+
+areserve_capacity = sync_to_async(reserve_capacity)
+arelease_capacity = sync_to_async(release_capacity)
+
+
+class BaseFilter:
+    def host_passes(self, host, flavor):
+        raise NotImplementedError
+
+
+class ComputeFilter(BaseFilter):
+    def host_passes(self, host, flavor):
+        return (
+            host.free_cpu_cores >= flavor.cpu_cores
+            and host.free_memory_mb >= flavor.memory_mb
+        )
+
+
+class DiskFilter(BaseFilter):
+    def host_passes(self, host, flavor):
+        return host.free_disk_gb >= flavor.disk_gb
+
+
+class GpuFilter(BaseFilter):
+    def host_passes(self, host, flavor):
+        if flavor.gpu_count == 0:
+            return True
+        return (
+            host.compute_node.gpu_type == flavor.gpu_type
+            and host.free_gpu_count >= flavor.gpu_count
+        )
+
+
+class BaseWeigher:
+    def weigh(self, host, flavor):
+        raise NotImplementedError
+
+
+class SpreadWeigher(BaseWeigher):
+    """
+    Prefer the compute nodes with the largest share of free capacity.
+    """
+
+    def weigh(self, host, flavor):
+        compute_node = host.compute_node
+        fractions = [
+            host.free_cpu_cores / compute_node.cpu_cores if compute_node.cpu_cores else 0,
+            host.free_memory_mb / compute_node.memory_mb if compute_node.memory_mb else 0,
+            host.free_disk_gb / compute_node.disk_gb if compute_node.disk_gb else 0,
+        ]
+        if compute_node.gpu_count:
+            fractions.append(host.free_gpu_count / compute_node.gpu_count)
+        return sum(fractions) / len(fractions)
+
+
+class BinPackWeigher(SpreadWeigher):
+    """
+    Prefer the most utilised compute nodes so that whole nodes stay free.
+    """
+
+    def weigh(self, host, flavor):
+        return -super().weigh(host, flavor)
+
+
+class LeastRecentlyUsedWeigher(BaseWeigher):
+    """
+    Prefer the compute nodes that were scheduled to least recently.
+    """
+
+    def weigh(self, host, flavor):
+        return -host.last_scheduled
+
+
+class CapacityIndex:
+    """
+    In-memory view of the capacity of every compute node.
+
+    The index is built from one query over ComputeNode, whose allocated_*
+    counters are the source of truth, and is kept up to date by the scheduler
+    as it places and releases VMs. It is reloaded after `ttl` seconds, or
+    immediately after `invalidate()`, to pick up changes made by other
+    conductor replicas.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hosts = None
+        self.loaded_at = 0.0
+
+    def invalidate(self):
+        self.hosts = None
+
+    async def get_hosts(self):
+        if self.hosts is None or time.monotonic() - self.loaded_at > self.ttl:
+            await self.load()
+        return list(self.hosts.values())
+
+    async def load(self):
+        previous_hosts = self.hosts or {}
+        hosts = {}
+        async for compute_node in ComputeNode.objects.order_by("id"):
+            host = HostState(compute_node)
+            if compute_node.id in previous_hosts:
+                host.last_scheduled = previous_hosts[compute_node.id].last_scheduled
+            hosts[compute_node.id] = host
+        self.hosts = hosts
+        self.loaded_at = time.monotonic()
+
+    def get(self, compute_node_id):
+        if self.hosts is None:
+            return None
+        return self.hosts.get(compute_node_id)
+
+
+class Scheduler:
+    def __init__(self, index, filters, weighers):
+        self.index = index
+        self.filters = filters
+        self.weighers = weighers
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            index=CapacityIndex(ttl=settings.SCHEDULER_INDEX_TTL),
+            filters=[import_string(path)() for path in settings.SCHEDULER_FILTERS],
+            weighers=[
+                (import_string(path)(), multiplier)
+                for path, multiplier in settings.SCHEDULER_WEIGHERS.items()
+            ],
+        )
+
+    def filter_hosts(self, hosts, flavor):
+        return [
+            host for host in hosts
+            if all(host_filter.host_passes(host, flavor) for host_filter in self.filters)
+        ]
+
+    def weigh_hosts(self, hosts, flavor):
+        totals = [0.0] * len(hosts)
+        if not hosts:
+            return totals
+        for weigher, multiplier in self.weighers:
+            weights = [weigher.weigh(host, flavor) for host in hosts]
+            lowest, highest = min(weights), max(weights)
+            if highest == lowest:
+                continue
+            for i, weight in enumerate(weights):
+                totals[i] += multiplier * (weight - lowest) / (highest - lowest)
+        return totals
+
+    def plan(self, hosts, flavor, count):
+        """
+        Place `count` VMs on `hosts` in memory, consuming capacity in the index
+        as each one is placed so that later VMs see the earlier placements.
+        """
+        planned = {}
+        for _ in range(count):
+            candidates = self.filter_hosts(hosts, flavor)
+            if not candidates:
+                break
+            totals = self.weigh_hosts(candidates, flavor)
+            host = candidates[max(range(len(candidates)), key=totals.__getitem__)]
+            host.consume(flavor)
+            planned[host] = planned.get(host, 0) + 1
+        return planned
+
+    async def select(self, flavor):
+        """
+        Pick a compute node for `flavor` and reserve its capacity.
+        """
+        return (await self.select_many(flavor, 1))[0]
+
+    async def select_many(self, flavor, count):
+        """
+        Pick compute nodes for `count` VMs of `flavor` and reserve their
+        capacity, with one conditional UPDATE per chosen compute node.
+
+        Placements that lose a race with another conductor are re-planned
+        against the refreshed node; if the VMs cannot all be placed, every
+        reservation made so far is released.
+        """
+        hosts = await self.index.get_hosts()
+        compute_nodes = []
+        while len(compute_nodes) < count:
+            planned = self.plan(hosts, flavor, count - len(compute_nodes))
+            if not planned:
+                for compute_node in set(compute_nodes):
+                    await self.release(
+                        compute_node.id, flavor, compute_nodes.count(compute_node)
+                    )
+                raise NoValidHost(f"No compute node has capacity for flavor {flavor.name}.")
+            for host, host_count in planned.items():
+                if await areserve_capacity(host.compute_node.id, flavor, host_count):
+                    compute_nodes.extend([host.compute_node] * host_count)
+                else:
+                    await host.refresh()
+        return compute_nodes
+
+    async def release(self, compute_node_id, flavor, count=1):
+        await arelease_capacity(compute_node_id, flavor, count)
+        self.released(compute_node_id, flavor, count)
+
+    def released(self, compute_node_id, flavor, count=1):
+        """
+        Return capacity to the index after `release_capacity()` was
+        committed by the caller.
+        """
+        host = self.index.get(compute_node_id)
+        if host is not None:
+            host.release(flavor, count)
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler.from_settings()
+    return _scheduler
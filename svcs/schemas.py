@@ -0,0 +1,135 @@
+"""
+Pydantic models for request payloads, an alternative to the DRF serializers
+for validation only.
+
+Validation runs in pydantic's compiled core instead of DRF's per-field Python
+machinery, which matters for list fields and for the up to 1 MB of
+`user_data`. The models follow the rules of the matching serializer, and
+`validate_payload` reports errors in the serializer's shape, so clients
+cannot tell which backend a view uses. Views opt in per class, see
+`VirtualMachineView.create_schema`.
+"""
+from typing import Annotated
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import URLValidator
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field, StringConstraints, model_validator
+from pydantic import ValidationError
+from pydantic_core import PydanticCustomError
+from rest_framework import serializers
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.settings import api_settings
+
+# CharField trims whitespace and rejects blank strings.
+Name = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=255)]
+UserData = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=1024 * 1024)]
+
+
+def validate_url(value):
+    try:
+        URLValidator()(value)
+    except DjangoValidationError:
+        raise PydanticCustomError("url", "Enter a valid URL.")
+    return value
+
+
+URL = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1), AfterValidator(validate_url)]
+
+
+class VirtualMachineCreate(BaseModel):
+    """
+    The payload of VirtualMachineSerializer.
+    """
+    # CharField accepts numbers as strings, e.g. a name of 42.
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    # Optional fields default to None without accepting an explicit null,
+    # like serializer fields with required=False.
+    environment_name: Name
+    image_name: Name
+    key_names: Annotated[list[Name], Field(min_length=1)]
+    flavor_name: Name
+    name: Name = None
+    user_data: UserData = None
+    callback_url: URL = None
+    assign_floating_ip: bool = False
+    labels: list[Name] = None
+    count: Annotated[int, Field(ge=1, le=256)] = 1
+
+    @model_validator(mode="after")
+    def check_name(self):
+        if self.count > 1 and not self.name:
+            raise PydanticCustomError(
+                "name_required",
+                "A name is required when count is greater than 1.",
+                {"field": "name"},
+            )
+        # get_vm_names appends "-<index>" to the name of every VM.
+        suffix = f"-{self.count}"
+        if self.count > 1 and len(self.name) + len(suffix) > 255:
+            raise PydanticCustomError(
+                "name_too_long",
+                "Ensure this field has no more than {max_length} characters when count is {count}.",
+                {"field": "name", "max_length": 255 - len(suffix), "count": self.count},
+            )
+        return self
+
+
+# DRF's code and wording for the errors the models can raise, by pydantic
+# error type.
+MESSAGES = {
+    "missing": ("required", "This field is required."),
+    "string_type": ("invalid", "Not a valid string."),
+    "string_too_short": ("blank", "This field may not be blank."),
+    "string_too_long": ("max_length", "Ensure this field has no more than {max_length} characters."),
+    "too_short": ("min_length", "Ensure this field has at least {min_length} elements."),
+    "too_long": ("max_length", "Ensure this field has no more than {max_length} elements."),
+    "list_type": ("not_a_list", 'Expected a list of items but got type "{input_type}".'),
+    "int_type": ("invalid", "A valid integer is required."),
+    "int_parsing": ("invalid", "A valid integer is required."),
+    "int_from_float": ("invalid", "A valid integer is required."),
+    "greater_than_equal": ("min_value", "Ensure this value is greater than or equal to {ge}."),
+    "less_than_equal": ("max_value", "Ensure this value is less than or equal to {le}."),
+    "bool_type": ("invalid", "Must be a valid boolean."),
+    "bool_parsing": ("invalid", "Must be a valid boolean."),
+    "model_type": ("invalid", "Invalid data. Expected a dictionary, but got {input_type}."),
+    "model_attributes_type": ("invalid", "Invalid data. Expected a dictionary, but got {input_type}."),
+}
+
+
+def error_detail(error):
+    if error["input"] is None and error["type"] != "missing":
+        return ErrorDetail("This field may not be null.", code="null")
+    if error["type"] not in MESSAGES:
+        return ErrorDetail(error["msg"], code="invalid")
+    code, template = MESSAGES[error["type"]]
+    message = template.format(input_type=type(error["input"]).__name__, **error.get("ctx", {}))
+    return ErrorDetail(message, code=code)
+
+
+def serializer_errors(exc):
+    """
+    Nest the errors of a pydantic ValidationError the way serializer.errors
+    does: `{field: [message]}`, with list items keyed by their index.
+    """
+    errors = {}
+    for error in exc.errors():
+        loc = error["loc"]
+        if not loc:
+            loc = (error.get("ctx", {}).get("field", api_settings.NON_FIELD_ERRORS_KEY),)
+        node = errors
+        for key in loc[:-1]:
+            node = node.setdefault(key, {})
+        node.setdefault(loc[-1], []).append(error_detail(error))
+    return errors
+
+
+def validate_payload(model, data):
+    """
+    Validate `data` against `model` and return it as the serializer's
+    `validated_data`, or raise DRF's ValidationError.
+    """
+    try:
+        return model.model_validate(data).model_dump()
+    except ValidationError as exc:
+        raise serializers.ValidationError(serializer_errors(exc))
@@ -1,18 +1,22 @@
 from adrf.serializers import Serializer
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+from .authentication import aget_primary_group
+from .cache import environments, flavors, images
 from .models import (
-    Flavor,
-    ComputeNode,
     FloatingIP,
-    Image,
-    Environment,
     Key,
     VirtualMachine,
     VMKeyBinding,
     VMLabel,
 )
-from django.shortcuts import aget_object_or_404
+from asgiref.sync import sync_to_async
+from django.db import connections, router, transaction
 from django.db.models import Subquery
+from django.utils import timezone
+from . import messages
+from .outbox import add_outbox_messages
+from .scheduler import NoValidHost, get_scheduler
 
 
 class VirtualMachineSerializer(Serializer):
@@ -29,73 +33,254 @@ class VirtualMachineSerializer(Serializer):
     labels = serializers.ListField(
         child=serializers.CharField(max_length=255), required=False, allow_empty=True
     )
+    count = serializers.IntegerField(min_value=1, max_value=256, default=1)
+
+    def validate(self, data):
+        if data["count"] > 1 and not data.get("name"):
+            raise serializers.ValidationError(
+                {"name": "A name is required when count is greater than 1."}
+            )
+        # get_vm_names appends "-<index>" to the name of every VM.
+        suffix = f"-{data['count']}"
+        if data["count"] > 1 and len(data["name"]) + len(suffix) > 255:
+            raise serializers.ValidationError({"name": (
+                f"Ensure this field has no more than {255 - len(suffix)} characters "
+                f"when count is {data['count']}."
+            )})
+        return data
 
     async def acreate(self, validated_data):
         user = self.context["user"]
-        group = await user.groups.afirst() if await user.groups.aexists() else None
+        group = await aget_primary_group(user)
         if group is None:
             raise serializers.ValidationError(
                 {"error": "User does not belong to any group."}
             )
-        environment = await aget_object_or_404(
-            Environment, name=validated_data["environment_name"], group=group
-        )
-        image = await aget_object_or_404(Image, name=validated_data["image_name"])
-        flavor = await aget_object_or_404(Flavor, name=validated_data["flavor_name"])
-
-        compute_node = await self.select_compute_node()
-
-        vm = await VirtualMachine.objects.acreate(
-            name=validated_data.get("name"),
-            environment=environment,
-            image=image,
-            flavor=flavor,
-            user_data=validated_data.get("user_data"),
-            callback_url=validated_data.get("callback_url"),
-            compute_node=compute_node,
+        environment = await environments.aget(
+            name=validated_data["environment_name"], group_id=group.id
         )
+        image = await images.aget(name=validated_data["image_name"])
+        flavor = await flavors.aget(name=validated_data["flavor_name"])
+        keys = await self.get_keys(environment, validated_data.get("key_names", []))
 
-        try:
-            public_ip = await self.assign_floating_ip_if_requested(
-                vm, validated_data["assign_floating_ip"]
+        count = validated_data["count"]
+        compute_nodes = await self.select_compute_nodes(flavor, count)
+
+        vms = [
+            VirtualMachine(
+                name=name,
+                environment=environment,
+                image=image,
+                flavor=flavor,
+                user_data=validated_data.get("user_data"),
+                callback_url=validated_data.get("callback_url"),
+                compute_node=compute_node,
             )
-            await self.create_vm_key_bindings(vm, validated_data.get("key_names", []))
-            await self.create_vm_labels(vm, validated_data.get("labels", []))
+            for name, compute_node in zip(self.get_vm_names(validated_data), compute_nodes)
+        ]
+
+        try:
+            return await sync_to_async(self.save_vms)(vms, keys, validated_data)
         except Exception as e:
-            await vm.adelete()
+            for compute_node in set(compute_nodes):
+                await get_scheduler().release(
+                    compute_node.id, flavor, compute_nodes.count(compute_node)
+                )
             raise e
 
-        return vm, public_ip
+    def save_vms(self, vms, keys, validated_data):
+        """
+        Write the VMs, their floating IPs, keys and labels together with the
+        start messages for their compute nodes in a single transaction.
+        """
+        db = router.db_for_write(VirtualMachine)
+        labels = validated_data.get("labels")
+        with transaction.atomic(using=db):
+            if connections[db].vendor == "postgresql":
+                created = self.insert_vms(db, vms, keys, validated_data)
+            else:
+                created_vms = VirtualMachine.objects.bulk_create(vms)
+                public_ips = self.assign_floating_ips_if_requested(
+                    created_vms, validated_data["assign_floating_ip"]
+                )
+                self.create_vm_key_bindings(created_vms, keys)
+                self.create_vm_labels(created_vms, labels or [])
+                created = list(zip(created_vms, public_ips))
+            add_outbox_messages(
+                [
+                    (f"q.{vm.compute_node.name}", messages.start_vm(vm, public_ip, labels))
+                    for vm, public_ip in created
+                ]
+            )
+        return created
 
-    async def assign_floating_ip_if_requested(self, vm, assign_floating_ip):
+    def insert_vms(self, db, vms, keys, validated_data):
+        """
+        Insert the VMs, claim their floating IPs and write their key bindings
+        and labels in a single statement, returning `(vm, public_ip)` pairs.
+
+        The VMs share everything but their names and compute nodes, so the
+        statement takes one array of each and `vms` are updated in place.
+        Free floating IPs are locked with FOR UPDATE SKIP LOCKED, so that
+        concurrent creates claim different rows instead of queueing on the
+        lowest one.
+        """
+        quote_name = connections[db].ops.quote_name
+        now = timezone.now()
+        vm_count = len(vms) if validated_data["assign_floating_ip"] else 0
+        with connections[db].cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH new_vms AS (
+                    INSERT INTO {quote_name(VirtualMachine._meta.db_table)} (
+                        name, state, environment_id, image_id, flavor_id, user_data,
+                        callback_url, compute_node_id, created_at, updated_at
+                    )
+                    SELECT t.name, %(state)s, %(environment)s, %(image)s, %(flavor)s,
+                        %(user_data)s, %(callback_url)s, t.compute_node_id, %(now)s, %(now)s
+                    FROM unnest(%(names)s::varchar[], %(compute_nodes)s::bigint[])
+                        WITH ORDINALITY AS t(name, compute_node_id, n)
+                    ORDER BY t.n
+                    RETURNING id, name
+                ), free AS (
+                    SELECT id FROM {quote_name(FloatingIP._meta.db_table)}
+                    WHERE virtual_machine_id IS NULL
+                    ORDER BY id
+                    LIMIT %(vm_count)s
+                    FOR UPDATE SKIP LOCKED
+                ), claimed AS (
+                    UPDATE {quote_name(FloatingIP._meta.db_table)} AS floating_ip
+                    SET virtual_machine_id = numbered_vms.vm_id, updated_at = %(now)s
+                    FROM (
+                        SELECT id AS ip_id, row_number() OVER (ORDER BY id) AS n FROM free
+                    ) AS numbered_free
+                    JOIN (
+                        SELECT id AS vm_id, row_number() OVER (ORDER BY id) AS n FROM new_vms
+                    ) AS numbered_vms USING (n)
+                    WHERE floating_ip.id = numbered_free.ip_id
+                    RETURNING floating_ip.virtual_machine_id, floating_ip.ip_address
+                ), key_bindings AS (
+                    INSERT INTO {quote_name(VMKeyBinding._meta.db_table)} (
+                        virtual_machine_id, key_id, created_at, updated_at
+                    )
+                    SELECT new_vms.id, k.key_id, %(now)s, %(now)s
+                    FROM new_vms CROSS JOIN unnest(%(keys)s::bigint[]) AS k(key_id)
+                ), labels AS (
+                    INSERT INTO {quote_name(VMLabel._meta.db_table)} (
+                        name, virtual_machine_id, created_at, updated_at
+                    )
+                    SELECT l.name, new_vms.id, %(now)s, %(now)s
+                    FROM new_vms CROSS JOIN unnest(%(labels)s::varchar[]) AS l(name)
+                )
+                SELECT new_vms.id, new_vms.name, claimed.ip_address
+                FROM new_vms LEFT JOIN claimed ON claimed.virtual_machine_id = new_vms.id
+                """,
+                {
+                    "state": vms[0].state,
+                    "environment": vms[0].environment_id,
+                    "image": vms[0].image_id,
+                    "flavor": vms[0].flavor_id,
+                    "user_data": vms[0].user_data,
+                    "callback_url": vms[0].callback_url,
+                    "now": now,
+                    "names": [vm.name for vm in vms],
+                    "compute_nodes": [vm.compute_node_id for vm in vms],
+                    "vm_count": vm_count,
+                    "keys": [key.id for key in keys],
+                    "labels": list(dict.fromkeys(validated_data.get("labels") or [])),
+                },
+            )
+            rows = {name: (vm_id, public_ip) for vm_id, name, public_ip in cursor.fetchall()}
+        if sum(public_ip is not None for _, public_ip in rows.values()) < vm_count:
+            raise serializers.ValidationError(
+                {"error": "No unused floating IPs are available."}
+            )
+        created = []
+        for vm in vms:
+            vm.id, public_ip = rows[vm.name]
+            vm.created_at = vm.updated_at = now
+            vm._state.adding = False
+            vm._state.db = db
+            created.append((vm, public_ip))
+        return created
+
+    def get_vm_names(self, validated_data):
+        name = validated_data.get("name")
+        count = validated_data["count"]
+        if count == 1:
+            return [name]
+        return [f"{name}-{i}" for i in range(1, count + 1)]
+
+    def assign_floating_ips_if_requested(self, vms, assign_floating_ip):
         if not assign_floating_ip:
-            return None
+            return [None] * len(vms)
+        return [self.claim_floating_ip(vm) for vm in vms]
+
+    def claim_floating_ip(self, vm):
         available_ip_subquery = (
             FloatingIP.objects.filter(virtual_machine__isnull=True)
             .order_by("id")
             .values("id")[:1]
         )
-        updated_count = await FloatingIP.objects.filter(
+        updated_count = FloatingIP.objects.filter(
             id=Subquery(available_ip_subquery)
-        ).aupdate(virtual_machine=vm)
+        ).update(virtual_machine=vm)
         if updated_count == 0:
             raise serializers.ValidationError(
                 {"error": "No unused floating IPs are available."}
             )
-        floating_ip = await aget_object_or_404(FloatingIP, virtual_machine=vm)
-        return floating_ip.ip_address
-
-    async def create_vm_key_bindings(self, vm, key_names):
-        for key_name in key_names:
-            key = await aget_object_or_404(Key, environment=vm.environment, name=key_name)
-            await VMKeyBinding.objects.acreate(virtual_machine=vm, key=key)
-
-    async def create_vm_labels(self, vm, labels):
-        for label in labels:
-            await VMLabel.objects.acreate(virtual_machine=vm, name=label)
-
-    async def select_compute_node(self):
-        # TODO: Implement a scheduling algorithm to select the best compute node
-        # For now, just select a random compute node
-        compute_node = await ComputeNode.objects.order_by("?")[:1].afirst()
-        return compute_node
+        return FloatingIP.objects.get(virtual_machine=vm).ip_address
+
+    async def get_keys(self, environment, key_names):
+        key_names = list(dict.fromkeys(key_names))
+        keys = {
+            key.name: key
+            async for key in Key.objects.filter(environment=environment, name__in=key_names)
+        }
+        missing_key_names = [key_name for key_name in key_names if key_name not in keys]
+        if missing_key_names:
+            raise NotFound(
+                {"error": f"Keys not found: {', '.join(missing_key_names)}."}
+            )
+        return list(keys.values())
+
+    def create_vm_key_bindings(self, vms, keys):
+        VMKeyBinding.objects.bulk_create(
+            [VMKeyBinding(virtual_machine=vm, key=key) for vm in vms for key in keys]
+        )
+
+    def create_vm_labels(self, vms, labels):
+        VMLabel.objects.bulk_create(
+            [
+                VMLabel(virtual_machine=vm, name=label)
+                for vm in vms
+                for label in dict.fromkeys(labels)
+            ]
+        )
+
+    async def select_compute_nodes(self, flavor, count):
+        try:
+            return await get_scheduler().select_many(flavor, count)
+        except NoValidHost as e:
+            raise serializers.ValidationError({"error": str(e)})
+
+
+class VirtualMachineStateSerializer(Serializer):
+    id = serializers.IntegerField()
+    hypervisor_id = serializers.CharField(max_length=255, required=False, allow_null=True)
+    state = serializers.ChoiceField(choices=VirtualMachine.STATE_CHOICES + [('deleted', 'DELETED')])
+
+
+class VirtualMachineBulkDeleteSerializer(Serializer):
+    environment_name = serializers.CharField(max_length=255)
+    label = serializers.CharField(max_length=255, required=False)
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), min_length=1, max_length=1000, required=False
+    )
+
+    def validate(self, data):
+        if ("label" in data) == ("ids" in data):
+            raise serializers.ValidationError(
+                {"error": "Exactly one of label and ids is required."}
+            )
+        return data
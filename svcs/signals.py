@@ -0,0 +1,48 @@
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .cache import broadcast_invalidation, catalog_caches, clear_cached
+from .models import ComputeNode
+from .scheduler import get_scheduler
+
+
+@receiver([post_save, post_delete], sender=ComputeNode)
+def invalidate_capacity_index(sender, **kwargs):
+    get_scheduler().index.invalidate()
+
+
+def invalidate_on_commit(model_label, using):
+    # Clearing only before the commit would let this or another process, or
+    # a read from a replica, cache the old row again for the whole TTL, so
+    # the caches are cleared and the broadcast sent once the change is
+    # committed. Clearing this process's caches right away as well keeps it
+    # from serving the old row to the transaction that changed it.
+    clear_cached(model_label)
+    transaction.on_commit(partial(broadcast_invalidation, model_label), using=using)
+
+
+def invalidate_catalog_cache(sender, using, **kwargs):
+    invalidate_on_commit(sender._meta.label_lower, using)
+
+
+for catalog_cache in catalog_caches.values():
+    post_save.connect(invalidate_catalog_cache, sender=catalog_cache.model)
+    post_delete.connect(invalidate_catalog_cache, sender=catalog_cache.model)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, using, **kwargs):
+    # Cached by their secret key, so every replica drops all of them rather
+    # than the key being broadcast.
+    invalidate_on_commit(Token._meta.label_lower, using)
+
+
+@receiver(post_save, sender=User)
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_cached_tokens(sender, using, **kwargs):
+    invalidate_on_commit(User._meta.label_lower, using)
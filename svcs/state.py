@@ -0,0 +1,88 @@
+"""
+Application of VM state reports sent by compute nodes.
+
+Reports are applied in bulk: the VMs are read in one query, written back in
+one UPDATE, the floating IPs of every VM that failed are released in
+another, and VMs reported deleted are removed in a single DELETE, so a burst
+of reports costs a fixed number of statements instead of a few per VM. The
+statements run in a single transaction.
+"""
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.db import router, transaction
+from django.utils import timezone
+
+from .models import FloatingIP, VirtualMachine
+from .scheduler import get_scheduler, release_capacity
+from .webhooks import add_webhooks
+
+
+async def apply_state_reports(reports):
+    """
+    Apply `reports`, a list of `{id, hypervisor_id, state}` dicts.
+
+    A state of "deleted" means the VM is gone from its hypervisor, and the VM
+    is removed. When a VM is reported more than once, the last report wins.
+    Returns the list of updated or deleted VMs and the list of reported ids
+    that do not exist.
+    """
+    latest = {report["id"]: report for report in reports}
+    vms, released = await sync_to_async(save_state_reports)(latest)
+    scheduler = get_scheduler()
+    for (compute_node_id, flavor), count in released.items():
+        scheduler.released(compute_node_id, flavor, count)
+
+    found_ids = {vm.id for vm in vms}
+    return vms, [vm_id for vm_id in latest if vm_id not in found_ids]
+
+
+def save_state_reports(latest):
+    """
+    Write the reports in `latest`, keyed by VM id, in one transaction, so the
+    VM states, their floating IPs, the capacity of their compute nodes and
+    their webhooks are committed together or not at all.
+
+    Returns the VMs and a Counter of the capacity released per
+    `(compute_node_id, flavor)`.
+    """
+    with transaction.atomic(using=router.db_for_write(VirtualMachine)):
+        # Locking the rows keeps a concurrent report for the same VM from
+        # releasing its capacity a second time.
+        vms = list(
+            VirtualMachine.objects.select_related("flavor").select_for_update(of=("self",)).filter(
+                pk__in=list(latest)
+            )
+        )
+
+        now = timezone.now()
+        released = Counter()
+        updated_vms = []
+        deleted_vms = []
+        for vm in vms:
+            report = latest[vm.id]
+            if report["state"] in ("failed", "deleted") and vm.state != "failed" and vm.compute_node_id is not None:
+                released[(vm.compute_node_id, vm.flavor)] += 1
+            if report["state"] == "deleted":
+                deleted_vms.append(vm)
+                continue
+            if report.get("hypervisor_id") is not None:
+                vm.hypervisor_id = report["hypervisor_id"]
+            vm.state = report["state"]
+            vm.updated_at = now
+            updated_vms.append(vm)
+        VirtualMachine.objects.bulk_update(updated_vms, ["hypervisor_id", "state", "updated_at"])
+        if deleted_vms:
+            VirtualMachine.objects.filter(pk__in=[vm.id for vm in deleted_vms]).delete()
+
+        failed_ids = [vm.id for vm in updated_vms if vm.state == "failed"]
+        if failed_ids:
+            FloatingIP.objects.filter(virtual_machine_id__in=failed_ids).update(
+                virtual_machine=None, updated_at=now
+            )
+        for (compute_node_id, flavor), count in released.items():
+            release_capacity(compute_node_id, flavor, count)
+
+        add_webhooks(updated_vms)
+        add_webhooks(deleted_vms, state="deleted")
+    return vms, released
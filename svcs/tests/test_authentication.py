@@ -0,0 +1,92 @@
+import asyncio
+import json
+from unittest.mock import patch, AsyncMock, MagicMock, Mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User, Group
+from django.test import TestCase
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+
+from svcs import cache
+from svcs.authentication import CachedTokenAuthentication, aget_primary_group, token_cache
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user")
+        self.group = Group.objects.create(name="TestGroup")
+        self.user.groups.add(self.group)
+        self.token = Token.objects.create(user=self.user, key="test_token")
+        self.authentication = CachedTokenAuthentication()
+
+    def make_request(self, authorization):
+        return Mock(META={"HTTP_AUTHORIZATION": authorization})
+
+    def delete_and_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+
+    async def test_authenticate(self):
+        user, token = await self.authentication.authenticate(self.make_request("Token test_token"))
+        self.assertEqual(user, self.user)
+        self.assertEqual(token, self.token)
+        self.assertEqual(user.primary_group, self.group)
+
+    async def test_authenticate_is_cached(self):
+        request = self.make_request("Token test_token")
+        first_user, _ = await self.authentication.authenticate(request)
+        with patch.object(Token.objects, "select_related") as mock_select_related:
+            user, _ = await self.authentication.authenticate(request)
+        mock_select_related.assert_not_called()
+        self.assertIs(user, first_user)
+        self.assertEqual(await aget_primary_group(user), self.group)
+
+    async def test_authenticate_invalid_token(self):
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            await self.authentication.authenticate(self.make_request("Token wrong_token"))
+
+    async def test_authenticate_other_scheme(self):
+        self.assertIsNone(await self.authentication.authenticate(self.make_request("Bearer test_token")))
+
+    async def test_token_delete_invalidates_cache(self):
+        request = self.make_request("Token test_token")
+        await self.authentication.authenticate(request)
+        self.assertIsNotNone(token_cache.get("test_token"))
+        await self.token.adelete()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            await self.authentication.authenticate(request)
+
+    async def test_token_delete_is_broadcast(self):
+        mock_broker = MagicMock()
+        mock_broker.subscribe = AsyncMock()
+        mock_broker.broadcast = AsyncMock()
+        await cache.subscribe_invalidations(mock_broker)
+        try:
+            await sync_to_async(self.delete_and_commit)()
+            await asyncio.sleep(0)
+        finally:
+            cache.unsubscribe_invalidations()
+        mock_broker.broadcast.assert_called_once_with(
+            "x.catalog_invalidation", json.dumps({"model": "authtoken.token"}).encode()
+        )
+
+    async def test_invalidation_message_clears_cache(self):
+        await self.authentication.authenticate(self.make_request("Token test_token"))
+        for model_label in ["authtoken.token", "auth.user"]:
+            with self.subTest(model_label=model_label):
+                token_cache.set("test_token", (self.user, self.token))
+                message = MagicMock(body=json.dumps({"model": model_label}).encode())
+                await cache.on_invalidation_message(message)
+                self.assertIsNone(token_cache.get("test_token"))
+
+    async def test_inactive_user(self):
+        self.user.is_active = False
+        await self.user.asave()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            await self.authentication.authenticate(self.make_request("Token test_token"))
+
+    async def test_user_without_group(self):
+        await self.user.groups.aclear()
+        user, _ = await self.authentication.authenticate(self.make_request("Token test_token"))
+        self.assertIsNone(user.primary_group)
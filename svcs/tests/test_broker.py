@@ -0,0 +1,158 @@
+import asyncio
+import os
+import unittest
+from unittest.mock import patch, AsyncMock, MagicMock
+
+import aio_pika
+from django.test import TestCase
+
+from svcs.broker import Broker, get_broker, close_broker
+from svcs.models import ComputeNode
+
+
+def mock_connection(mock_connect_robust):
+    mock_connect_robust.return_value.reconnect_callbacks = MagicMock()
+    mock_channel = AsyncMock()
+    mock_channel.is_closed = False
+    mock_connect_robust.return_value.channel.return_value = mock_channel
+    return mock_channel
+
+
+class BrokerTests(unittest.IsolatedAsyncioTestCase):
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_channels_are_reused(self, mock_connect_robust):
+        mock_channel = mock_connection(mock_connect_robust)
+        broker = Broker(host="test.rabbitmq.host")
+        for _ in range(3):
+            async with broker.acquire() as broker_channel:
+                self.assertIs(broker_channel.channel, mock_channel)
+        mock_connect_robust.assert_called_once_with(host="test.rabbitmq.host", port=5672)
+        mock_connect_robust.return_value.channel.assert_called_once()
+        mock_channel.declare_exchange.assert_called_once()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_channel_pool_is_bounded(self, mock_connect_robust):
+        mock_connect_robust.return_value.reconnect_callbacks = MagicMock()
+        mock_connect_robust.return_value.channel.side_effect = lambda **kwargs: AsyncMock(is_closed=False)
+        broker = Broker(host="test.rabbitmq.host", max_channels=2)
+        leases = []
+
+        async def lease():
+            async with broker.acquire() as broker_channel:
+                leases.append(broker_channel)
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*[lease() for _ in range(5)])
+        self.assertEqual(len(leases), 5)
+        self.assertEqual(len({id(broker_channel) for broker_channel in leases}), 2)
+        self.assertEqual(mock_connect_robust.return_value.channel.call_count, 2)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_closed_channel_is_reopened(self, mock_connect_robust):
+        mock_channel = mock_connection(mock_connect_robust)
+        broker = Broker(host="test.rabbitmq.host")
+        async with broker.acquire():
+            pass
+        mock_channel.is_closed = True
+        async with broker.acquire():
+            pass
+        self.assertEqual(mock_connect_robust.return_value.channel.call_count, 2)
+        mock_connect_robust.assert_called_once()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_queue_is_declared_once(self, mock_connect_robust):
+        mock_channel = mock_connection(mock_connect_robust)
+        broker = Broker(host="test.rabbitmq.host")
+        await broker.publish("q.compute-1", b"{}")
+        await broker.publish("q.compute-1", b"{}")
+        await broker.publish("q.compute-2", b"{}")
+        self.assertEqual(mock_channel.declare_queue.call_count, 2)
+        self.assertEqual(mock_channel.declare_exchange.return_value.publish.call_count, 3)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_reconnect_invalidates_topology(self, mock_connect_robust):
+        mock_channel = mock_connection(mock_connect_robust)
+        broker = Broker(host="test.rabbitmq.host")
+        await broker.publish("q.compute-1", b"{}")
+        mock_connect_robust.return_value.reconnect_callbacks.add.assert_called_once_with(
+            broker.topology.invalidate
+        )
+        broker.topology.invalidate(mock_connect_robust.return_value)
+        await broker.publish("q.compute-1", b"{}")
+        self.assertEqual(mock_channel.declare_queue.call_count, 2)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_channels_confirm_publishes(self, mock_connect_robust):
+        mock_connection(mock_connect_robust)
+        broker = Broker(host="test.rabbitmq.host")
+        await broker.publish("q.compute-1", b"{}")
+        mock_connect_robust.return_value.channel.assert_called_once_with(
+            publisher_confirms=True, on_return_raises=True
+        )
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_publish_batch_reports_each_message(self, mock_connect_robust):
+        mock_channel = mock_connection(mock_connect_robust)
+        error = aio_pika.exceptions.DeliveryError(None, None)
+        mock_channel.declare_exchange.return_value.publish.side_effect = [None, error, None]
+        broker = Broker(host="test.rabbitmq.host")
+        results = await broker.publish_batch("q.compute-1", [b"1", b"2", b"3"])
+        self.assertEqual(results, [None, error, None])
+
+        mock_channel.declare_exchange.return_value.publish.side_effect = error
+        with self.assertRaises(aio_pika.exceptions.DeliveryError):
+            await broker.publish("q.compute-1", b"{}")
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_publish_window_is_bounded(self, mock_connect_robust):
+        mock_channel = mock_connection(mock_connect_robust)
+        in_flight = 0
+        max_in_flight = 0
+
+        async def publish(message, routing_key, timeout):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+
+        mock_channel.declare_exchange.return_value.publish.side_effect = publish
+        broker = Broker(host="test.rabbitmq.host", publish_window=3)
+        results = await broker.publish_batch("q.compute-1", [b"{}"] * 10)
+        self.assertEqual(results, [None] * 10)
+        self.assertEqual(max_in_flight, 3)
+
+    @patch.dict(os.environ, {"RABBITMQ_HOST": "test.rabbitmq.host", "RABBITMQ_PORT": "5673"})
+    async def test_get_broker_is_per_event_loop(self):
+        broker = get_broker()
+        self.assertIs(get_broker(), broker)
+        self.assertEqual(broker.port, 5673)
+        await close_broker()
+        self.assertIsNot(get_broker(), broker)
+        await close_broker()
+
+    @patch.dict(os.environ, {"RABBITMQ_HOST": ""})
+    async def test_get_broker_without_host(self):
+        with self.assertRaises(ValueError):
+            get_broker()
+
+
+class BrokerStartTests(TestCase):
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_start_declares_compute_node_queues(self, mock_connect_robust):
+        for name in ["compute-1", "compute-2"]:
+            await ComputeNode.objects.acreate(
+                name=name, cpu_cores=2, memory_mb=2048, disk_gb=20, gpu_type="TestGPU", gpu_count=1
+            )
+        mock_channel = mock_connection(mock_connect_robust)
+        broker = Broker(host="test.rabbitmq.host")
+        await broker.start()
+        self.assertEqual(broker.topology.declared, {"q.compute-1", "q.compute-2"})
+        await broker.publish("q.compute-2", b"{}")
+        self.assertEqual(mock_channel.declare_queue.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from django.test import TestCase
+
+from svcs import cache
+from svcs.cache import CatalogCache, TTLCache, flavors, subscribe_invalidations, unsubscribe_invalidations
+from svcs.models import Flavor
+
+
+class TTLCacheTests(TestCase):
+
+    def test_entries_expire(self):
+        entries = TTLCache(maxsize=10, ttl=60)
+        entries.set("a", 1)
+        self.assertEqual(entries.get("a"), 1)
+        with patch("svcs.cache.time.monotonic", return_value=10 ** 9):
+            self.assertIsNone(entries.get("a"))
+        self.assertEqual(len(entries), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        entries = TTLCache(maxsize=2, ttl=60)
+        entries.set("a", 1)
+        entries.set("b", 2)
+        entries.get("a")
+        entries.set("c", 3)
+        self.assertEqual(entries.get("a"), 1)
+        self.assertIsNone(entries.get("b"))
+        self.assertEqual(entries.get("c"), 3)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        self.flavor = Flavor.objects.create(
+            name="TestFlavor", cpu_cores=2, memory_mb=2048, disk_gb=20, gpu_type="TestGPU", gpu_count=1
+        )
+
+    def save_and_commit(self, execute=True):
+        # on_commit callbacks belong to the connection of the thread that saves.
+        with self.captureOnCommitCallbacks(execute=execute) as callbacks:
+            self.flavor.save()
+        return callbacks
+
+    async def test_lookup_is_cached(self):
+        catalog = CatalogCache(Flavor)
+        with patch("svcs.cache.aget_object_or_404", new_callable=AsyncMock, return_value=self.flavor) as mock_get:
+            self.assertEqual(await catalog.aget(name="TestFlavor"), self.flavor)
+            self.assertEqual(await catalog.aget(name="TestFlavor"), self.flavor)
+        mock_get.assert_called_once()
+        self.assertEqual(mock_get.call_args.args[0].model, Flavor)
+        self.assertEqual(mock_get.call_args.kwargs, {"name": "TestFlavor"})
+
+    async def test_missing_lookup_raises_404(self):
+        catalog = CatalogCache(Flavor)
+        with self.assertRaises(Http404):
+            await catalog.aget(name="MissingFlavor")
+
+    async def test_save_clears_cache(self):
+        self.assertEqual((await flavors.aget(name="TestFlavor")).cpu_cores, 2)
+        self.flavor.cpu_cores = 4
+        await self.flavor.asave()
+        self.assertEqual((await flavors.aget(name="TestFlavor")).cpu_cores, 4)
+
+    async def test_delete_clears_cache(self):
+        await flavors.aget(name="TestFlavor")
+        await self.flavor.adelete()
+        with self.assertRaises(Http404):
+            await flavors.aget(name="TestFlavor")
+
+    async def test_save_broadcasts_invalidation(self):
+        mock_broker = MagicMock()
+        mock_broker.subscribe = AsyncMock()
+        mock_broker.broadcast = AsyncMock()
+        await subscribe_invalidations(mock_broker)
+        try:
+            self.flavor.cpu_cores = 4
+            await sync_to_async(self.save_and_commit)()
+            await asyncio.sleep(0)
+        finally:
+            unsubscribe_invalidations()
+        mock_broker.broadcast.assert_called_once_with(
+            "x.catalog_invalidation", json.dumps({"model": "svcs.flavor"}).encode()
+        )
+
+    async def test_rolled_back_save_is_not_broadcast(self):
+        mock_broker = MagicMock()
+        mock_broker.subscribe = AsyncMock()
+        mock_broker.broadcast = AsyncMock()
+        await subscribe_invalidations(mock_broker)
+        try:
+            self.flavor.cpu_cores = 4
+            # The test's transaction is rolled back without running them.
+            callbacks = await sync_to_async(self.save_and_commit)(execute=False)
+            await asyncio.sleep(0)
+        finally:
+            unsubscribe_invalidations()
+        self.assertEqual(len(callbacks), 1)
+        mock_broker.broadcast.assert_not_called()
+
+    async def test_failed_broadcast_is_logged(self):
+        await flavors.aget(name="TestFlavor")
+        mock_broker = MagicMock()
+        mock_broker.subscribe = AsyncMock()
+        mock_broker.broadcast = AsyncMock(side_effect=ConnectionError("broker down"))
+        await subscribe_invalidations(mock_broker)
+        try:
+            with self.assertLogs("svcs.cache", "ERROR") as logs:
+                self.flavor.cpu_cores = 4
+                await sync_to_async(self.save_and_commit)()
+                for _ in range(3):
+                    await asyncio.sleep(0)
+        finally:
+            unsubscribe_invalidations()
+        self.assertIn("svcs.flavor", logs.output[0])
+        self.assertEqual(len(flavors.entries), 0)
+
+    async def test_invalidation_message_clears_cache(self):
+        await flavors.aget(name="TestFlavor")
+        await Flavor.objects.filter(pk=self.flavor.pk).aupdate(cpu_cores=8)
+        self.assertEqual((await flavors.aget(name="TestFlavor")).cpu_cores, 2)
+        message = MagicMock(body=json.dumps({"model": "svcs.flavor"}).encode())
+        await cache.on_invalidation_message(message)
+        self.assertEqual((await flavors.aget(name="TestFlavor")).cpu_cores, 8)
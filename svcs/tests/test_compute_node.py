@@ -1,9 +1,10 @@
+import json
 import os
 import unittest
 from unittest.mock import patch, MagicMock, Mock
 from django.core.management import call_command
 from django.urls import reverse
-from svcs.management.commands.compute_node import Command
+from svcs.management.commands.compute_node import Command, StateReportBatcher
 from io import StringIO
 
 @patch.dict(os.environ, {
@@ -22,24 +23,25 @@ class ComputeNodeCommandTests(unittest.TestCase):
         self.assertEqual(command.conductor_api_url, 'http://test.conductor.api')
         self.assertEqual(command.rabbitmq_host, 'test.rabbitmq.host')
 
-    @patch('sys.stdout', new_callable=StringIO)
-    @patch('requests.patch')
-    def test_virtual_machine_update_state_success(self, mock_patch, mock_stdout):
+    def test_session(self):
         command = Command()
-        mock_patch.return_value.status_code = 200
-        command.virtual_machine_update_state('vm1', 'hypervisor_id', 'started')
-        mock_patch.assert_called_once()
-        output = mock_stdout.getvalue()
-        self.assertIn('Successfully notified conductor about state change for VM vm1', output)
+        self.assertEqual(command.session.headers['Authorization'], 'Token test_token')
+        retry = command.session.get_adapter('http://test.conductor.api').max_retries
+        self.assertEqual(retry.total, 10)
+        self.assertIn(503, retry.status_forcelist)
+        self.assertIn('POST', retry.allowed_methods)
+        self.assertIn('DELETE', retry.allowed_methods)
+        self.assertGreater(retry.backoff_jitter, 0)
 
     @patch('sys.stdout', new_callable=StringIO)
-    @patch('requests.patch')
-    def test_virtual_machine_update_state_failure(self, mock_patch, mock_stdout):
+    @patch('requests.Session.delete')
+    def test_virtual_machine_delete_already_deleted(self, mock_delete, mock_stdout):
         command = Command()
-        mock_patch.return_value.status_code = 400
+        mock_delete.return_value.status_code = 404
+        command.virtual_machine_delete(1)
+        mock_delete.return_value.status_code = 500
         with self.assertRaises(Exception):
-            command.virtual_machine_update_state('vm1', 'hypervisor_id', 'started')
-        output = mock_stdout.getvalue()
+            command.virtual_machine_delete(1)
 
     @patch('sys.stdout', new_callable=StringIO)
     @patch('pika.BlockingConnection')
@@ -48,16 +50,263 @@ class ComputeNodeCommandTests(unittest.TestCase):
         mock_channel = MagicMock()
         mock_blocking_connection.return_value.channel.return_value = mock_channel
         mock_channel.basic_consume.side_effect = lambda queue, on_message_callback, auto_ack: on_message_callback(
-            ch=mock_channel, method=Mock(), properties=Mock(), body=b'{"id": "vm1", "state": "started"}'
+            ch=mock_channel, method=Mock(), properties=Mock(content_type=None), body=b'{"id": "vm1", "state": "started"}'
         )
-        with patch.object(command, 'virtual_machine_update_state') as mock_update_state:
+        with patch.object(command, 'publish_state_events') as mock_publish_state_events:
             command.handle()
             mock_channel.basic_consume.assert_called()
             mock_channel.start_consuming.assert_called()
         output = mock_stdout.getvalue()
         self.assertIn('Starting RabbitMQ listener on compute node test_node...', output)
-        self.assertIn('test_node: received b\'{"id": "vm1", "state": "started"}\' with routing key', output)
+        self.assertIn('test_node: received 33 bytes of application/json with routing key', output)
         self.assertIn('Waiting for messages. To exit press CTRL+C', output)
 
+    @patch.dict(os.environ, {'COMPUTE_NODE_REPORT_TRANSPORT': 'http'})
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_acks_from_connection_thread(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        mock_connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        bodies = [
+            b'{"id": "vm1", "state": "deleted", "hypervisor_id": "hv1"}',
+            b'{"id": "vm2", "state": "unknown"}',
+        ]
+
+        def consume(queue, on_message_callback, auto_ack):
+            for delivery_tag, body in enumerate(bodies, start=1):
+                on_message_callback(
+                    ch=mock_channel, method=Mock(delivery_tag=delivery_tag), properties=Mock(content_type=None), body=body
+                )
+
+        mock_channel.basic_consume.side_effect = consume
+        command.client = MagicMock()
+        with patch.object(command, 'virtual_machine_delete'), \
+                patch.object(command, 'virtual_machine_update_states') as mock_update_states:
+            command.handle()
+        mock_channel.basic_qos.assert_called_once_with(prefetch_count=command.workers)
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        mock_channel.basic_nack.assert_called_once_with(delivery_tag=2, requeue=False)
+        mock_update_states.assert_called_once_with([{'id': 'vm2', 'hypervisor_id': None, 'state': 'failed'}])
+        mock_connection.close.assert_called_once()
+
+    @patch.dict(os.environ, {'COMPUTE_NODE_REPORT_RETRY_DELAY': '0'})
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_retries_failure_report(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        mock_connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        mock_channel.basic_consume.side_effect = lambda queue, on_message_callback, auto_ack: on_message_callback(
+            ch=mock_channel, method=Mock(delivery_tag=1), properties=Mock(content_type=None), body=b'{"id": "vm1", "state": "unknown"}'
+        )
+        with patch.object(
+            command, 'publish_state_events', side_effect=[Exception('conductor down'), None]
+        ) as mock_publish_state_events:
+            command.handle()
+        self.assertEqual(mock_publish_state_events.call_count, 2)
+        mock_channel.basic_nack.assert_called_once_with(delivery_tag=1, requeue=False)
+        self.assertIn('Failed to report the failure of VM vm1, retrying in 0s: conductor down', mock_stdout.getvalue())
+
+    @patch.dict(os.environ, {'COMPUTE_NODE_REPORT_RETRY_DELAY': '0'})
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_never_reports_created_vm_as_failed(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        mock_connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        body = json.dumps({
+            'id': 1, 'name': 'vm', 'state': 'started', 'cpu_cores': 1, 'memory_mb': 1024,
+            'disk_gb': 10, 'public_ip': None, 'labels': [], 'version': 1,
+        }).encode()
+        mock_channel.basic_consume.side_effect = lambda queue, on_message_callback, auto_ack: on_message_callback(
+            ch=mock_channel, method=Mock(delivery_tag=1), properties=Mock(content_type=None), body=body
+        )
+        command.client = MagicMock()
+        command.client.create_vm.return_value.id = 'hv1'
+        reports = []
+
+        def publish_state_events(batch):
+            if len(reports) < 3:
+                reports.append(None)
+                raise Exception('conductor down')
+            reports.extend(batch)
+
+        with patch.object(command, 'publish_state_events', side_effect=publish_state_events):
+            command.handle()
+        self.assertEqual(reports[3:], [{'id': 1, 'hypervisor_id': 'hv1', 'state': 'started'}])
+        command.client.create_vm.assert_called_once()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_starts_redelivered_vm_once(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        mock_connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        body = json.dumps({
+            'id': 1, 'name': 'vm', 'state': 'started', 'cpu_cores': 1, 'memory_mb': 1024,
+            'disk_gb': 10, 'public_ip': None, 'labels': [], 'version': 1,
+        }).encode()
+
+        def consume(queue, on_message_callback, auto_ack):
+            for delivery_tag in [1, 2]:
+                on_message_callback(
+                    ch=mock_channel, method=Mock(delivery_tag=delivery_tag), properties=Mock(content_type=None), body=body
+                )
+
+        mock_channel.basic_consume.side_effect = consume
+        command.client = MagicMock()
+        command.client.create_vm.return_value.id = 'hv1'
+        reports = []
+        with patch.object(command, 'publish_state_events', side_effect=reports.extend):
+            command.handle()
+        command.client.create_vm.assert_called_once()
+        self.assertEqual(reports, [{'id': 1, 'hypervisor_id': 'hv1', 'state': 'started'}] * 2)
+        self.assertEqual(mock_channel.basic_ack.call_count, 2)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_publishes_state_events(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        mock_connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        mock_channel.basic_consume.side_effect = lambda queue, on_message_callback, auto_ack: on_message_callback(
+            ch=mock_channel, method=Mock(delivery_tag=1), properties=Mock(content_type=None),
+            body=b'{"id": 1, "state": "deleted", "hypervisor_id": "hv1"}'
+        )
+        command.client = MagicMock()
+        with patch.object(command, 'virtual_machine_delete') as mock_virtual_machine_delete:
+            command.handle()
+        mock_virtual_machine_delete.assert_not_called()
+        mock_channel.confirm_delivery.assert_called_once()
+        mock_channel.basic_publish.assert_called_once()
+        publish_kwargs = mock_channel.basic_publish.call_args.kwargs
+        self.assertEqual(publish_kwargs['routing_key'], 'conductor.events')
+        self.assertEqual(
+            json.loads(publish_kwargs['body']), [{'id': 1, 'hypervisor_id': 'hv1', 'state': 'deleted'}]
+        )
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_drains_through_connection_thread(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        callbacks = []
+        mock_connection.add_callback_threadsafe.side_effect = callbacks.append
+
+        def process_data_events(time_limit):
+            # Only the connection thread runs publishes and acks.
+            while callbacks:
+                callbacks.pop(0)()
+
+        mock_connection.process_data_events.side_effect = process_data_events
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        mock_channel.basic_consume.side_effect = lambda queue, on_message_callback, auto_ack: on_message_callback(
+            ch=mock_channel, method=Mock(delivery_tag=1), properties=Mock(content_type=None),
+            body=b'{"id": 1, "state": "deleted", "hypervisor_id": "hv1"}'
+        )
+        command.client = MagicMock()
+        command.handle()
+        mock_channel.basic_publish.assert_called_once()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        self.assertFalse(command.state_reports.thread.is_alive())
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('pika.BlockingConnection')
+    def test_handle_multi_vm_delete(self, mock_blocking_connection, mock_stdout):
+        command = Command()
+        mock_connection = mock_blocking_connection.return_value
+        mock_connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        mock_channel = MagicMock()
+        mock_connection.channel.return_value = mock_channel
+        body = json.dumps({
+            'state': 'deleted',
+            'vms': [
+                {'id': 1, 'hypervisor_id': 'hv1'},
+                {'id': 2, 'hypervisor_id': 'hv2'},
+                {'id': 3, 'hypervisor_id': 'hv3'},
+            ],
+        }).encode()
+        mock_channel.basic_consume.side_effect = lambda queue, on_message_callback, auto_ack: on_message_callback(
+            ch=mock_channel, method=Mock(delivery_tag=1), properties=Mock(content_type=None), body=body
+        )
+        command.client = MagicMock()
+        command.client.delete_vm.side_effect = lambda hypervisor_id: hypervisor_id == 'hv2' and 1 / 0
+        reports = []
+        with patch.object(command, 'publish_state_events', side_effect=reports.extend):
+            command.handle()
+        self.assertEqual([call.args[0] for call in command.client.delete_vm.call_args_list], ['hv1', 'hv2', 'hv3'])
+        self.assertEqual(reports, [
+            {'id': 1, 'hypervisor_id': 'hv1', 'state': 'deleted'},
+            {'id': 2, 'hypervisor_id': 'hv2', 'state': 'failed'},
+            {'id': 3, 'hypervisor_id': 'hv3', 'state': 'deleted'},
+        ])
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('requests.Session.post')
+    def test_virtual_machine_update_states(self, mock_post, mock_stdout):
+        command = Command()
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'updated': [1], 'not_found': [2]}
+        reports = [{'id': 1, 'hypervisor_id': 'hv1', 'state': 'started'}, {'id': 2, 'hypervisor_id': 'hv2', 'state': 'started'}]
+        command.virtual_machine_update_states(reports)
+        self.assertEqual(mock_post.call_args.kwargs['json'], reports)
+        self.assertEqual(mock_post.call_args.kwargs['timeout'], command.callback_timeout)
+        output = mock_stdout.getvalue()
+        self.assertIn('Conductor does not know VM 2', output)
+        mock_post.return_value.status_code = 400
+        with self.assertRaises(Exception):
+            command.virtual_machine_update_states(reports)
+        self.assertIn('Successfully notified conductor about state changes for 2 VMs', output)
+
+    @patch.dict(os.environ, {'COMPUTE_NODE_WORKERS': '8'})
+    def test_workers_from_environment(self):
+        command = Command()
+        self.assertEqual(command.workers, 8)
+
+
+class StateReportBatcherTests(unittest.TestCase):
+
+    def test_size_threshold(self):
+        sent = []
+        batcher = StateReportBatcher(sent.append, max_size=2, window=60)
+        futures = [batcher.submit({'id': i}) for i in range(5)]
+        batcher.start()
+        futures[3].result(timeout=5)
+        self.assertEqual(sent[:2], [[{'id': 0}, {'id': 1}], [{'id': 2}, {'id': 3}]])
+        batcher.close()
+        self.assertEqual(sent[2], [{'id': 4}])
+        self.assertTrue(all(future.done() for future in futures))
+
+    def test_window(self):
+        sent = []
+        batcher = StateReportBatcher(sent.append, max_size=100, window=0.01)
+        batcher.start()
+        batcher.submit({'id': 1}).result(timeout=5)
+        self.assertEqual(sent, [[{'id': 1}]])
+        batcher.close()
+
+    def test_send_failure(self):
+        batcher = StateReportBatcher(Mock(side_effect=Exception('conductor down')), max_size=100, window=0)
+        batcher.start()
+        future = batcher.submit({'id': 1})
+        with self.assertRaises(Exception):
+            future.result(timeout=5)
+        batcher.close()
+
 if __name__ == '__main__':
     unittest.main()
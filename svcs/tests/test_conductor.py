@@ -1,5 +1,8 @@
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APITestCase
+from asgiref.sync import sync_to_async
 from adrf.test import AsyncAPIClient
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.authtoken.models import Token
@@ -11,14 +14,34 @@ from svcs.models import (
     Image,
     Environment,
     Key,
+    OutboxMessage,
     VirtualMachine,
     VMKeyBinding,
     VMLabel,
+    WebhookDelivery,
 )
-from unittest.mock import patch, AsyncMock
+from svcs import messages
+from svcs.outbox import OutboxRelay, add_outbox_messages
+from svcs.schemas import VirtualMachineCreate
+from svcs.serializers import VirtualMachineSerializer
+from svcs.state import apply_state_reports
+from svcs.views import VirtualMachineView
+from unittest import skipUnless
+from unittest.mock import patch, AsyncMock, MagicMock
+import asyncio
 import os
 import aio_pika
-import json
+
+
+def mock_broker(mock_connect_robust):
+    mock_connection = mock_connect_robust.return_value
+    mock_connection.reconnect_callbacks = MagicMock()
+    mock_channel = AsyncMock()
+    mock_channel.is_closed = False
+    mock_exchange = AsyncMock()
+    mock_connection.channel.return_value = mock_channel
+    mock_channel.declare_exchange.return_value = mock_exchange
+    return mock_channel, mock_exchange
 
 
 @patch.dict(os.environ, {"RABBITMQ_HOST": "your_rabbitmq_host"})
@@ -49,6 +72,10 @@ class VirtualMachineViewTests(APITestCase):
             disk_gb=20,
             gpu_type="TestGPU",
             gpu_count=1,
+            allocated_cpu_cores=2,
+            allocated_memory_mb=2048,
+            allocated_disk_gb=20,
+            allocated_gpu_count=1,
         )
         ComputeNode.objects.create(
             name="compute-2",
@@ -88,12 +115,12 @@ class VirtualMachineViewTests(APITestCase):
             virtual_machine=self.virtual_machine, name="TestLabel"
         )
 
+    async def relay_outbox(self):
+        await OutboxRelay(batch_size=100, poll_interval=1, lease=30, publish_timeout=10).relay_pending()
+
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_create_virtual_machine(self, mock_connect_robust):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine")
         data = {
             "environment_name": self.environment.name,
@@ -110,9 +137,11 @@ class VirtualMachineViewTests(APITestCase):
             status.HTTP_201_CREATED,
             msg=f"Response content: {response.content}",
         )
+        await self.relay_outbox()
         mock_exchange.publish.assert_called_once()
         expected_message = {
-            'id': 2,
+            'version': 1,
+            'id': response.data['id'],
             'name': "TestStandardVM",
             'state': 'started',
             'image': self.virtual_machine.image.name,
@@ -124,17 +153,152 @@ class VirtualMachineViewTests(APITestCase):
             'public_ip': self.floating_ip.ip_address,
         }
         published_message = mock_exchange.publish.call_args[0][0]
-        self.assertEqual(json.loads(published_message.body), expected_message)
+        self.assertEqual(messages.decode(published_message.body, published_message.content_type), expected_message)
         self.assertEqual(published_message.delivery_mode, aio_pika.DeliveryMode.PERSISTENT)
 
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machine_with_schema(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "name": "TestSchemaVM",
+            "count": 2,
+        }
+        with patch.object(VirtualMachineView, "create_schema", VirtualMachineCreate):
+            response = await self.async_client.post(url, {**data, "count": 0}, format="json", AUTHORIZATION=f"Token {self.token}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data, {"count": ["Ensure this value is greater than or equal to 1."]})
+
+            response = await self.async_client.post(url, {**data, "count": 1}, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            msg=f"Response content: {response.content}",
+        )
+        self.assertEqual(response.data["name"], "TestSchemaVM")
+        self.assertEqual(await VMKeyBinding.objects.filter(virtual_machine_id=response.data["id"]).acount(), 1)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machine_writes_outbox(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "name": "TestOutboxVM",
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_connect_robust.assert_not_called()
+        message = await OutboxMessage.objects.aget()
+        self.assertEqual(message.routing_key, "q.compute-2")
+        self.assertEqual(messages.decode(bytes(message.body), message.content_type)["id"], response.data["id"])
+
+        await self.relay_outbox()
+        mock_exchange.publish.assert_called_once()
+        self.assertFalse(await OutboxMessage.objects.aexists())
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_outbox_keeps_unconfirmed_messages(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        mock_exchange.publish.side_effect = aio_pika.exceptions.DeliveryError(None, None)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "name": "TestOutboxVM",
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        await self.relay_outbox()
+        message = await OutboxMessage.objects.aget()
+        self.assertIsNotNone(message.claimed_until)
+
+        # Claimed messages are left alone until the lease runs out.
+        mock_exchange.publish.reset_mock(side_effect=True)
+        await self.relay_outbox()
+        mock_exchange.publish.assert_not_called()
+        await OutboxMessage.objects.aupdate(claimed_until=message.created_at)
+        await self.relay_outbox()
+        mock_exchange.publish.assert_called_once()
+        self.assertFalse(await OutboxMessage.objects.aexists())
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_outbox_gives_up_on_publishing_before_the_lease_runs_out(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+
+        async def publish(*args, **kwargs):
+            # The broker never confirms.
+            await asyncio.Event().wait()
+
+        mock_exchange.publish.side_effect = publish
+        await sync_to_async(add_outbox_messages)([("q.compute-1", messages.delete_vm(1, "hv-1"))])
+        relay = OutboxRelay(batch_size=100, poll_interval=1, lease=30, publish_timeout=0.01)
+        with self.assertLogs("svcs.outbox", "WARNING"):
+            await relay.relay_pending()
+        self.assertIsNotNone((await OutboxMessage.objects.aget()).claimed_until)
+
+    async def test_outbox_lease_must_outlast_publishing(self):
+        with self.assertRaises(ValueError):
+            OutboxRelay(batch_size=100, poll_interval=1, lease=30, publish_timeout=30)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_outbox_keeps_messages_claimed_by_another_relay(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        await sync_to_async(add_outbox_messages)([("q.compute-1", messages.delete_vm(1, "hv-1"))])
+
+        async def publish(*args, **kwargs):
+            # The lease ran out and another relay claimed the message.
+            await OutboxMessage.objects.aupdate(claim="other")
+
+        mock_exchange.publish.side_effect = publish
+        await self.relay_outbox()
+        self.assertEqual((await OutboxMessage.objects.aget()).claim, "other")
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_share_broker_connection(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        await ComputeNode.objects.acreate(
+            name="compute-3",
+            cpu_cores=4,
+            memory_mb=4096,
+            disk_gb=40,
+            gpu_type="TestGPU",
+            gpu_count=2,
+        )
+        url = reverse("virtual_machine")
+        for name in ["TestPooledVM1", "TestPooledVM2"]:
+            data = {
+                "environment_name": self.environment.name,
+                "image_name": self.image.name,
+                "flavor_name": self.flavor.name,
+                "key_names": [self.key.name],
+                "name": name,
+            }
+            response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_201_CREATED,
+                msg=f"Response content: {response.content}",
+            )
+            await self.relay_outbox()
+        mock_connect_robust.assert_called_once()
+        mock_connect_robust.return_value.channel.assert_called_once()
+        self.assertEqual(mock_exchange.publish.call_count, 2)
+
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_create_virtual_machine_without_floating_ip(
         self, mock_connect_robust
     ):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine")
         data = {
             "environment_name": self.environment.name,
@@ -150,16 +314,282 @@ class VirtualMachineViewTests(APITestCase):
             status.HTTP_201_CREATED,
             msg=f"Response content: {response.content}",
         )
+        await self.relay_outbox()
+        mock_exchange.publish.assert_called_once()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machine_without_capacity(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "name": "TestVMWithCapacity",
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        vm = await VirtualMachine.objects.select_related("compute_node").aget(name="TestVMWithCapacity")
+        self.assertEqual(vm.compute_node.name, "compute-2")
+        data["name"] = "TestVMWithoutCapacity"
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "No compute node has capacity for flavor TestFlavor.")
+        await self.relay_outbox()
         mock_exchange.publish.assert_called_once()
 
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_with_count(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        await ComputeNode.objects.acreate(
+            name="compute-3",
+            cpu_cores=4,
+            memory_mb=4096,
+            disk_gb=40,
+            gpu_type="TestGPU",
+            gpu_count=2,
+        )
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "assign_floating_ip": False,
+            "name": "TestBatchVM",
+            "labels": ["TestBatchLabel1", "TestBatchLabel2"],
+            "count": 3,
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            msg=f"Response content: {response.content}",
+        )
+        self.assertEqual(
+            [vm["name"] for vm in response.data],
+            ["TestBatchVM-1", "TestBatchVM-2", "TestBatchVM-3"],
+        )
+        await self.relay_outbox()
+        self.assertEqual(mock_exchange.publish.call_count, 3)
+        routing_keys = sorted(call.kwargs["routing_key"] for call in mock_exchange.publish.call_args_list)
+        self.assertEqual(routing_keys, ["q.compute-2", "q.compute-3", "q.compute-3"])
+        vm_ids = [vm["id"] for vm in response.data]
+        self.assertEqual(await VMKeyBinding.objects.filter(virtual_machine_id__in=vm_ids).acount(), 3)
+        self.assertEqual(await VMLabel.objects.filter(virtual_machine_id__in=vm_ids).acount(), 6)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_with_count_over_capacity(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "name": "TestBatchVM",
+            "count": 2,
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(await VirtualMachine.objects.filter(name__startswith="TestBatchVM").aexists())
+        compute_node = await ComputeNode.objects.aget(name="compute-2")
+        self.assertEqual(compute_node.allocated_gpu_count, 0)
+        await self.relay_outbox()
+        mock_exchange.publish.assert_not_called()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_with_count_without_name(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "count": 2,
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("name", response.data)
+        await self.relay_outbox()
+        mock_exchange.publish.assert_not_called()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_with_too_long_name(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "name": "x" * 254,
+            "count": 2,
+        }
+        allocated = [node.allocated_cpu_cores async for node in ComputeNode.objects.order_by("id")]
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("name", response.data)
+        self.assertEqual(
+            [node.allocated_cpu_cores async for node in ComputeNode.objects.order_by("id")], allocated
+        )
+        self.assertFalse(await VirtualMachine.objects.filter(name__startswith="x").aexists())
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_with_floating_ips(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        await ComputeNode.objects.acreate(
+            name="compute-3",
+            cpu_cores=4,
+            memory_mb=4096,
+            disk_gb=40,
+            gpu_type="TestGPU",
+            gpu_count=2,
+        )
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "assign_floating_ip": True,
+            "name": "TestBatchIPVM",
+            "count": 2,
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            msg=f"Response content: {response.content}",
+        )
+        self.assertEqual(
+            sorted(vm["public_ip"] for vm in response.data), ["192.168.1.1", "192.168.1.2"]
+        )
+        for vm in response.data:
+            floating_ip = await FloatingIP.objects.aget(virtual_machine_id=vm["id"])
+            self.assertEqual(floating_ip.ip_address, vm["public_ip"])
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machines_without_enough_floating_ips(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        await ComputeNode.objects.acreate(
+            name="compute-3",
+            cpu_cores=8,
+            memory_mb=8192,
+            disk_gb=80,
+            gpu_type="TestGPU",
+            gpu_count=4,
+        )
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name],
+            "assign_floating_ip": True,
+            "name": "TestBatchIPVM",
+            "count": 3,
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["error"], "No unused floating IPs are available.")
+        self.assertEqual(await FloatingIP.objects.filter(virtual_machine__isnull=True).acount(), 2)
+        self.assertFalse(await VirtualMachine.objects.filter(name__startswith="TestBatchIPVM").aexists())
+        self.assertFalse(await OutboxMessage.objects.aexists())
+        await self.relay_outbox()
+        mock_exchange.publish.assert_not_called()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machine_with_multiple_keys(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        second_key = await Key.objects.acreate(
+            name="TestKey2", environment=self.environment, public_key="TestPublicKey2"
+        )
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": [self.key.name, second_key.name, self.key.name],
+            "name": "TestMultiKeyVM",
+            "labels": ["TestLabel1", "TestLabel2", "TestLabel1"],
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            msg=f"Response content: {response.content}",
+        )
+        key_ids = [
+            key_id async for key_id in VMKeyBinding.objects.filter(
+                virtual_machine_id=response.data["id"]
+            ).order_by("key_id").values_list("key_id", flat=True)
+        ]
+        self.assertEqual(key_ids, [self.key.id, second_key.id])
+        self.assertEqual(await VMLabel.objects.filter(virtual_machine_id=response.data["id"]).acount(), 2)
+
+    @skipUnless(connection.vendor == "postgresql", "Only PostgreSQL creates VMs in one statement")
+    def test_save_virtual_machines_in_one_statement(self):
+        vms = [
+            VirtualMachine(
+                name=f"TestStatementVM-{i}",
+                environment=self.environment,
+                image=self.image,
+                flavor=self.flavor,
+                compute_node=self.compute_node,
+            )
+            for i in range(1, 3)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            created = VirtualMachineSerializer().save_vms(
+                vms, [self.key], {"assign_floating_ip": True, "labels": ["a", "b", "a"]}
+            )
+        statements = [
+            query["sql"] for query in queries
+            if not query["sql"].startswith(("SAVEPOINT", "RELEASE SAVEPOINT"))
+        ]
+        # The VMs with their IPs, keys and labels, then the outbox messages.
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(sorted(public_ip for _, public_ip in created), ["192.168.1.1", "192.168.1.2"])
+        for vm, public_ip in created:
+            self.assertEqual(FloatingIP.objects.get(virtual_machine=vm).ip_address, public_ip)
+            self.assertEqual(
+                list(VMKeyBinding.objects.filter(virtual_machine=vm).values_list("key_id", flat=True)),
+                [self.key.id],
+            )
+            self.assertEqual(
+                sorted(VMLabel.objects.filter(virtual_machine=vm).values_list("name", flat=True)),
+                ["a", "b"],
+            )
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_create_virtual_machine_with_missing_keys(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine")
+        data = {
+            "environment_name": self.environment.name,
+            "image_name": self.image.name,
+            "flavor_name": self.flavor.name,
+            "key_names": ["MissingKey1", self.key.name, "MissingKey2"],
+            "name": "TestMissingKeyVM",
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data["error"], "Keys not found: MissingKey1, MissingKey2.")
+        self.assertFalse(await VirtualMachine.objects.filter(name="TestMissingKeyVM").aexists())
+        compute_node = await ComputeNode.objects.aget(name="compute-2")
+        self.assertEqual(compute_node.allocated_gpu_count, 0)
+        await self.relay_outbox()
+        mock_exchange.publish.assert_not_called()
+
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_create_virtual_machine_with_missing_fields(
         self, mock_connect_robust
     ):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine")
         data = {
             "environment_name": self.environment.name,
@@ -173,14 +603,12 @@ class VirtualMachineViewTests(APITestCase):
             status.HTTP_400_BAD_REQUEST,
             msg=f"Response content: {response.content}",
         )
+        await self.relay_outbox()
         mock_exchange.publish.assert_not_called()
 
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_create_virtual_machine_with_invalid_data(self, mock_connect_robust):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine")
         data = {
             "environment_name": self.environment.name,
@@ -196,14 +624,12 @@ class VirtualMachineViewTests(APITestCase):
             status.HTTP_400_BAD_REQUEST,
             msg=f"Response content: {response.content}",
         )
+        await self.relay_outbox()
         mock_exchange.publish.assert_not_called()
 
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_delete_virtual_machine_by_id(self, mock_connect_robust):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine_by_id", args=[self.virtual_machine.id])
         response = await self.async_client.delete(url, AUTHORIZATION=f"Token {self.token}")
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
@@ -211,14 +637,12 @@ class VirtualMachineViewTests(APITestCase):
             (await VirtualMachine.objects.aget(pk=self.virtual_machine.id)).state,
             "deleting",
         )
+        await self.relay_outbox()
         mock_exchange.publish.assert_called_once()
 
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_patch_virtual_machine_state(self, mock_connect_robust):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine_update_state", args=[self.virtual_machine.id])
         data = {"state": "started"}
         response = await self.async_client.patch(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
@@ -228,12 +652,309 @@ class VirtualMachineViewTests(APITestCase):
         self.assertEqual(self.virtual_machine.state, "started")
         mock_exchange.publish.assert_not_called()
 
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_patch_virtual_machine_failed_releases_capacity(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine_update_state", args=[self.virtual_machine.id])
+        response = await self.async_client.patch(url, {"state": "failed"}, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        await self.compute_node.arefresh_from_db()
+        self.assertEqual(self.compute_node.allocated_cpu_cores, 0)
+        self.assertEqual(self.compute_node.allocated_memory_mb, 0)
+        self.assertEqual(self.compute_node.allocated_disk_gb, 0)
+        self.assertEqual(self.compute_node.allocated_gpu_count, 0)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_state_changes_enqueue_webhooks(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        self.virtual_machine.callback_url = "http://tenant.example.com/hook"
+        await self.virtual_machine.asave()
+        url = reverse("virtual_machine_update_state", args=[self.virtual_machine.id])
+        response = await self.async_client.patch(url, {"state": "failed"}, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        delivery = await WebhookDelivery.objects.aget(virtual_machine_id=self.virtual_machine.id)
+        self.assertEqual(delivery.url, "http://tenant.example.com/hook")
+        self.assertEqual(delivery.payload["state"], "failed")
+
+        url = reverse("virtual_machine_by_id", args=[self.virtual_machine.id])
+        response = await self.async_client.delete(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        delivery = await WebhookDelivery.objects.aget(virtual_machine_id=self.virtual_machine.id)
+        self.assertEqual(delivery.payload["state"], "deleted")
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_update_virtual_machine_states(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        other_vm = await VirtualMachine.objects.acreate(
+            name="OtherVM",
+            environment=self.environment,
+            image=self.image,
+            flavor=self.flavor,
+            compute_node=self.compute_node,
+        )
+        self.floating_ip.virtual_machine = self.virtual_machine
+        await self.floating_ip.asave()
+        url = reverse("virtual_machine_update_states")
+        data = [
+            {"id": self.virtual_machine.id, "state": "failed"},
+            {"id": other_vm.id, "hypervisor_id": "hv-1", "state": "starting"},
+            {"id": other_vm.id, "hypervisor_id": "hv-2", "state": "started"},
+            {"id": 999999, "state": "started"},
+        ]
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertCountEqual(response.data["updated"], [self.virtual_machine.id, other_vm.id])
+        self.assertEqual(response.data["not_found"], [999999])
+        await self.virtual_machine.arefresh_from_db()
+        self.assertEqual(self.virtual_machine.state, "failed")
+        await other_vm.arefresh_from_db()
+        self.assertEqual(other_vm.state, "started")
+        self.assertEqual(other_vm.hypervisor_id, "hv-2")
+        await self.floating_ip.arefresh_from_db()
+        self.assertIsNone(self.floating_ip.virtual_machine_id)
+        await self.compute_node.arefresh_from_db()
+        self.assertEqual(self.compute_node.allocated_cpu_cores, 0)
+
+        response = await self.async_client.post(url, data[:1], format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        await self.compute_node.arefresh_from_db()
+        self.assertEqual(self.compute_node.allocated_cpu_cores, 0)
+        mock_exchange.publish.assert_not_called()
+
+    async def test_state_reports_roll_back_together(self):
+        self.floating_ip.virtual_machine = self.virtual_machine
+        await self.floating_ip.asave()
+        with patch("svcs.state.release_capacity", side_effect=RuntimeError("database gone")):
+            with self.assertRaises(RuntimeError):
+                await apply_state_reports([{"id": self.virtual_machine.id, "state": "failed"}])
+        await self.virtual_machine.arefresh_from_db()
+        self.assertEqual(self.virtual_machine.state, "started")
+        await self.floating_ip.arefresh_from_db()
+        self.assertEqual(self.floating_ip.virtual_machine_id, self.virtual_machine.id)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_update_virtual_machine_states_invalid(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machine_update_states")
+        for data in [[], [{"id": self.virtual_machine.id, "state": "exploded"}]]:
+            response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        await self.virtual_machine.arefresh_from_db()
+        self.assertEqual(self.virtual_machine.state, "started")
+
+    def create_listed_virtual_machines(self):
+        other_group = Group.objects.create(name="OtherGroup")
+        other_environment = Environment.objects.create(name="OtherEnv", group=other_group)
+        hidden_vm = VirtualMachine.objects.create(
+            name="HiddenVM", environment=other_environment, image=self.image, flavor=self.flavor
+        )
+        vms = [self.virtual_machine]
+        for i in range(3):
+            vm = VirtualMachine.objects.create(
+                name=f"ListedVM-{i}",
+                environment=self.environment,
+                image=self.image,
+                flavor=self.flavor,
+                compute_node=self.compute_node,
+                state="failed" if i == 2 else "started",
+            )
+            VMKeyBinding.objects.create(virtual_machine=vm, key=self.key)
+            VMLabel.objects.create(virtual_machine=vm, name=f"label-{i % 2}")
+            vms.append(vm)
+        return vms, hidden_vm
+
+    async def test_list_virtual_machines(self):
+        vms, hidden_vm = await sync_to_async(self.create_listed_virtual_machines)()
+        url = reverse("virtual_machine")
+        response = await self.async_client.get(url, {"limit": 3}, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([vm["id"] for vm in response.data["results"]], [vm.id for vm in vms[:3]])
+        first = response.data["results"][0]
+        self.assertEqual(first["key_names"], ["TestKey"])
+        self.assertEqual(first["labels"], ["TestLabel"])
+        self.assertEqual(first["compute_node_name"], "compute-1")
+        self.assertIsNotNone(response.data["next"])
+
+        response = await self.async_client.get(response.data["next"], AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([vm["id"] for vm in response.data["results"]], [vms[3].id])
+        self.assertIsNone(response.data["next"])
+
+        response = await self.async_client.get(
+            url, {"label": "label-0", "state": "started"}, AUTHORIZATION=f"Token {self.token}"
+        )
+        self.assertEqual([vm["id"] for vm in response.data["results"]], [vms[1].id])
+
+        for params in [{"cursor": "garbage"}, {"limit": 0}, {"limit": "many"}]:
+            response = await self.async_client.get(url, params, AUTHORIZATION=f"Token {self.token}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("error", response.data)
+
+    def test_list_virtual_machines_query_count(self):
+        self.create_listed_virtual_machines()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {self.token}")
+        url = reverse("virtual_machine")
+        client.get(url)
+        with self.assertNumQueries(5):
+            response = client.get(url)
+        self.assertEqual(len(response.data["results"]), 4)
+
+    async def test_get_virtual_machine(self):
+        vms, hidden_vm = await sync_to_async(self.create_listed_virtual_machines)()
+        url = reverse("virtual_machine_by_id", args=[vms[1].id])
+        response = await self.async_client.get(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["name"], "ListedVM-0")
+        self.assertEqual(response.data["labels"], ["label-0"])
+
+        url = reverse("virtual_machine_by_id", args=[hidden_vm.id])
+        response = await self.async_client.get(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_get_virtual_machine_invalid_id(self):
+        for pk in ["not-a-number", "1.5", "9" * 30]:
+            with self.subTest(pk=pk):
+                response = await self.async_client.get(
+                    f"/v1/core/virtual-machines/{pk}/", AUTHORIZATION=f"Token {self.token}"
+                )
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+                response = await self.async_client.patch(
+                    f"/v1/internal/vm-state/{pk}/", {"state": "started"}, format="json",
+                    AUTHORIZATION=f"Token {self.token}",
+                )
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_virtual_machine_by_name(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        vms, hidden_vm = await sync_to_async(self.create_listed_virtual_machines)()
+        url = reverse("virtual_machine_by_name", args=["TestEnv", "ListedVM-1"])
+        response = await self.async_client.get(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["id"], vms[2].id)
+
+        url = reverse("virtual_machine_by_name", args=["OtherEnv", "HiddenVM"])
+        response = await self.async_client.get(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = await self.async_client.delete(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        url = reverse("virtual_machine_by_name", args=["TestEnv", "ListedVM-1"])
+        response = await self.async_client.delete(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        await vms[2].arefresh_from_db()
+        self.assertEqual(vms[2].state, "deleting")
+        await self.relay_outbox()
+        mock_exchange.publish.assert_called_once()
+
+        response = await self.async_client.patch(url, {"state": "failed"}, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_virtual_machines_by_label(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        vms, hidden_vm = await sync_to_async(self.create_listed_virtual_machines)()
+        url = reverse("virtual_machines_by_label", args=["TestEnv", "label-0"])
+        response = await self.async_client.get(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([vm["id"] for vm in response.data["results"]], [vms[1].id, vms[3].id])
+
+        response = await self.async_client.delete(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        await vms[1].arefresh_from_db()
+        self.assertEqual(vms[1].state, "deleting")
+        self.assertFalse(await VirtualMachine.objects.filter(pk=vms[3].id).aexists())
+        await vms[2].arefresh_from_db()
+        self.assertEqual(vms[2].state, "started")
+        await self.relay_outbox()
+        mock_exchange.publish.assert_called_once()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_bulk_delete_virtual_machines(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        vms, hidden_vm = await sync_to_async(self.create_listed_virtual_machines)()
+        compute_node_2 = await ComputeNode.objects.aget(name="compute-2")
+        vms[2].compute_node = compute_node_2
+        vms[2].hypervisor_id = "hv-2"
+        await vms[2].asave()
+        url = reverse("virtual_machines_bulk_delete")
+        data = {
+            "environment_name": "TestEnv",
+            "ids": [vm.id for vm in vms] + [hidden_vm.id],
+        }
+        response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertCountEqual(response.data["deleting"], [vms[0].id, vms[1].id, vms[2].id])
+        self.assertEqual(response.data["deleted"], [vms[3].id])
+        self.assertEqual(
+            await VirtualMachine.objects.filter(state="deleting").acount(), 3
+        )
+        self.assertFalse(await VirtualMachine.objects.filter(pk=vms[3].id).aexists())
+        await hidden_vm.arefresh_from_db()
+        self.assertEqual(hidden_vm.state, "starting")
+
+        await self.relay_outbox()
+        self.assertEqual(mock_exchange.publish.call_count, 2)
+        published = {
+            call.kwargs["routing_key"]: messages.decode(call.args[0].body, call.args[0].content_type)
+            for call in mock_exchange.publish.call_args_list
+        }
+        self.assertEqual(published["q.compute-1"]["state"], "deleted")
+        self.assertCountEqual(
+            [vm["id"] for vm in published["q.compute-1"]["vms"]], [vms[0].id, vms[1].id]
+        )
+        self.assertEqual(published["q.compute-2"]["vms"], [{"id": vms[2].id, "hypervisor_id": "hv-2"}])
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_bulk_delete_skips_unplaced_and_concurrently_changed_vms(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        vms, hidden_vm = await sync_to_async(self.create_listed_virtual_machines)()
+        vms[1].compute_node = None
+        await vms[1].asave()
+        read_vms = [vm async for vm in VirtualMachine.objects.select_related("flavor").filter(pk__in=[vm.id for vm in vms])]
+        # Another request deletes vms[2] after this one read it.
+        await VirtualMachine.objects.filter(pk=vms[2].id).aupdate(state="deleting")
+        deleting, removed = await VirtualMachineView().delete_vms(read_vms)
+        self.assertEqual([vm.id for vm in deleting], [vms[0].id])
+        self.assertCountEqual([vm.id for vm in removed], [vms[1].id, vms[3].id])
+        self.assertFalse(await VirtualMachine.objects.filter(pk=vms[1].id).aexists())
+        await self.relay_outbox()
+        mock_exchange.publish.assert_called_once()
+        published = messages.decode(
+            mock_exchange.publish.call_args.args[0].body, mock_exchange.publish.call_args.args[0].content_type
+        )
+        self.assertEqual([vm["id"] for vm in published["vms"]], [vms[0].id])
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_bulk_delete_virtual_machines_invalid(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        url = reverse("virtual_machines_bulk_delete")
+        for data in [
+            {"environment_name": "TestEnv"},
+            {"environment_name": "TestEnv", "label": "TestLabel", "ids": [self.virtual_machine.id]},
+            {"environment_name": "TestEnv", "ids": []},
+        ]:
+            response = await self.async_client.post(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_exchange.publish.assert_not_called()
+
+    @patch("aio_pika.connect_robust", new_callable=AsyncMock)
+    async def test_delete_deleting_virtual_machine_releases_capacity(self, mock_connect_robust):
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
+        self.virtual_machine.state = "deleting"
+        await self.virtual_machine.asave()
+        url = reverse("virtual_machine_by_id", args=[self.virtual_machine.id])
+        response = await self.async_client.delete(url, AUTHORIZATION=f"Token {self.token}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(await VirtualMachine.objects.filter(pk=self.virtual_machine.id).aexists())
+        await self.compute_node.arefresh_from_db()
+        self.assertEqual(self.compute_node.allocated_gpu_count, 0)
+        mock_exchange.publish.assert_not_called()
+
     @patch("aio_pika.connect_robust", new_callable=AsyncMock)
     async def test_patch_virtual_machine_state_missing(self, mock_connect_robust):
-        mock_channel = AsyncMock()
-        mock_exchange = AsyncMock()
-        mock_connect_robust.return_value.channel.return_value = mock_channel
-        mock_channel.declare_exchange.return_value = mock_exchange
+        mock_channel, mock_exchange = mock_broker(mock_connect_robust)
         url = reverse("virtual_machine_update_state", args=[self.virtual_machine.id])
         data = {}
         response = await self.async_client.patch(url, data, format="json", AUTHORIZATION=f"Token {self.token}")
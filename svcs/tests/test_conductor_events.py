@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+from io import StringIO
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from django.contrib.auth.models import Group
+from django.db import OperationalError
+from django.test import TestCase
+
+from svcs.management.commands.conductor_events import Command
+from svcs.models import ComputeNode, Environment, Flavor, FloatingIP, Image, VirtualMachine
+
+
+def mock_message(body, redelivered=False):
+    message = MagicMock()
+    message.body = body
+    message.redelivered = redelivered
+    message.ack = AsyncMock()
+    message.nack = AsyncMock()
+    message.reject = AsyncMock()
+    return message
+
+
+class ConductorEventsCommandTests(TestCase):
+    def setUp(self):
+        self.flavor = Flavor.objects.create(
+            name="TestFlavor", cpu_cores=2, memory_mb=2048, disk_gb=20, gpu_type="TestGPU", gpu_count=0
+        )
+        self.compute_node = ComputeNode.objects.create(
+            name="compute-1",
+            cpu_cores=4,
+            memory_mb=4096,
+            disk_gb=40,
+            gpu_type="TestGPU",
+            gpu_count=0,
+            allocated_cpu_cores=4,
+            allocated_memory_mb=4096,
+            allocated_disk_gb=40,
+        )
+        group = Group.objects.create(name="TestGroup")
+        environment = Environment.objects.create(name="TestEnv", group=group)
+        image = Image.objects.create(name="TestImage")
+        self.starting_vm, self.deleting_vm = [
+            VirtualMachine.objects.create(
+                name=name,
+                environment=environment,
+                image=image,
+                flavor=self.flavor,
+                compute_node=self.compute_node,
+                state=state,
+            )
+            for name, state in [("vm-1", "starting"), ("vm-2", "deleting")]
+        ]
+        self.floating_ip = FloatingIP.objects.create(ip_address="192.168.1.1", virtual_machine=self.starting_vm)
+        with patch.dict(os.environ, {"RABBITMQ_HOST": "test.rabbitmq.host"}):
+            self.command = Command(stdout=StringIO())
+        # Like the test client, keep the test transaction's connection open.
+        patcher = patch("svcs.management.commands.conductor_events.close_old_connections")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_next_batch(self):
+        self.command.batch_size = 2
+        messages = asyncio.Queue()
+        for i in range(3):
+            messages.put_nowait(i)
+        self.assertEqual(await self.command.next_batch(messages), [0, 1])
+        self.assertEqual(await self.command.next_batch(messages), [2])
+
+    async def test_apply_batch(self):
+        messages = [
+            mock_message(json.dumps([
+                {"id": self.starting_vm.id, "hypervisor_id": "hv-1", "state": "started"},
+                {"id": self.deleting_vm.id, "hypervisor_id": "hv-2", "state": "deleted"},
+            ]).encode()),
+            mock_message(json.dumps([{"id": self.starting_vm.id, "hypervisor_id": "hv-1", "state": "failed"}]).encode()),
+            mock_message(b"not json"),
+            mock_message(json.dumps([{"id": self.starting_vm.id, "state": "exploded"}]).encode()),
+        ]
+        await self.command.apply_batch(messages)
+        for message in messages[:2]:
+            message.ack.assert_awaited_once()
+        for message in messages[2:]:
+            message.reject.assert_awaited_once()
+            message.ack.assert_not_awaited()
+
+        await self.starting_vm.arefresh_from_db()
+        self.assertEqual(self.starting_vm.state, "failed")
+        self.assertEqual(self.starting_vm.hypervisor_id, "hv-1")
+        self.assertFalse(await VirtualMachine.objects.filter(pk=self.deleting_vm.id).aexists())
+        await self.floating_ip.arefresh_from_db()
+        self.assertIsNone(self.floating_ip.virtual_machine_id)
+        await self.compute_node.arefresh_from_db()
+        self.assertEqual(self.compute_node.allocated_cpu_cores, 0)
+        self.assertEqual(self.compute_node.allocated_memory_mb, 0)
+
+    async def test_apply_batch_requeues_on_error(self):
+        message = mock_message(json.dumps([{"id": self.starting_vm.id, "state": "started"}]).encode())
+        with patch(
+            "svcs.management.commands.conductor_events.apply_state_reports",
+            side_effect=Exception("database is down"),
+        ), patch("asyncio.sleep", new_callable=AsyncMock):
+            await self.command.apply_batch([message])
+        message.nack.assert_awaited_once_with(requeue=True)
+        message.ack.assert_not_awaited()
+        self.assertIn("database is down", self.command.stdout.getvalue())
+
+    async def test_apply_batch_applies_events_one_by_one_on_error(self):
+        good = mock_message(json.dumps([{"id": self.starting_vm.id, "state": "started"}]).encode())
+        bad = mock_message(json.dumps([{"id": self.deleting_vm.id, "state": "deleted"}]).encode())
+        apply_state_reports = self.command.apply_reports
+
+        async def apply_reports(reports):
+            if any(report["id"] == self.deleting_vm.id for report in reports):
+                raise Exception("constraint violated")
+            await apply_state_reports(reports)
+
+        with patch.object(self.command, "apply_reports", side_effect=apply_reports), patch(
+            "asyncio.sleep", new_callable=AsyncMock
+        ):
+            await self.command.apply_batch([good, bad])
+        good.ack.assert_awaited_once()
+        bad.nack.assert_awaited_once_with(requeue=True)
+        bad.ack.assert_not_awaited()
+        await self.starting_vm.arefresh_from_db()
+        self.assertEqual(self.starting_vm.state, "started")
+
+    async def test_apply_batch_dead_letters_redelivered_failures(self):
+        message = mock_message(json.dumps([{"id": self.starting_vm.id, "state": "started"}]).encode(), redelivered=True)
+        with patch(
+            "svcs.management.commands.conductor_events.apply_state_reports",
+            side_effect=Exception("constraint violated"),
+        ), patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+            await self.command.apply_batch([message])
+        message.reject.assert_awaited_once_with(requeue=False)
+        message.nack.assert_not_awaited()
+        mock_sleep.assert_not_awaited()
+
+    async def test_apply_batch_requeues_redelivered_events_while_database_is_down(self):
+        message = mock_message(json.dumps([{"id": self.starting_vm.id, "state": "started"}]).encode(), redelivered=True)
+        with patch(
+            "svcs.management.commands.conductor_events.apply_state_reports",
+            side_effect=OperationalError("connection refused"),
+        ), patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+            for _ in range(7):
+                await self.command.apply_batch([message])
+        self.assertEqual(message.nack.await_count, 7)
+        message.reject.assert_not_awaited()
+        self.assertEqual([call.args[0] for call in mock_sleep.await_args_list], [1, 2, 4, 8, 16, 30, 30])
+
+        await self.command.apply_batch([message])
+        message.ack.assert_awaited_once()
+        self.assertEqual(self.command.retry_delay, 0)
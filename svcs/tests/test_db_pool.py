@@ -0,0 +1,140 @@
+import threading
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from svcs.db.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def make_pool(self, **kwargs):
+        self.connections = []
+
+        def connect():
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+
+        return ConnectionPool(connect=connect, **kwargs)
+
+    def test_reuses_returned_connections(self):
+        pool = self.make_pool()
+        first = pool.getconn()
+        pool.putconn(first)
+        self.assertIs(pool.getconn(), first)
+        self.assertEqual(pool.stats(), {"size": 1, "idle": 0, "in_use": 1, "opened": 1})
+
+    def test_rolls_back_returned_connections(self):
+        pool = self.make_pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertEqual(conn.rollbacks, 1)
+
+    def test_waits_for_a_free_connection(self):
+        pool = self.make_pool(max_size=1, timeout=5)
+        conn = pool.getconn()
+        timer = threading.Timer(0.05, pool.putconn, [conn])
+        timer.start()
+        self.assertIs(pool.getconn(), conn)
+        timer.join()
+
+    def test_times_out_when_exhausted(self):
+        pool = self.make_pool(max_size=1, timeout=0.01)
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+
+    def test_replaces_connections_failing_the_check(self):
+        pool = self.make_pool(check=lambda conn: conn is not self.connections[0])
+        first = pool.getconn()
+        pool.putconn(first)
+        second = pool.getconn()
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_discards_closed_and_old_connections(self):
+        pool = self.make_pool(max_lifetime=60)
+        closed, old = pool.getconn(), pool.getconn()
+        closed.close()
+        pool.putconn(closed)
+        with patch("svcs.db.pool.time.monotonic", return_value=pool.in_use[id(old)].created_at + 61):
+            pool.putconn(old)
+        self.assertTrue(old.closed)
+        self.assertEqual(pool.stats()["size"], 0)
+
+    def test_closes_idle_connections_above_min_size(self):
+        pool = self.make_pool(min_size=1, max_idle=60)
+        first, second = pool.getconn(), pool.getconn()
+        pool.putconn(second)
+        pool.putconn(first)
+        with patch("svcs.db.pool.time.monotonic", return_value=pool.idle[-1].idle_since + 61):
+            self.assertIs(pool.getconn(), first)
+        self.assertTrue(second.closed)
+        self.assertFalse(first.closed)
+
+    def test_closes_idle_connections_behind_recently_used_ones(self):
+        pool = self.make_pool(max_idle=60)
+        old, recent, busy = pool.getconn(), pool.getconn(), pool.getconn()
+        pool.putconn(old)
+        now = pool.idle[0].idle_since + 61
+        with patch("svcs.db.pool.time.monotonic", return_value=now - 30):
+            pool.putconn(recent)
+        with patch("svcs.db.pool.time.monotonic", return_value=now):
+            pool.putconn(busy)
+        self.assertTrue(old.closed)
+        self.assertEqual(pool.stats(), {"size": 2, "idle": 2, "in_use": 0, "opened": 3})
+
+    def test_failed_connect_frees_its_slot(self):
+        pool = ConnectionPool(connect=lambda: 1 / 0, max_size=1, timeout=0.01)
+        for _ in range(2):
+            with self.assertRaises(ZeroDivisionError):
+                pool.getconn()
+        self.assertEqual(pool.stats()["size"], 0)
+
+    def test_rejects_foreign_connections(self):
+        pool = self.make_pool()
+        with self.assertRaises(ValueError):
+            pool.putconn(FakeConnection())
+
+    def test_close(self):
+        pool = self.make_pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        pool.close()
+        self.assertTrue(conn.closed)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+
+
+class PooledDatabaseTests(TestCase):
+    def setUp(self):
+        if connection.vendor != "postgresql" or not connection.settings_dict.get("POOL"):
+            self.skipTest("Needs the pooled PostgreSQL backend")
+
+    def test_reuses_connections_across_threads(self):
+        def backend_pid():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_backend_pid()")
+                pid = cursor.fetchone()[0]
+            connection.close()
+            return pid
+
+        pids = []
+        for _ in range(3):
+            thread = threading.Thread(target=lambda: pids.append(backend_pid()))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(set(pids)), 1)
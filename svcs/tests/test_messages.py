@@ -0,0 +1,72 @@
+import json
+import unittest
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from svcs import messages
+
+
+class MessageTests(SimpleTestCase):
+    def setUp(self):
+        self.vm = SimpleNamespace(
+            id=1,
+            name="vm-1",
+            image=SimpleNamespace(name="TestImage"),
+            flavor=SimpleNamespace(cpu_cores=2, memory_mb=2048, disk_gb=20),
+            user_data="#cloud-config",
+            hypervisor_id="hv-1",
+        )
+
+    def test_round_trip(self):
+        message = messages.start_vm(self.vm, "192.168.1.1", ["web"])
+        for content_type in messages.content_types():
+            body, encoded_as = messages.encode(message, content_type)
+            self.assertEqual(encoded_as, content_type)
+            self.assertEqual(messages.decode(body, content_type), {"version": messages.SCHEMA_VERSION, **message})
+
+    @override_settings(MESSAGE_CONTENT_TYPE="application/json")
+    def test_content_type_setting(self):
+        body, content_type = messages.encode(messages.delete_vms([self.vm]))
+        self.assertEqual(content_type, messages.JSON)
+        self.assertEqual(
+            json.loads(body),
+            {"version": 1, "state": "deleted", "vms": [{"id": 1, "hypervisor_id": "hv-1"}]},
+        )
+
+    @unittest.skipIf(messages.msgpack is None, "msgpack is not installed")
+    def test_msgpack_is_preferred(self):
+        self.assertEqual(messages.content_types()[0], messages.MSGPACK)
+
+    def test_decode_unversioned_json(self):
+        # Messages queued before versioning, without a content type.
+        message = messages.decode(b'{"id": 1, "hypervisor_id": "hv-1", "state": "deleted"}')
+        self.assertEqual(message["state"], "deleted")
+
+    def test_decode_rejects_newer_versions(self):
+        body = json.dumps({"version": messages.SCHEMA_VERSION + 1, "state": "started"}).encode()
+        with self.assertRaises(messages.MessageError):
+            messages.decode(body, messages.JSON)
+
+    def test_decode_rejects_malformed_messages(self):
+        for body, content_type in [(b"not json", None), (b"[1, 2]", None), (b"{}", "text/plain")]:
+            with self.assertRaises(messages.MessageError):
+                messages.decode(body, content_type)
+
+    @patch.object(messages, "msgpack", None)
+    def test_msgpack_missing(self):
+        self.assertEqual(messages.content_types(), [messages.JSON])
+        with self.assertRaises(messages.MessageError):
+            messages.encode({}, messages.MSGPACK)
+        with self.assertRaises(messages.MessageError):
+            messages.decode(b"\x80", messages.MSGPACK)
+
+    def test_benchmark_command(self):
+        stdout = StringIO()
+        call_command("benchmark_messages", number=10, stdout=stdout)
+        output = stdout.getvalue()
+        for name in ["start", "delete", "delete_vms"]:
+            self.assertIn(name, output)
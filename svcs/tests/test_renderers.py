@@ -0,0 +1,70 @@
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import BytesIO
+from ipaddress import ip_address
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from svcs import parsers, renderers
+from svcs.parsers import ORJSONParser
+from svcs.renderers import ORJSONRenderer
+from svcs.views import VirtualMachineView
+
+
+class ORJSONRendererTests(SimpleTestCase):
+    def setUp(self):
+        self.data = {
+            "id": 1,
+            "name": "vm-ä",
+            "created_at": datetime(2024, 1, 2, 3, 4, 5, 678000, tzinfo=timezone.utc),
+            "uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "public_ip": ip_address("192.168.1.1"),
+            "price": Decimal("1.50"),
+            "errors": {0: ["This field is required."]},
+        }
+
+    def test_render_matches_drf(self):
+        self.assertEqual(
+            ORJSONRenderer().render(self.data),
+            JSONRenderer().render({**self.data, "public_ip": "192.168.1.1"}),
+        )
+
+    def test_render_indent(self):
+        rendered = ORJSONRenderer().render({"id": 1}, "application/json; indent=4")
+        self.assertEqual(rendered, b'{\n  "id": 1\n}')
+
+    def test_render_none(self):
+        self.assertEqual(ORJSONRenderer().render(None), b"")
+
+    def test_render_without_orjson(self):
+        with patch.object(renderers, "orjson", None):
+            self.assertEqual(ORJSONRenderer().render({"id": 1}), b'{"id":1}')
+
+    def test_virtual_machine_view_uses_orjson(self):
+        view = VirtualMachineView()
+        self.assertIsInstance(view.get_renderers()[0], ORJSONRenderer)
+        self.assertIsInstance(view.get_parsers()[0], ORJSONParser)
+
+
+class ORJSONParserTests(SimpleTestCase):
+    def test_parse(self):
+        data = ORJSONParser().parse(BytesIO('{"name": "vm-ä", "count": 2}'.encode()))
+        self.assertEqual(data, {"name": "vm-ä", "count": 2})
+
+    def test_parse_error(self):
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(BytesIO(b'{"name": '))
+
+    def test_parse_other_encoding(self):
+        with patch.object(JSONParser, "parse", return_value={}) as mock_parse:
+            ORJSONParser().parse(BytesIO(b"{}"), parser_context={"encoding": "latin-1"})
+        mock_parse.assert_called_once()
+
+    def test_parse_without_orjson(self):
+        with patch.object(parsers, "orjson", None):
+            self.assertEqual(ORJSONParser().parse(BytesIO(b'{"id": 1}')), {"id": 1})
@@ -0,0 +1,158 @@
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+
+from adrf.test import AsyncAPIClient
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.db import connections
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from svcs import routers
+from svcs.cache import CatalogCache
+from svcs.models import ComputeNode, Environment, Flavor, Image, ReadPin, VirtualMachine
+from svcs.routers import PIN_COOKIE_NAME, ReadYourWritesMiddleware, ReplicaRouter
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRouterTests(TransactionTestCase):
+    def setUp(self):
+        routers.recent_writers.clear()
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def request(self, method, write=False, **headers):
+        """
+        Return where a request reads VMs from, and its response.
+        """
+        databases = []
+
+        def view(request):
+            databases.append(self.router.db_for_read(VirtualMachine))
+            if write:
+                self.router.db_for_write(VirtualMachine)
+            return HttpResponse()
+
+        request = getattr(self.factory, method)("/", **headers)
+        response = ReadYourWritesMiddleware(view)(request)
+        return databases[0], response
+
+    def test_safe_requests_read_from_the_replica(self):
+        self.assertEqual(self.request("get")[0], "replica")
+
+    def test_other_requests_read_from_the_primary(self):
+        for method in ["post", "patch", "delete"]:
+            with self.subTest(method=method):
+                self.assertEqual(self.request(method)[0], "default")
+
+    def test_reads_outside_requests_use_the_primary(self):
+        self.assertEqual(self.router.db_for_read(VirtualMachine), "default")
+
+    def test_reads_in_transactions_use_the_primary(self):
+        with patch.object(connections["default"], "in_atomic_block", True):
+            self.assertEqual(self.request("get")[0], "default")
+
+    def test_writes_go_to_the_primary(self):
+        vm = VirtualMachine()
+        vm._state.db = "replica"
+        self.assertEqual(self.router.db_for_write(VirtualMachine, instance=vm), "default")
+
+    def test_writers_read_their_writes(self):
+        _, response = self.request("post", write=True, HTTP_AUTHORIZATION="Token a")
+        self.assertIn(PIN_COOKIE_NAME, response.cookies)
+        self.assertEqual(self.request("get", HTTP_AUTHORIZATION="Token a")[0], "default")
+        self.assertEqual(self.request("get", HTTP_AUTHORIZATION="Token b")[0], "replica")
+        with patch("svcs.cache.time.monotonic", return_value=10 ** 9), patch(
+            "svcs.routers.timezone.now", return_value=timezone.now() + timedelta(seconds=60)
+        ):
+            self.assertEqual(self.request("get", HTTP_AUTHORIZATION="Token a")[0], "replica")
+
+    def test_writers_read_their_writes_in_other_processes(self):
+        self.request("post", write=True, HTTP_AUTHORIZATION="Token a")
+        # Another conductor process has not seen the write.
+        routers.recent_writers.clear()
+        self.assertEqual(self.request("get", HTTP_AUTHORIZATION="Token a")[0], "default")
+        self.assertEqual(self.request("get", HTTP_AUTHORIZATION="Token b")[0], "replica")
+
+    def test_pins_do_not_hold_credentials(self):
+        self.request("post", write=True, HTTP_AUTHORIZATION="Token a")
+        pin = ReadPin.objects.get()
+        self.assertNotIn("Token a", pin.client)
+        self.assertEqual(list(routers.recent_writers.entries), [pin.client])
+
+    def test_pin_cookie(self):
+        self.factory.cookies[PIN_COOKIE_NAME] = "1"
+        self.assertEqual(self.request("get")[0], "default")
+
+    def test_requests_without_writes_do_not_pin(self):
+        _, response = self.request("post", HTTP_AUTHORIZATION="Token a")
+        self.assertNotIn(PIN_COOKIE_NAME, response.cookies)
+        self.assertEqual(self.request("get", HTTP_AUTHORIZATION="Token a")[0], "replica")
+
+    def test_catalog_misses_read_from_the_replica(self):
+        catalog = CatalogCache(Flavor)
+        self.assertEqual(catalog.queryset().db, "replica")
+        catalog.clear()
+        self.assertEqual(catalog.queryset().db, "default")
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertIsNone(self.request("get")[0])
+        self.assertNotIn(PIN_COOKIE_NAME, self.request("post", write=True)[1].cookies)
+
+
+@skipUnless(settings.DATABASES["default"]["ENGINE"] == "svcs.db.postgresql", "Needs PostgreSQL")
+@override_settings(DATABASE_REPLICAS=["postgres_replica"])
+class ReplicaDatabaseTests(TransactionTestCase):
+    databases = {"default", "postgres_replica"}
+
+    def setUp(self):
+        routers.recent_writers.clear()
+        # The test database can only be dropped once the mirror's pooled
+        # connections are closed.
+        self.addCleanup(connections["postgres_replica"].close_pool)
+        user = User.objects.create_user(username="replica_user")
+        token = Token.objects.create(user=user)
+        group = Group.objects.create(name="ReplicaGroup")
+        user.groups.add(group)
+        self.vm = VirtualMachine.objects.create(
+            name="ReplicaVM",
+            environment=Environment.objects.create(name="ReplicaEnv", group=group),
+            image=Image.objects.create(name="ReplicaImage"),
+            flavor=Flavor.objects.create(
+                name="ReplicaFlavor", cpu_cores=1, memory_mb=1024, disk_gb=10, gpu_type="", gpu_count=0
+            ),
+            compute_node=ComputeNode.objects.create(
+                name="replica-node", cpu_cores=1, memory_mb=1024, disk_gb=10, gpu_type="", gpu_count=0
+            ),
+            state="starting",
+        )
+        self.client = AsyncAPIClient()
+        self.authorization = f"Token {token.key}"
+        self.url = reverse("virtual_machine_by_id", kwargs={"pk": self.vm.pk})
+
+    async def get_databases(self):
+        databases = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            databases.append(db_for_read(router, model, **hints))
+            return databases[-1]
+
+        with patch.object(ReplicaRouter, "db_for_read", record):
+            response = await self.client.get(self.url, AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["id"], self.vm.pk)
+        return databases
+
+    async def test_reads_follow_the_writes_of_the_client(self):
+        self.assertIn("postgres_replica", await self.get_databases())
+        response = await self.client.patch(
+            self.url, {"state": "started"}, format="json", AUTHORIZATION=self.authorization
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("postgres_replica", await self.get_databases())
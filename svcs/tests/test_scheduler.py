@@ -0,0 +1,154 @@
+from unittest.mock import patch, AsyncMock
+from django.test import TestCase, override_settings
+from svcs.models import Flavor, ComputeNode
+from svcs.scheduler import (
+    BinPackWeigher,
+    CapacityIndex,
+    ComputeFilter,
+    DiskFilter,
+    GpuFilter,
+    LeastRecentlyUsedWeigher,
+    NoValidHost,
+    Scheduler,
+    SpreadWeigher,
+    arelease_capacity,
+    areserve_capacity,
+    get_scheduler,
+)
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        self.flavor = Flavor.objects.create(
+            name="a6000x1", cpu_cores=4, memory_mb=8192, disk_gb=100, gpu_type="A6000", gpu_count=1
+        )
+        self.small_node = ComputeNode.objects.create(
+            name="compute-small", cpu_cores=8, memory_mb=16384, disk_gb=200, gpu_type="A6000", gpu_count=2
+        )
+        self.large_node = ComputeNode.objects.create(
+            name="compute-large", cpu_cores=32, memory_mb=65536, disk_gb=800, gpu_type="A6000", gpu_count=8
+        )
+        self.h100_node = ComputeNode.objects.create(
+            name="compute-h100", cpu_cores=32, memory_mb=65536, disk_gb=800, gpu_type="H100", gpu_count=8
+        )
+
+    def make_scheduler(self, *weighers):
+        return Scheduler(
+            index=CapacityIndex(ttl=60),
+            filters=[ComputeFilter(), DiskFilter(), GpuFilter()],
+            weighers=[(weigher, 1.0) for weigher in weighers],
+        )
+
+    async def test_spread_prefers_emptiest_node(self):
+        scheduler = self.make_scheduler(SpreadWeigher())
+        names = [(await scheduler.select(self.flavor)).name for _ in range(3)]
+        self.assertEqual(names, ["compute-small", "compute-large", "compute-large"])
+
+    async def test_bin_pack_prefers_fullest_node(self):
+        scheduler = self.make_scheduler(BinPackWeigher())
+        self.assertEqual((await scheduler.select(self.flavor)).name, "compute-small")
+        self.assertEqual((await scheduler.select(self.flavor)).name, "compute-small")
+        self.assertEqual((await scheduler.select(self.flavor)).name, "compute-large")
+
+    async def test_least_recently_used_rotates_nodes(self):
+        scheduler = self.make_scheduler(LeastRecentlyUsedWeigher())
+        names = [(await scheduler.select(self.flavor)).name for _ in range(3)]
+        self.assertEqual(names, ["compute-small", "compute-large", "compute-small"])
+
+    async def test_gpu_type_is_filtered(self):
+        flavor = await Flavor.objects.acreate(
+            name="h100x4", cpu_cores=4, memory_mb=8192, disk_gb=100, gpu_type="H100", gpu_count=4
+        )
+        scheduler = self.make_scheduler(SpreadWeigher())
+        self.assertEqual((await scheduler.select(flavor)).name, "compute-h100")
+        self.assertEqual((await scheduler.select(flavor)).name, "compute-h100")
+        with self.assertRaises(NoValidHost):
+            await scheduler.select(flavor)
+
+    async def test_release_returns_capacity(self):
+        flavor = await Flavor.objects.acreate(
+            name="h100x8", cpu_cores=4, memory_mb=8192, disk_gb=100, gpu_type="H100", gpu_count=8
+        )
+        scheduler = self.make_scheduler(SpreadWeigher())
+        compute_node = await scheduler.select(flavor)
+        with self.assertRaises(NoValidHost):
+            await scheduler.select(flavor)
+        await scheduler.release(compute_node.id, flavor)
+        self.assertEqual((await scheduler.select(flavor)).id, compute_node.id)
+
+    async def test_select_many_spreads_in_one_pass(self):
+        scheduler = self.make_scheduler(SpreadWeigher())
+        compute_nodes = await scheduler.select_many(self.flavor, 6)
+        names = sorted(compute_node.name for compute_node in compute_nodes)
+        self.assertEqual(names, ["compute-large"] * 4 + ["compute-small"] * 2)
+        await self.large_node.arefresh_from_db()
+        self.assertEqual(self.large_node.allocated_gpu_count, 4)
+
+    async def test_select_many_releases_partial_placement(self):
+        scheduler = self.make_scheduler(SpreadWeigher())
+        with self.assertRaises(NoValidHost):
+            await scheduler.select_many(self.flavor, 11)
+        await self.small_node.arefresh_from_db()
+        await self.large_node.arefresh_from_db()
+        self.assertEqual(self.small_node.allocated_gpu_count, 0)
+        self.assertEqual(self.large_node.allocated_gpu_count, 0)
+        self.assertEqual(len(await scheduler.select_many(self.flavor, 10)), 10)
+
+    async def test_reservation_is_conditional(self):
+        self.assertTrue(await areserve_capacity(self.small_node.id, self.flavor))
+        self.assertTrue(await areserve_capacity(self.small_node.id, self.flavor))
+        self.assertFalse(await areserve_capacity(self.small_node.id, self.flavor))
+        await self.small_node.arefresh_from_db()
+        self.assertEqual(self.small_node.allocated_cpu_cores, 8)
+        self.assertEqual(self.small_node.allocated_memory_mb, 16384)
+        self.assertEqual(self.small_node.allocated_disk_gb, 200)
+        self.assertEqual(self.small_node.allocated_gpu_count, 2)
+        await arelease_capacity(self.small_node.id, self.flavor)
+        await arelease_capacity(self.small_node.id, self.flavor)
+        await arelease_capacity(self.small_node.id, self.flavor)
+        await self.small_node.arefresh_from_db()
+        self.assertEqual(self.small_node.allocated_cpu_cores, 0)
+        self.assertEqual(self.small_node.allocated_gpu_count, 0)
+
+    async def test_stale_index_falls_back_to_next_node(self):
+        scheduler = self.make_scheduler(BinPackWeigher())
+        await scheduler.index.get_hosts()
+        # Another conductor fills compute-small behind this index's back.
+        await ComputeNode.objects.filter(pk=self.small_node.id).aupdate(allocated_gpu_count=2)
+        compute_node = await scheduler.select(self.flavor)
+        self.assertEqual(compute_node.name, "compute-large")
+        self.assertEqual(scheduler.index.get(self.small_node.id).free_gpu_count, 0)
+
+    async def test_index_reads_allocated_counters(self):
+        await ComputeNode.objects.filter(pk=self.small_node.id).aupdate(
+            allocated_cpu_cores=8, allocated_gpu_count=2
+        )
+        index = CapacityIndex(ttl=60)
+        await index.load()
+        host = index.get(self.small_node.id)
+        self.assertEqual(host.free_gpu_count, 0)
+        self.assertEqual(host.free_cpu_cores, 0)
+        self.assertEqual(index.get(self.large_node.id).free_gpu_count, 8)
+
+    async def test_index_is_not_reloaded_before_ttl(self):
+        index = CapacityIndex(ttl=60)
+        await index.get_hosts()
+        with patch.object(index, "load", new_callable=AsyncMock) as mock_load:
+            hosts = await index.get_hosts()
+        mock_load.assert_not_called()
+        self.assertEqual(len(hosts), 3)
+
+    async def test_compute_node_changes_invalidate_index(self):
+        scheduler = get_scheduler()
+        await scheduler.index.get_hosts()
+        await ComputeNode.objects.acreate(
+            name="compute-new", cpu_cores=8, memory_mb=16384, disk_gb=200, gpu_type="A6000", gpu_count=2
+        )
+        self.assertEqual(len(await scheduler.index.get_hosts()), 4)
+
+    @override_settings(SCHEDULER_WEIGHERS={"svcs.scheduler.BinPackWeigher": 2.0})
+    def test_from_settings(self):
+        scheduler = Scheduler.from_settings()
+        self.assertEqual(len(scheduler.filters), 3)
+        self.assertIsInstance(scheduler.weighers[0][0], BinPackWeigher)
+        self.assertEqual(scheduler.weighers[0][1], 2.0)
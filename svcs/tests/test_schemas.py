@@ -0,0 +1,84 @@
+from django.test import SimpleTestCase
+from rest_framework.exceptions import ValidationError
+
+from svcs.schemas import VirtualMachineCreate, validate_payload
+from svcs.serializers import VirtualMachineSerializer
+
+
+class VirtualMachineCreateTests(SimpleTestCase):
+    valid = {
+        "environment_name": "TestEnv",
+        "image_name": "TestImage",
+        "flavor_name": "TestFlavor",
+        "key_names": ["TestKey"],
+    }
+
+    def assertSameAsSerializer(self, data):
+        serializer = VirtualMachineSerializer(data=data)
+        try:
+            validated_data = validate_payload(VirtualMachineCreate, data)
+        except ValidationError as e:
+            self.assertFalse(serializer.is_valid(), msg=f"Only the schema rejected {data}")
+            self.assertEqual(e.detail, serializer.errors)
+            return e.detail
+        self.assertTrue(serializer.is_valid(), msg=f"Only the serializer rejected {data}: {serializer.errors}")
+        for field, value in validated_data.items():
+            self.assertEqual(value, serializer.validated_data.get(field), msg=field)
+        return None
+
+    def test_valid_payloads(self):
+        payloads = [
+            self.valid,
+            {
+                **self.valid,
+                "name": "  vm  ",
+                "user_data": "#cloud-config\n",
+                "callback_url": "https://tenant.example.com/hook",
+                "assign_floating_ip": "true",
+                "labels": [],
+                "count": "3",
+            },
+            {**self.valid, "labels": ["a", "b"], "unknown": "ignored"},
+            {**self.valid, "name": "x" * 255},
+            {**self.valid, "name": "x" * 252, "count": 10},
+        ]
+        for data in payloads:
+            with self.subTest(data=data):
+                self.assertIsNone(self.assertSameAsSerializer(data))
+
+    def test_numeric_names(self):
+        payloads = [
+            {**self.valid, "name": 42},
+            {**self.valid, "name": 4.5, "labels": [1, 2]},
+            {**self.valid, "environment_name": 7, "key_names": [8]},
+        ]
+        for data in payloads:
+            with self.subTest(data=data):
+                self.assertIsNone(self.assertSameAsSerializer(data))
+        self.assertEqual(validate_payload(VirtualMachineCreate, {**self.valid, "name": 42})["name"], "42")
+        self.assertIsNotNone(self.assertSameAsSerializer({**self.valid, "name": True}))
+
+    def test_invalid_payloads(self):
+        payloads = [
+            {},
+            {**self.valid, "environment_name": ""},
+            {**self.valid, "environment_name": "   "},
+            {**self.valid, "environment_name": None},
+            {**self.valid, "image_name": "x" * 256},
+            {**self.valid, "key_names": []},
+            {**self.valid, "key_names": "TestKey"},
+            {**self.valid, "key_names": ["TestKey", "x" * 256, ""]},
+            {**self.valid, "labels": [None]},
+            {**self.valid, "callback_url": "not a url"},
+            {**self.valid, "assign_floating_ip": "maybe"},
+            {**self.valid, "count": 0},
+            {**self.valid, "count": 257},
+            {**self.valid, "count": "many"},
+            {**self.valid, "count": 2},
+            {**self.valid, "name": "x" * 253, "count": 10},
+            {**self.valid, "user_data": "x" * (1024 * 1024 + 1)},
+            ["not", "a", "dict"],
+        ]
+        for data in payloads:
+            with self.subTest(data=str(data)[:80]):
+                self.assertIsNotNone(self.assertSameAsSerializer(data))
@@ -0,0 +1,223 @@
+import asyncio
+import socket
+import threading
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
+import requests
+from django.contrib.auth.models import Group
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from svcs.models import ComputeNode, Environment, Flavor, Image, VirtualMachine, WebhookDelivery
+from svcs.webhooks import ForbiddenDestination, WebhookDispatcher, check_destination, enqueue_webhooks, retry_delay
+
+
+class WebhookTests(TestCase):
+    def setUp(self):
+        flavor = Flavor.objects.create(
+            name="TestFlavor", cpu_cores=2, memory_mb=2048, disk_gb=20, gpu_type="TestGPU", gpu_count=0
+        )
+        compute_node = ComputeNode.objects.create(
+            name="compute-1", cpu_cores=4, memory_mb=4096, disk_gb=40, gpu_type="TestGPU", gpu_count=0
+        )
+        group = Group.objects.create(name="TestGroup")
+        environment = Environment.objects.create(name="TestEnv", group=group)
+        image = Image.objects.create(name="TestImage")
+        self.vm, self.slow_vm, self.silent_vm = [
+            VirtualMachine.objects.create(
+                name=name,
+                environment=environment,
+                image=image,
+                flavor=flavor,
+                compute_node=compute_node,
+                callback_url=callback_url,
+            )
+            for name, callback_url in [
+                ("vm-1", "http://tenant.example.com/hook"),
+                ("vm-2", "http://slow.example.com/hook"),
+                ("vm-3", None),
+            ]
+        ]
+
+    async def dispatch(self, dispatcher):
+        await dispatcher.dispatch_due()
+        await asyncio.gather(*list(dispatcher.in_flight.values()))
+
+    def create_dispatcher(self, max_per_host=4, allow_private_destinations=False):
+        return WebhookDispatcher(
+            max_concurrency=4,
+            max_per_host=max_per_host,
+            poll_interval=1,
+            lease=300,
+            allow_private_destinations=allow_private_destinations,
+        )
+
+    def resolve_to(self, address):
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        return patch(
+            "svcs.webhooks.socket.getaddrinfo",
+            return_value=[(family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, 80))],
+        )
+
+    async def test_enqueue_coalesces(self):
+        await enqueue_webhooks([self.vm, self.silent_vm])
+        self.vm.state = "started"
+        await enqueue_webhooks([self.vm])
+        deliveries = [delivery async for delivery in WebhookDelivery.objects.all()]
+        self.assertEqual(len(deliveries), 1)
+        self.assertEqual(deliveries[0].virtual_machine_id, self.vm.id)
+        self.assertEqual(deliveries[0].url, "http://tenant.example.com/hook")
+        self.assertEqual(deliveries[0].payload["state"], "started")
+
+        await WebhookDelivery.objects.aupdate(attempts=3)
+        await enqueue_webhooks([self.vm], state="deleted")
+        delivery = await WebhookDelivery.objects.aget()
+        self.assertEqual(delivery.payload["state"], "deleted")
+        self.assertEqual(delivery.attempts, 0)
+
+    async def test_deliver(self):
+        await enqueue_webhooks([self.vm])
+        dispatcher = self.create_dispatcher()
+        with patch.object(dispatcher, "post", return_value=Mock(status_code=204)) as mock_post:
+            await self.dispatch(dispatcher)
+        mock_post.assert_called_once()
+        delivery = mock_post.call_args.args[0]
+        self.assertEqual(delivery.payload, {"id": self.vm.id, "name": "vm-1", "state": "starting", "hypervisor_id": None})
+        self.assertFalse(await WebhookDelivery.objects.aexists())
+        await dispatcher.close()
+
+    async def test_deliver_failure_backs_off(self):
+        await enqueue_webhooks([self.vm])
+        dispatcher = self.create_dispatcher()
+        with patch.object(dispatcher, "post", return_value=Mock(status_code=503)):
+            await self.dispatch(dispatcher)
+        delivery = await WebhookDelivery.objects.aget()
+        self.assertEqual(delivery.attempts, 1)
+        self.assertGreater(delivery.next_attempt_at, timezone.now())
+
+        with patch.object(dispatcher, "post") as mock_post:
+            await self.dispatch(dispatcher)
+        mock_post.assert_not_called()
+        await dispatcher.close()
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=3)
+    async def test_deliver_gives_up(self):
+        await enqueue_webhooks([self.vm])
+        await WebhookDelivery.objects.aupdate(attempts=2)
+        dispatcher = self.create_dispatcher()
+        with patch.object(dispatcher, "post", side_effect=requests.ConnectionError("refused")):
+            await self.dispatch(dispatcher)
+        self.assertFalse(await WebhookDelivery.objects.aexists())
+        await dispatcher.close()
+
+    async def test_newer_state_survives_delivery(self):
+        await enqueue_webhooks([self.vm])
+        sent = await WebhookDelivery.objects.aget()
+        self.vm.state = "started"
+        await enqueue_webhooks([self.vm])
+        dispatcher = self.create_dispatcher()
+        await dispatcher.delivered(sent)
+        delivery = await WebhookDelivery.objects.aget()
+        self.assertEqual(delivery.payload["state"], "started")
+        await dispatcher.close()
+
+    async def test_slow_host_does_not_block_others(self):
+        await enqueue_webhooks([self.vm, self.slow_vm])
+        fast = await WebhookDelivery.objects.aget(virtual_machine_id=self.vm.id)
+        dispatcher = self.create_dispatcher(max_per_host=1)
+        release = threading.Event()
+
+        def post(delivery):
+            if "slow" in delivery.url:
+                release.wait(5)
+            return Mock(status_code=200)
+
+        with patch.object(dispatcher, "post", side_effect=post):
+            await dispatcher.dispatch_due()
+            tasks = {
+                delivery_id: task for delivery_id, task in dispatcher.in_flight.items()
+            }
+            await tasks[fast.pk]
+            self.assertFalse(await WebhookDelivery.objects.filter(pk=fast.pk).aexists())
+            self.assertTrue(await WebhookDelivery.objects.filter(virtual_machine_id=self.slow_vm.id).aexists())
+            release.set()
+            await asyncio.gather(*tasks.values())
+        self.assertFalse(await WebhookDelivery.objects.aexists())
+        await dispatcher.close()
+
+    async def test_claims_only_free_host_slots(self):
+        self.silent_vm.callback_url = "http://slow.example.com/other-hook"
+        await self.silent_vm.asave()
+        await enqueue_webhooks([self.vm, self.slow_vm, self.silent_vm])
+        dispatcher = self.create_dispatcher(max_per_host=1)
+        release = threading.Event()
+
+        def post(delivery):
+            release.wait(5)
+            return Mock(status_code=200)
+
+        with patch.object(dispatcher, "post", side_effect=post) as mock_post:
+            await dispatcher.dispatch_due()
+            # The second delivery to the busy host is left unclaimed, for
+            # another replica or a later round, instead of waiting on its
+            # lease.
+            self.assertEqual(len(dispatcher.in_flight), 2)
+            unclaimed = await WebhookDelivery.objects.exclude(pk__in=list(dispatcher.in_flight)).aget()
+            self.assertLessEqual(unclaimed.next_attempt_at, timezone.now())
+            release.set()
+            await asyncio.gather(*list(dispatcher.in_flight.values()))
+            await self.dispatch(dispatcher)
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertFalse(await WebhookDelivery.objects.aexists())
+        await dispatcher.close()
+
+    @override_settings(WEBHOOK_BATCH_SIZE=1)
+    async def test_busy_hosts_are_left_out_of_the_query(self):
+        await enqueue_webhooks([self.slow_vm, self.vm])
+        await WebhookDelivery.objects.filter(virtual_machine_id=self.slow_vm.id).aupdate(
+            next_attempt_at=timezone.now() - timedelta(minutes=1)
+        )
+        dispatcher = self.create_dispatcher(max_per_host=1)
+        dispatcher.in_flight_per_host["slow.example.com"] = 1
+        with patch.object(dispatcher, "post", return_value=Mock(status_code=200)):
+            await self.dispatch(dispatcher)
+        self.assertFalse(await WebhookDelivery.objects.filter(virtual_machine_id=self.vm.id).aexists())
+        await dispatcher.close()
+
+    def test_check_destination(self):
+        for address in ["127.0.0.1", "10.0.0.1", "192.168.1.1", "169.254.169.254", "::1", "fe80::1", "::ffff:127.0.0.1"]:
+            with self.subTest(address=address), self.resolve_to(address):
+                with self.assertRaises(ForbiddenDestination):
+                    check_destination("http://tenant.example.com/hook")
+        with self.resolve_to("93.184.216.34"):
+            check_destination("http://tenant.example.com/hook")
+        with patch("svcs.webhooks.socket.getaddrinfo", side_effect=socket.gaierror("no such host")):
+            with self.assertRaises(requests.ConnectionError):
+                check_destination("http://tenant.example.com/hook")
+
+    async def test_private_destination_is_dropped(self):
+        await enqueue_webhooks([self.vm])
+        dispatcher = self.create_dispatcher()
+        with self.resolve_to("169.254.169.254"), patch.object(dispatcher.session, "post") as mock_post, \
+                self.assertLogs("svcs.webhooks", "WARNING"):
+            await self.dispatch(dispatcher)
+        mock_post.assert_not_called()
+        self.assertFalse(await WebhookDelivery.objects.aexists())
+        await dispatcher.close()
+
+    async def test_private_destinations_can_be_allowed(self):
+        await enqueue_webhooks([self.vm])
+        dispatcher = self.create_dispatcher(allow_private_destinations=True)
+        with self.resolve_to("10.0.0.1"), patch.object(
+            dispatcher.session, "post", return_value=Mock(status_code=204)
+        ) as mock_post:
+            await self.dispatch(dispatcher)
+        mock_post.assert_called_once()
+        self.assertFalse(await WebhookDelivery.objects.aexists())
+        await dispatcher.close()
+
+    def test_retry_delay(self):
+        for attempts in range(1, 20):
+            self.assertLessEqual(retry_delay(attempts), 600)
+        self.assertGreaterEqual(retry_delay(3), 4)
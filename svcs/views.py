@@ -1,49 +1,193 @@
 from adrf.views import APIView
+from asgiref.sync import sync_to_async
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import aget_object_or_404
 from django.conf import settings
-from django.db.models import Subquery
-from .models import VirtualMachine, Environment, ComputeNode, FloatingIP
-from .serializers import VirtualMachineSerializer
-import aio_pika
+from django.db import router, transaction
+from django.db.models import Q, Subquery
+from django.http import Http404
+from django.utils import timezone
+from . import messages
+from .authentication import CachedTokenAuthentication, aget_primary_group
+from .cache import compute_nodes, environments
+from .scheduler import get_scheduler
+from .schemas import validate_payload
+from .models import VirtualMachine, FloatingIP
+from .serializers import (
+    VirtualMachineBulkDeleteSerializer,
+    VirtualMachineSerializer,
+    VirtualMachineStateSerializer,
+)
+from .state import apply_state_reports
+from .outbox import add_outbox_messages
+from .webhooks import add_webhooks, enqueue_webhooks
+from collections import Counter, defaultdict
+from datetime import datetime
+import base64
 import json
-import os
 
 class VirtualMachineView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    # A pydantic model from svcs/schemas.py that validates create payloads
+    # instead of VirtualMachineSerializer, e.g.
+    # VirtualMachineView.as_view(create_schema=VirtualMachineCreate).
+    create_schema = None
 
-    async def post(self, request, *args, **kwargs):
-        serializer = VirtualMachineSerializer(data=request.data, context={'user': request.user})
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        vm, public_ip = await serializer.asave()
-        await self.request_vm_start(vm, serializer.validated_data.get('labels'), public_ip)
+    async def get(self, request, pk=None):
+        group = await aget_primary_group(request.user)
+        queryset = self.get_queryset(group)
+        if pk is not None:
+            vms = [vm async for vm in queryset.filter(pk=pk)]
+            if not vms:
+                raise Http404
+            return Response(self.serialize_vm(vms[0]), status=status.HTTP_200_OK)
+        return await self.list_vms(request, queryset)
+
+    async def list_vms(self, request, queryset):
+        try:
+            limit = int(request.query_params.get('limit', settings.VM_LIST_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= settings.VM_LIST_MAX_PAGE_SIZE:
+            return Response({
+                'error': f'limit must be between 1 and {settings.VM_LIST_MAX_PAGE_SIZE}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = {
+            'environment': 'environment__name',
+            'state': 'state',
+            'label': 'vmlabel__name',
+            'compute_node': 'compute_node__name',
+        }
+        for param, lookup in filters.items():
+            if param in request.query_params:
+                queryset = queryset.filter(**{lookup: request.query_params[param]})
+
+        cursor = request.query_params.get('cursor')
+        if cursor is not None:
+            try:
+                created_at, vm_id = self.decode_cursor(cursor)
+            except (TypeError, ValueError):
+                return Response({
+                    'error': 'Invalid cursor.'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=vm_id)
+            )
+
+        vms = [vm async for vm in queryset.order_by('created_at', 'id')[:limit + 1]]
+        next_url = None
+        if len(vms) > limit:
+            vms = vms[:limit]
+            params = request.query_params.copy()
+            params['cursor'] = self.encode_cursor(vms[-1])
+            next_url = request.build_absolute_uri(f'{request.path}?{params.urlencode()}')
         return Response({
+            'results': [self.serialize_vm(vm) for vm in vms],
+            'next': next_url,
+        }, status=status.HTTP_200_OK)
+
+    def get_scoped_queryset(self, group):
+        if group is None:
+            return VirtualMachine.objects.none()
+        return VirtualMachine.objects.filter(environment__group=group)
+
+    def get_queryset(self, group):
+        return self.get_scoped_queryset(group).select_related(
+            'environment', 'image', 'flavor', 'compute_node'
+        ).prefetch_related('vmkeybinding_set__key', 'vmlabel_set', 'floatingip_set')
+
+    def serialize_vm(self, vm):
+        floating_ips = vm.floatingip_set.all()
+        return {
             'id': vm.id,
             'name': vm.name,
             'environment_name': vm.environment.name,
+            'image_name': vm.image.name,
+            'flavor_name': vm.flavor.name,
+            'compute_node_name': vm.compute_node.name if vm.compute_node else None,
             'state': vm.state,
-            'public_ip': public_ip,
-        }, status=status.HTTP_201_CREATED)
+            'key_names': [binding.key.name for binding in vm.vmkeybinding_set.all()],
+            'labels': [label.name for label in vm.vmlabel_set.all()],
+            'public_ip': floating_ips[0].ip_address if floating_ips else None,
+            'created_at': vm.created_at,
+            'updated_at': vm.updated_at,
+        }
+
+    def encode_cursor(self, vm):
+        position = json.dumps([vm.created_at.isoformat(), vm.id])
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        created_at, vm_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(vm_id)
+
+    async def post(self, request, *args, **kwargs):
+        if self.create_schema is not None:
+            try:
+                validated_data = validate_payload(self.create_schema, request.data)
+            except ValidationError as e:
+                return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+            serializer = VirtualMachineSerializer(context={'user': request.user})
+        else:
+            serializer = VirtualMachineSerializer(data=request.data, context={'user': request.user})
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            validated_data = serializer.validated_data
+        # The start messages were written to the outbox along with the VMs
+        # and are published by the relay, see svcs/outbox.py.
+        created = await serializer.acreate(validated_data)
+        data = [
+            {
+                'id': vm.id,
+                'name': vm.name,
+                'environment_name': vm.environment.name,
+                'state': vm.state,
+                'public_ip': public_ip,
+            }
+            for vm, public_ip in created
+        ]
+        if validated_data['count'] == 1:
+            data = data[0]
+        return Response(data, status=status.HTTP_201_CREATED)
 
     async def delete(self, request, pk):
-        vm = await aget_object_or_404(VirtualMachine, pk=pk)
-        compute_node = await aget_object_or_404(ComputeNode, pk=vm.compute_node_id)
-        if vm.state in [ 'deleting', 'failed' ]:
+        vm = await aget_object_or_404(VirtualMachine.objects.select_related('flavor'), pk=pk)
+        await self.delete_vm(vm)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    async def delete_vm(self, vm):
+        # A VM that was never placed has no compute node to acknowledge its
+        # deletion.
+        if vm.state in [ 'deleting', 'failed' ] or vm.compute_node_id is None:
+            await enqueue_webhooks([vm], state='deleted')
             await vm.adelete()
+            if vm.state == 'deleting' and vm.compute_node_id is not None:
+                await get_scheduler().release(vm.compute_node_id, vm.flavor)
         else:
+            compute_node = await compute_nodes.aget(pk=vm.compute_node_id)
             vm.state = 'deleting'
-            await vm.asave()
-            await self.request_vm_delete(compute_node.name, vm.id, vm.hypervisor_id)
-        return Response(status=status.HTTP_204_NO_CONTENT)
+            await sync_to_async(self.save_deleting)(vm, compute_node.name)
+
+    def save_deleting(self, vm, compute_node_name):
+        """
+        Save `vm`, moved to "deleting", together with its delete message for
+        the compute node and its notification.
+        """
+        with transaction.atomic(using=router.db_for_write(VirtualMachine)):
+            vm.save()
+            add_webhooks([vm])
+            add_outbox_messages([
+                (f"q.{compute_node_name}", messages.delete_vm(vm.id, vm.hypervisor_id))
+            ])
 
     async def patch(self, request, pk):
-        vm = await aget_object_or_404(VirtualMachine, pk=pk)
-        environment = await aget_object_or_404(Environment, pk=vm.environment_id)
+        vm = await aget_object_or_404(VirtualMachine.objects.select_related('flavor'), pk=pk)
+        environment = await environments.aget(pk=vm.environment_id)
 
         vm_hypervisor_id = request.data.get('hypervisor_id')
         if vm_hypervisor_id is not None:
@@ -54,16 +198,20 @@ class VirtualMachineView(APIView):
             return Response({
                 'error': 'state is required'
             }, status=status.HTTP_400_BAD_REQUEST)
+        previous_state = vm.state
         vm.state = state
 
         await vm.asave()
         if vm.state == 'failed':
+            if previous_state != 'failed':
+                await get_scheduler().release(vm.compute_node_id, vm.flavor)
             assigned_floating_ip = (
                 FloatingIP.objects.filter(virtual_machine=vm).values('id')
             )
             await FloatingIP.objects.filter(
                 id=Subquery(assigned_floating_ip)
             ).aupdate(virtual_machine=None)
+        await enqueue_webhooks([vm])
 
         return Response({
             'id': vm.id,
@@ -72,65 +220,162 @@ class VirtualMachineView(APIView):
             'state': vm.state
         }, status=status.HTTP_200_OK)
 
-    rabbitmq_channel = None
-    rabbitmq_exchange = None
-
-    async def init_rabbitmq(self):
-        if self.rabbitmq_channel is not None and not self.rabbitmq_channel.is_closed:
-            return
-        rabbitmq_host = os.environ.get("RABBITMQ_HOST")
-        if not rabbitmq_host:
-            raise ValueError("RABBITMQ_HOST environment variable is not set")
-        rabbitmq_port = os.environ.get("RABBITMQ_PORT")
-        if not rabbitmq_port:
-            rabbitmq_port = 5672
-        else:
-            rabbitmq_port = int(rabbitmq_port)
-        connection = await aio_pika.connect_robust(host=rabbitmq_host, port=rabbitmq_port)
-        self.rabbitmq_channel = await connection.channel()
-        self.rabbitmq_exchange = await self.rabbitmq_channel.declare_exchange(
-            settings.EXCHANGE_NAME, aio_pika.ExchangeType.DIRECT, durable=True
+    async def delete_vms(self, vms):
+        """
+        Delete `vms` with a fixed number of statements and one delete message
+        per compute node.
+
+        VMs that are already being deleted, that failed or that were never
+        placed on a compute node are removed right away, like `delete_vm`
+        does. Returns the VMs now being deleted and the VMs removed.
+        """
+        removed = [
+            vm for vm in vms
+            if vm.state in ['deleting', 'failed'] or vm.compute_node_id is None
+        ]
+        if removed:
+            await enqueue_webhooks(removed, state='deleted')
+            await VirtualMachine.objects.filter(pk__in=[vm.id for vm in removed]).adelete()
+            released = Counter(
+                (vm.compute_node_id, vm.flavor) for vm in removed
+                if vm.state == 'deleting' and vm.compute_node_id is not None
+            )
+            for (compute_node_id, flavor), count in released.items():
+                await get_scheduler().release(compute_node_id, flavor, count)
+
+        deleting = []
+        removed_ids = {vm.id for vm in removed}
+        candidates = [vm for vm in vms if vm.id not in removed_ids]
+        if candidates:
+            # A concurrent request may have moved some of the VMs on since
+            # they were read; only those moved to "deleting" here get a
+            # delete message.
+            compute_node_names = {
+                compute_node_id: (await compute_nodes.aget(pk=compute_node_id)).name
+                for compute_node_id in {vm.compute_node_id for vm in candidates}
+            }
+            deleting = await sync_to_async(self.mark_deleting)(candidates, compute_node_names)
+        return deleting, removed
+
+    def mark_deleting(self, vms, compute_node_names):
+        """
+        Move the VMs in `vms` that are not already being deleted, or failed,
+        to "deleting" and return them.
+
+        The delete messages, one per compute node, and the notifications are
+        written in the same transaction.
+        """
+        with transaction.atomic(using=router.db_for_write(VirtualMachine)):
+            vm_ids = set(
+                VirtualMachine.objects.select_for_update().filter(pk__in=[vm.id for vm in vms]).exclude(
+                    state__in=['deleting', 'failed']
+                ).values_list('id', flat=True)
+            )
+            VirtualMachine.objects.filter(pk__in=vm_ids).update(
+                state='deleting', updated_at=timezone.now()
+            )
+            deleting = [vm for vm in vms if vm.id in vm_ids]
+            by_compute_node = defaultdict(list)
+            for vm in deleting:
+                vm.state = 'deleting'
+                by_compute_node[vm.compute_node_id].append(vm)
+            add_webhooks(deleting)
+            add_outbox_messages([
+                (f"q.{compute_node_names[compute_node_id]}", messages.delete_vms(node_vms))
+                for compute_node_id, node_vms in by_compute_node.items()
+            ])
+        return deleting
+
+
+class VirtualMachineByNameView(VirtualMachineView):
+    """
+    A VM addressed by its environment and name, which are unique together.
+    """
+    http_method_names = ['get', 'delete', 'options']
+
+    async def get(self, request, environment_name, name):
+        group = await aget_primary_group(request.user)
+        vms = [
+            vm async for vm in self.get_queryset(group).filter(
+                environment__name=environment_name, name=name
+            )
+        ]
+        if not vms:
+            raise Http404
+        return Response(self.serialize_vm(vms[0]), status=status.HTTP_200_OK)
+
+    async def delete(self, request, environment_name, name):
+        group = await aget_primary_group(request.user)
+        vm = await aget_object_or_404(
+            self.get_scoped_queryset(group).select_related('flavor'),
+            environment__name=environment_name,
+            name=name,
         )
+        await self.delete_vm(vm)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
-    async def request_vm_start(self, vm, labels, public_ip=None):
-        await self.init_rabbitmq()
-        queue_name = f"q.{vm.compute_node.name}"
-        queue = await self.rabbitmq_channel.declare_queue(queue_name, durable=True)
-        await queue.bind(self.rabbitmq_exchange, routing_key=queue_name)
-        message = {
-            'id': vm.id,
-            'name': vm.name,
-            'state': 'started',
-            'image': vm.image.name,
-            'cpu_cores': vm.flavor.cpu_cores,
-            'memory_mb': vm.flavor.memory_mb,
-            'disk_gb': vm.flavor.disk_gb,
-            'user_data': vm.user_data,
-            'labels': labels,
-            'public_ip': public_ip,
-        }
-        await self.rabbitmq_exchange.publish(
-            aio_pika.Message(
-                body=json.dumps(message).encode(),
-                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-            ),
-            routing_key=queue_name,
+
+class VirtualMachineByLabelView(VirtualMachineView):
+    """
+    All VMs of an environment that carry a label.
+    """
+    http_method_names = ['get', 'delete', 'options']
+
+    async def get(self, request, environment_name, label):
+        group = await aget_primary_group(request.user)
+        queryset = self.get_queryset(group).filter(
+            environment__name=environment_name, vmlabel__name=label
         )
+        return await self.list_vms(request, queryset)
 
-    async def request_vm_delete(self, compute_node_name, vm_id, vm_hypervisor_id):
-        await self.init_rabbitmq()
-        queue_name = f"q.{compute_node_name}"
-        queue = await self.rabbitmq_channel.declare_queue(queue_name, durable=True)
-        await queue.bind(self.rabbitmq_exchange, routing_key=queue_name)
-        message = {
-            'id': vm_id,
-            'hypervisor_id': vm_hypervisor_id,
-            'state': 'deleted',
-        }
-        await self.rabbitmq_exchange.publish(
-            aio_pika.Message(
-                body=json.dumps(message).encode(),
-                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-            ),
-            routing_key=queue_name,
+    async def delete(self, request, environment_name, label):
+        group = await aget_primary_group(request.user)
+        vms = self.get_scoped_queryset(group).select_related('flavor').filter(
+            environment__name=environment_name, vmlabel__name=label
+        )
+        await self.delete_vms([vm async for vm in vms])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class VirtualMachineBulkDeleteView(VirtualMachineView):
+    """
+    Delete the VMs of an environment selected by label or by id.
+    """
+    http_method_names = ['post', 'options']
+
+    async def post(self, request):
+        serializer = VirtualMachineBulkDeleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        group = await aget_primary_group(request.user)
+        vms = self.get_scoped_queryset(group).select_related('flavor').filter(
+            environment__name=data['environment_name']
+        )
+        if 'label' in data:
+            vms = vms.filter(vmlabel__name=data['label'])
+        else:
+            vms = vms.filter(pk__in=data['ids'])
+        deleting, removed = await self.delete_vms([vm async for vm in vms])
+        return Response({
+            'deleting': [vm.id for vm in deleting],
+            'deleted': [vm.id for vm in removed],
+        }, status=status.HTTP_200_OK)
+
+
+class VirtualMachineStateView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    max_batch_size = 1000
+
+    async def post(self, request):
+        serializer = VirtualMachineStateSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=self.max_batch_size
         )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        vms, not_found = await apply_state_reports(serializer.validated_data)
+        return Response({
+            'updated': [vm.id for vm in vms],
+            'not_found': not_found,
+        }, status=status.HTTP_200_OK)
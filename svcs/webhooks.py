@@ -0,0 +1,289 @@
+"""
+Delivery of VM state changes to the `callback_url` given at creation.
+
+State changes are written to the WebhookDelivery table, one row per VM, so
+rapid transitions coalesce into a single delivery of the latest state and
+pending deliveries survive a restart. The dispatcher polls the table for due
+rows, posts them over a pooled HTTP session and reschedules failures with
+exponential backoff. Every host gets its own concurrency limit, so a slow
+tenant endpoint only delays its own notifications.
+
+Callback URLs are chosen by tenants, so unless
+WEBHOOK_ALLOW_PRIVATE_DESTINATIONS is set, a delivery to a host that
+resolves to a loopback, link-local, private or otherwise non-global address
+is dropped rather than sent from inside the conductor's network.
+"""
+import asyncio
+import ipaddress
+import logging
+import random
+import socket
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from .models import WebhookDelivery
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_payload(vm, state=None):
+    return {
+        "id": vm.id,
+        "name": vm.name,
+        "state": state or vm.state,
+        "hypervisor_id": vm.hypervisor_id,
+    }
+
+
+def add_webhooks(vms, state=None):
+    """
+    Schedule a notification of the current state of each VM in `vms` that
+    has a callback URL, replacing any notification still pending for it.
+
+    `state` overrides the reported state, e.g. "deleted" for VMs that no
+    longer exist. Called inside a transaction, the notifications commit with
+    it and the dispatcher is woken once it does.
+    """
+    now = timezone.now()
+    deliveries = [
+        WebhookDelivery(
+            virtual_machine_id=vm.id,
+            url=vm.callback_url,
+            host=urlsplit(vm.callback_url).netloc,
+            payload=webhook_payload(vm, state),
+            next_attempt_at=now,
+        )
+        for vm in vms
+        if vm.callback_url
+    ]
+    if not deliveries:
+        return
+    WebhookDelivery.objects.bulk_create(
+        deliveries,
+        update_conflicts=True,
+        unique_fields=["virtual_machine_id"],
+        update_fields=["url", "host", "payload", "attempts", "next_attempt_at", "updated_at"],
+    )
+    transaction.on_commit(wake_webhook_dispatcher, using=router.db_for_write(WebhookDelivery))
+
+
+enqueue_webhooks = sync_to_async(add_webhooks)
+
+
+def wake_webhook_dispatcher():
+    if _dispatcher is not None:
+        _dispatcher.wake()
+
+
+class ForbiddenDestination(Exception):
+    pass
+
+
+def check_destination(url):
+    """
+    Raise ForbiddenDestination unless every address the host of `url`
+    resolves to is a global one.
+
+    The addresses are checked before every attempt rather than when the
+    callback URL is given, since the name can be repointed in between.
+    """
+    parts = urlsplit(url)
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise requests.ConnectionError(f"Cannot resolve {parts.hostname}: {e}") from e
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ForbiddenDestination(f"{parts.hostname} resolves to {address}")
+
+
+def retry_delay(attempts):
+    """
+    Exponential backoff with full jitter, capped at WEBHOOK_MAX_BACKOFF.
+    """
+    delay = min(settings.WEBHOOK_BASE_BACKOFF * 2 ** attempts, settings.WEBHOOK_MAX_BACKOFF)
+    return random.uniform(delay / 2, delay)
+
+
+class WebhookDispatcher:
+    def __init__(self, max_concurrency, max_per_host, poll_interval, lease, allow_private_destinations=False):
+        self.max_per_host = max_per_host
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.allow_private_destinations = allow_private_destinations
+        self.in_flight = {}
+        self.in_flight_per_host = Counter()
+        self.woken = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        # Blocking HTTP calls run on a dedicated pool so that slow endpoints
+        # cannot starve the loop's default executor.
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="webhook"
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_concurrency=settings.WEBHOOK_MAX_CONCURRENCY,
+            max_per_host=settings.WEBHOOK_MAX_PER_HOST,
+            poll_interval=settings.WEBHOOK_POLL_INTERVAL,
+            lease=settings.WEBHOOK_LEASE,
+            allow_private_destinations=settings.WEBHOOK_ALLOW_PRIVATE_DESTINATIONS,
+        )
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.woken.set)
+
+    async def run(self):
+        while True:
+            try:
+                await self.dispatch_due()
+            except Exception:
+                logger.exception("Failed to dispatch webhooks")
+            try:
+                await asyncio.wait_for(self.woken.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.woken.clear()
+
+    async def dispatch_due(self):
+        """
+        Claim due deliveries that are not already in flight and start sending
+        them, reading at most WEBHOOK_BATCH_SIZE of them per round.
+
+        Only as many deliveries are claimed for a host as it has free slots,
+        so that every claimed delivery is sent right away and none waits
+        for its host long enough to outlive its lease. Hosts without a free
+        slot are left out of the query; when a host runs out of slots during
+        the round, another round follows straight away without it.
+        """
+        now = timezone.now()
+        busy_hosts = [
+            host for host, in_flight in self.in_flight_per_host.items()
+            if in_flight >= self.max_per_host
+        ]
+        due = WebhookDelivery.objects.filter(next_attempt_at__lte=now).exclude(
+            pk__in=list(self.in_flight)
+        ).exclude(host__in=busy_hosts).order_by("next_attempt_at")[:settings.WEBHOOK_BATCH_SIZE]
+        skipped = False
+        async for delivery in due:
+            host = delivery.host
+            if self.in_flight_per_host[host] >= self.max_per_host:
+                skipped = True
+                continue
+            # Push the next attempt out by the lease first, so that other
+            # conductor replicas polling the table skip this delivery.
+            claimed = await WebhookDelivery.objects.filter(
+                pk=delivery.pk, next_attempt_at=delivery.next_attempt_at
+            ).aupdate(next_attempt_at=now + timedelta(seconds=self.lease))
+            if claimed:
+                self.in_flight_per_host[host] += 1
+                self.in_flight[delivery.pk] = asyncio.create_task(self.deliver(delivery, host))
+        if skipped:
+            self.wake()
+
+    async def deliver(self, delivery, host):
+        try:
+            try:
+                response = await self.loop.run_in_executor(self.executor, self.post, delivery)
+                succeeded = response.status_code < 300
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                succeeded = False
+                error = str(e)
+            except ForbiddenDestination as e:
+                logger.warning(
+                    "Dropping webhook for VM %s to %s: %s",
+                    delivery.virtual_machine_id, delivery.url, e,
+                )
+                await WebhookDelivery.objects.filter(
+                    pk=delivery.pk, updated_at=delivery.updated_at
+                ).adelete()
+                return
+            if succeeded:
+                await self.delivered(delivery)
+            else:
+                await self.failed(delivery, error)
+        finally:
+            self.in_flight.pop(delivery.pk, None)
+            if self.in_flight_per_host[host] == self.max_per_host:
+                # Deliveries skipped for the busy host can go now.
+                self.wake()
+            self.in_flight_per_host[host] -= 1
+            if not self.in_flight_per_host[host]:
+                del self.in_flight_per_host[host]
+
+    def post(self, delivery):
+        if not self.allow_private_destinations:
+            check_destination(delivery.url)
+        return self.session.post(
+            delivery.url,
+            json=delivery.payload,
+            timeout=(settings.WEBHOOK_CONNECT_TIMEOUT, settings.WEBHOOK_READ_TIMEOUT),
+        )
+
+    async def delivered(self, delivery):
+        # A state change that arrived during the attempt replaced the row
+        # and bumped updated_at, in which case it is still to be sent.
+        await WebhookDelivery.objects.filter(
+            pk=delivery.pk, updated_at=delivery.updated_at
+        ).adelete()
+
+    async def failed(self, delivery, error):
+        attempts = delivery.attempts + 1
+        pending = WebhookDelivery.objects.filter(pk=delivery.pk, updated_at=delivery.updated_at)
+        if attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+            logger.warning(
+                "Giving up on webhook for VM %s to %s after %s attempts: %s",
+                delivery.virtual_machine_id, delivery.url, attempts, error,
+            )
+            await pending.adelete()
+            return
+        await pending.aupdate(
+            attempts=attempts,
+            next_attempt_at=timezone.now() + timedelta(seconds=retry_delay(attempts)),
+        )
+
+    async def close(self):
+        for task in self.in_flight.values():
+            task.cancel()
+        await asyncio.gather(*self.in_flight.values(), return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+_dispatcher = None
+_dispatcher_task = None
+
+
+async def start_webhook_dispatcher():
+    global _dispatcher, _dispatcher_task
+    _dispatcher = WebhookDispatcher.from_settings()
+    _dispatcher_task = asyncio.create_task(_dispatcher.run())
+
+
+async def stop_webhook_dispatcher():
+    global _dispatcher, _dispatcher_task
+    if _dispatcher_task is None:
+        return
+    _dispatcher_task.cancel()
+    await asyncio.gather(_dispatcher_task, return_exceptions=True)
+    await _dispatcher.close()
+    _dispatcher = None
+    _dispatcher_task = None